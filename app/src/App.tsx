@@ -22,14 +22,14 @@ import {
 
 const initialPuzzleState: IPuzzleState = {
   startImage: {
-    base64Image: "",
+    imageUrl: "",
     caption: "Loading...",
     headingText: ORIGINAL_IMAGE_HEADING,
     isLoading: true,
     displayPlaceholder: true,
   },
   goalImage: {
-    base64Image: "",
+    imageUrl: "",
     caption: "Loading...",
     headingText: GOAL_IMAGE_HEADING,
     isLoading: true,
@@ -38,7 +38,7 @@ const initialPuzzleState: IPuzzleState = {
   guessImages: Array(DEFAULT_NUM_GUESS_IMAGES)
     .fill(null)
     .map(() => ({
-      base64Image: "",
+      imageUrl: "",
       caption: IMAGE_PLACEHOLDER_CAPTION,
       headingText: "",
       isLoading: true,
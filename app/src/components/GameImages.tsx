@@ -11,7 +11,7 @@ export const GradientPlaceholder = () => (
 );
 
 export const ImageModal = ({
-  image: { base64Image, caption },
+  image: { imageUrl, caption },
   onClose,
 }: {
   image: IPuzzleImage;
@@ -23,7 +23,7 @@ export const ImageModal = ({
   >
     <div className="max-w-[90vw] max-h-[90vh]">
       <img
-        src={base64Image}
+        src={imageUrl}
         alt={caption}
         className="max-w-full max-h-[90vh] object-contain"
       />
@@ -49,7 +49,7 @@ export const ImageDisplay = ({ image }: { image: IPuzzleImage }) => {
           {image.isLoading ? (
             <GradientPlaceholder />
           ) : (
-            <img src={image.base64Image} alt={image.caption} />
+            <img src={image.imageUrl} alt={image.caption} />
           )}
         </div>
       </div>
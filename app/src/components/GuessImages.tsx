@@ -36,7 +36,7 @@ export const ImageDisplay = ({ image }: { image: IPuzzleImage }) => {
               isLoading={image.isLoading}
             />
           ) : (
-            <img src={image.base64Image} alt={image.caption} />
+            <img src={image.imageUrl} alt={image.caption} />
           )}
         </div>
       </div>
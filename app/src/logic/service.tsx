@@ -24,14 +24,14 @@ function transformApiResponse(response: ApiPuzzleState): IPuzzleState {
 
   return {
     startImage: {
-      base64Image: response.start_image.base64_image,
+      imageUrl: response.start_image.image_url,
       caption: response.start_image.prompt,
       headingText: ORIGINAL_IMAGE_HEADING,
       isLoading: false,
       displayPlaceholder: false,
     },
     goalImage: {
-      base64Image: response.goal_image.base64_image,
+      imageUrl: response.goal_image.image_url,
       caption: response.goal_image.prompt,
       headingText: GOAL_IMAGE_HEADING,
       isLoading: false,
@@ -43,7 +43,7 @@ function transformApiResponse(response: ApiPuzzleState): IPuzzleState {
       const guess = response.guess_images[index];
       if (guess) {
         return {
-          base64Image: guess.base64_image,
+          imageUrl: guess.image_url,
           caption: guess.prompt,
           headingText: "",
           isLoading: false,
@@ -51,7 +51,7 @@ function transformApiResponse(response: ApiPuzzleState): IPuzzleState {
         };
       }
       return {
-        base64Image: "",
+        imageUrl: "",
         caption: IMAGE_PLACEHOLDER_CAPTION,
         headingText: "",
         isLoading: false,
@@ -1,5 +1,5 @@
 export type IPuzzleImage = {
-  base64Image: string;
+  imageUrl: string;
   caption: string;
   headingText: string;
   isLoading: boolean;
@@ -19,7 +19,7 @@ export type IPuzzleState = {
 };
 
 export type ApiPuzzleImage = {
-  base64_image: string;
+  image_url: string;
   prompt: string;
 };
 
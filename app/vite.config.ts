@@ -26,6 +26,11 @@ export default defineConfig({
         changeOrigin: true,
         secure: false,
       },
+      "/image": {
+        target: "http://0.0.0.0:8000",
+        changeOrigin: true,
+        secure: false,
+      },
     },
   },
 });
@@ -45,6 +45,8 @@ parser.add_argument("--max-upload-size", type=float, default=100, help="Set the
 
 parser.add_argument("--extra-model-paths-config", type=str, default=None, metavar="PATH", nargs='+', action='append', help="Load one or more extra_model_paths.yaml files.")
 parser.add_argument("--output-directory", type=str, default=None, help="Set the ComfyUI output directory.")
+parser.add_argument("--output-shard-size", type=int, default=0, metavar="N", help="Save output images into subfolders of N files each per filename prefix ({prefix}.00000, {prefix}.00001...), to keep output folders small. 0 saves them all in one folder.")
+parser.add_argument("--image-encode-threads", type=int, default=None, metavar="N", help="Number of threads used to encode the images of a batch when saving them. Defaults to the number of CPUs, up to 8.")
 parser.add_argument("--temp-directory", type=str, default=None, help="Set the ComfyUI temp directory (default is in the ComfyUI directory).")
 parser.add_argument("--input-directory", type=str, default=None, help="Set the ComfyUI input directory.")
 parser.add_argument("--auto-launch", action="store_true", help="Automatically launch ComfyUI in the default browser.")
@@ -100,6 +102,16 @@ cache_group = parser.add_mutually_exclusive_group()
 cache_group.add_argument("--cache-classic", action="store_true", help="Use the old style (aggressive) caching.")
 cache_group.add_argument("--cache-lru", type=int, default=0, help="Use LRU caching with a maximum of N node results cached. May use more RAM/VRAM.")
 
+parser.add_argument("--conditioning-cache-size", type=float, default=256, metavar="MB", help="RAM budget in MB for caching CLIPTextEncode results across prompts, keyed by text encoder and tokens. 0 disables the cache. The cache, including what --conditioning-cache-dir spills to disk, never survives a restart.")
+parser.add_argument("--conditioning-cache-dir", type=str, default=None, help="Spill conditionings evicted from the RAM conditioning cache to this directory instead of dropping them. They are written to a temporary subdirectory that is removed at exit: the cache keys are only valid in the process that made them, so the spilled conditionings never survive a restart.")
+parser.add_argument("--conditioning-cache-disk-size", type=float, default=2048, metavar="MB", help="Disk budget in MB for --conditioning-cache-dir.")
+parser.add_argument("--view-cache-size", type=float, default=64, metavar="MB", help="RAM budget in MB for caching the images re-encoded by /view for preview and channel requests. 0 disables the cache.")
+parser.add_argument("--validation-cache-ttl", type=float, default=30, metavar="SECONDS", help="Reuse the validation of nodes whose class, widget values and links are the same as in a prompt validated less than this many seconds ago. 0 validates every node of every prompt.")
+parser.add_argument("--prompt-workers", type=int, default=1, metavar="N", help="Execute up to N prompts concurrently. Nodes that use models take turns on the device, CPU only nodes (image loading/saving...) run in parallel. Each worker has its own node cache, the outputs of loader nodes are shared between them so that a model is loaded once. /interrupt stops the prompt given by its prompt_id, or every running prompt.")
+parser.add_argument("--queue-db", type=str, default=None, metavar="PATH", help="Keep the prompt queue and history in this SQLite database. Prompts that were queued or running when ComfyUI stopped are executed after a restart, and the history is read from disk instead of kept in memory.")
+parser.add_argument("--scheduler", type=str, default="fifo", choices=["fifo", "fair"], help="Order of the prompt queue. fifo: by prompt number. fair: by priority class (\"priority\": \"interactive\", \"normal\" or \"batch\" in the prompt's extra_data), then earliest \"deadline\" (seconds), then weighted fair queuing between tenants (\"tenant\" in extra_data, the client id by default).")
+parser.add_argument("--scheduler-weights", type=str, nargs="+", default=None, metavar="TENANT=WEIGHT", help="Share of the prompt queue of each tenant with --scheduler fair, relative to the default weight of 1.")
+
 attn_group = parser.add_mutually_exclusive_group()
 attn_group.add_argument("--use-split-cross-attention", action="store_true", help="Use the split cross attention optimization. Ignored when xformers is used.")
 attn_group.add_argument("--use-quad-cross-attention", action="store_true", help="Use the sub-quadratic cross attention optimization . Ignored when xformers is used.")
@@ -122,11 +134,17 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 parser.add_argument("--reserve-vram", type=float, default=None, help="Set the amount of vram in GB you want to reserve for use by your OS/other software. By default some amount is reverved depending on your OS.")
+parser.add_argument("--weight-streaming-budget", type=float, default=0, help="In lowvram mode, copy the weights of the layers that don't fit in vram ahead of their use, on a separate stream through pinned memory, while the previous layers compute. The value is how many MB of weights can be in flight. 0 (the default) copies each layer when it runs.")
 
 
 parser.add_argument("--default-hashing-function", type=str, choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256', help="Allows you to choose the hash function to use for duplicate filename / contents comparison. Default is sha256.")
 
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
+parser.add_argument("--disable-mmap", action="store_true", help="Read .safetensors files into RAM and copy them into the models, instead of memory mapping them and using the mapped tensors as the model weights.")
+parser.add_argument("--model-snapshot-dir", type=str, default=None, help="Save diffusion models to this directory the first time they are loaded, as they are after detection, key remapping and dtype conversion, and load them from there afterwards. A snapshot is only used with the same file, loader options, dtype arguments and device.")
+parser.add_argument("--patched-weight-cache-size", type=float, default=0, help="MB of RAM for the weights with their LoRAs and other patches applied, so that loading a model again with the same patches copies them instead of patching them again. A model whose patched weights don't all fit isn't cached. 0 (the default) disables the cache.")
+parser.add_argument("--patched-weight-cache-dir", type=str, default=None, help="Save the patched weights evicted from the RAM cache to this directory and load them from there. The files are deleted when ComfyUI exits.")
+parser.add_argument("--patched-weight-cache-disk-size", type=float, default=8192, help="MB of patched weights that can be saved to --patched-weight-cache-dir.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 parser.add_argument("--fast", action="store_true", help="Enable some untested and potentially quality deteriorating optimizations.")
 
@@ -0,0 +1,200 @@
+import atexit
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import torch
+
+from comfy.cli_args import args
+
+
+def _tensors_nbytes(value):
+    if torch.is_tensor(value):
+        return value.nelement() * value.element_size()
+    if isinstance(value, dict):
+        return sum(_tensors_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_tensors_nbytes(v) for v in value)
+    return 0
+
+
+def _update_hash(h, value):
+    # Stable hash of tokenizer output: nested dicts/lists of (token, weight[, word id]) where a token can also be an
+    # embedding tensor (textual inversion)
+    if torch.is_tensor(value):
+        h.update(b"t")
+        h.update(str((value.dtype, tuple(value.shape))).encode())
+        h.update(value.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, dict):
+        h.update(b"d")
+        for k in sorted(value.keys(), key=str):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(b"l%d" % len(value))
+        for v in value:
+            _update_hash(h, v)
+    else:
+        h.update(repr(value).encode())
+        h.update(b";")
+
+
+def tokens_hash(tokens):
+    h = hashlib.sha256()
+    _update_hash(h, tokens)
+    return h.hexdigest()
+
+
+def _copy_conditioning(conditioning):
+    # Consumers may add keys to the dicts, the tensors themselves are never modified in place
+    return [[c[0], c[1].copy()] for c in conditioning]
+
+
+class ConditioningCache:
+    """LRU cache of text encoder outputs, so a prompt that was already encoded skips the text encoders.
+
+    Keyed by the text encoder weights and patches (the patcher's patches_uuid), the encoder options and a hash of the
+    tokens. Entries are evicted from RAM once they use more than max_bytes and, if disk_dir is set, are spilled to
+    disk until that uses more than max_disk_bytes. patches_uuid is random, so the spilled files are only meaningful to
+    this process: they go to a temporary directory inside disk_dir, which is removed with them at exit.
+    """
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.ram = OrderedDict()
+        self.ram_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_temp_dir = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, clip, tokens):
+        return (str(clip.patcher.patches_uuid), clip.layer_idx, tokens_hash(tokens))
+
+    def get(self, key):
+        with self.lock:
+            value = self.ram.get(key, None)
+            if value is not None:
+                self.ram.move_to_end(key)
+                self.hits += 1
+                return _copy_conditioning(value)
+            path = self.disk.pop(key, None)
+            if path is None:
+                self.misses += 1
+                return None
+            self.disk_bytes -= os.path.getsize(path)
+        try:
+            value = torch.load(path, weights_only=True)
+            os.remove(path)
+        except Exception as e:
+            logging.warning("Failed to load conditioning from the disk cache: {}".format(e))
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        self.put(key, value)
+        return _copy_conditioning(value)
+
+    def put(self, key, conditioning):
+        size = _tensors_nbytes(conditioning)
+        if size > self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            if key in self.ram:
+                return
+            self.ram[key] = _copy_conditioning(conditioning)
+            self.ram_bytes += size
+            while self.ram_bytes > self.max_bytes:
+                old_key, old_value = self.ram.popitem(last=False)
+                self.ram_bytes -= _tensors_nbytes(old_value)
+                evicted.append((old_key, old_value))
+        for old_key, old_value in evicted:
+            self._spill(old_key, old_value)
+
+    def _spill(self, key, conditioning):
+        if self.disk_dir is None or self.max_disk_bytes <= 0:
+            return
+        path = os.path.join(self._disk_directory(), hashlib.sha256(repr(key).encode()).hexdigest() + ".pt")
+        cpu_conditioning = [[c[0].cpu(), {k: v.cpu() if torch.is_tensor(v) else v for k, v in c[1].items()}] for c in conditioning]
+        try:
+            torch.save(cpu_conditioning, path)
+        except Exception as e:
+            logging.warning("Failed to spill conditioning to the disk cache: {}".format(e))
+            return
+        with self.lock:
+            self.disk[key] = path
+            self.disk_bytes += os.path.getsize(path)
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk) > 0:
+                _, old_path = self.disk.popitem(last=False)
+                self.disk_bytes -= os.path.getsize(old_path)
+                os.remove(old_path)
+
+    def _disk_directory(self):
+        with self.lock:
+            if self.disk_temp_dir is None:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                self.disk_temp_dir = tempfile.mkdtemp(prefix="conditioning_", dir=self.disk_dir)
+                atexit.register(self._remove_disk_files)
+            return self.disk_temp_dir
+
+    def _remove_disk_files(self):
+        # Only the files this cache wrote, disk_dir may be shared with anything else
+        with self.lock:
+            for path in self.disk.values():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.disk.clear()
+            self.disk_bytes = 0
+            try:
+                os.rmdir(self.disk_temp_dir)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                "entries": len(self.ram),
+                "ram_bytes": self.ram_bytes,
+                "max_ram_bytes": self.max_bytes,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk_bytes,
+            }
+
+
+cache = ConditioningCache(int(args.conditioning_cache_size * 1024 * 1024),
+                          disk_dir=args.conditioning_cache_dir,
+                          max_disk_bytes=int(args.conditioning_cache_disk_size * 1024 * 1024))
+
+
+def encode_from_tokens_scheduled(clip, tokens):
+    """Same as clip.encode_from_tokens_scheduled(tokens), served from the conditioning cache when possible."""
+    # Hooks make the result depend on more than the weights and tokens
+    if not cache.enabled or clip.patcher.forced_hooks is not None or clip.apply_hooks_to_conds is not None:
+        return clip.encode_from_tokens_scheduled(tokens)
+    key = cache.key(clip, tokens)
+    conditioning = cache.get(key)
+    if conditioning is None:
+        conditioning = clip.encode_from_tokens_scheduled(tokens)
+        cache.put(key, conditioning)
+    return conditioning
@@ -0,0 +1,230 @@
+import logging
+
+import torch
+
+import comfy.model_management
+
+# How many bytes of weights in the intermediate dtype are patched together at most. Larger batches are slower on CPU,
+# where their temporaries are new allocations that have to be paged in
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+# Where the DoRA scale is in the values of each patch type
+DORA_SCALE_INDEX = {"lora": 4, "loha": 7, "lokr": 8}
+
+
+def patch_signature(patch, weight):
+    """What the patch looks like to the batched code, None if only comfy.lora.calculate_weight can apply it.
+
+    Patches with the same signature can be applied to weights of the same shape with batched matmuls. Plain
+    lora/locon, loha and lokr patches without CP decomposition, offsets, functions or a model strength are batched.
+    """
+    strength, v, strength_model, offset, function = patch
+    if offset is not None or function is not None or strength_model != 1.0 or isinstance(v, list) or len(v) != 2:
+        return None
+    patch_type, v = v
+    if patch_type == "lora":
+        if v[3] is not None or v[5] is not None:
+            return None
+        tensors = (v[0], v[1], v[4])
+        if v[0].shape[0] != weight.shape[0] or v[0].shape[1] != v[1].shape[0] or v[0].shape[0] * (v[1].numel() // v[1].shape[0]) != weight.numel():
+            return None
+    elif patch_type == "loha":
+        if v[5] is not None:
+            return None
+        tensors = (v[0], v[1], v[3], v[4], v[7])
+        if v[0].dim() != 2 or v[0].shape[0] != weight.shape[0] or v[0].shape[0] * v[1].shape[1] != weight.numel():
+            return None
+    elif patch_type == "lokr":
+        if v[7] is not None:
+            return None
+        tensors = (v[0], v[1], v[3], v[4], v[5], v[6], v[8])
+        w1_shape = tuple(v[0].shape) if v[0] is not None else (v[3].shape[0], v[4].shape[1])
+        w2_shape = tuple(v[1].shape) if v[1] is not None else (v[5].shape[0], v[6].shape[1])
+        kron_shape = (w1_shape[0] * w2_shape[0], w1_shape[1] * w2_shape[1]) + w2_shape[2:]
+        if len(w1_shape) != 2 or kron_shape != tuple(weight.shape):
+            return None
+    else:
+        return None
+    return (patch_type, tuple(None if t is None else tuple(t.shape) for t in tensors), v[2] is None)
+
+
+def batch_signature(weight, patches):
+    signatures = []
+    for p in patches:
+        signature = patch_signature(p, weight)
+        if signature is None:
+            return None
+        signatures.append(signature)
+    return (tuple(weight.shape), weight.dtype, weight.device, tuple(signatures))
+
+
+def stack(tensors, device, dtype):
+    out = torch.empty((len(tensors),) + tuple(tensors[0].shape), dtype=dtype, device=device)
+    non_blocking = comfy.model_management.device_supports_non_blocking(device)
+    for i, t in enumerate(tensors):
+        out[i].copy_(t, non_blocking=non_blocking)
+    return out
+
+
+def per_key(values, like):
+    """Values of the keys of a batch as a tensor that broadcasts over the weights of the batch."""
+    return torch.tensor(values, dtype=like.dtype, device=like.device).reshape(-1, *[1] * (like.dim() - 1))
+
+
+def weight_decompose(dora_scale, weight, lora_diff, alpha, strength, scratch):
+    """comfy.lora.weight_decompose for a batch of weights, alpha and strength hold the value of each key.
+
+    The norms of the input channels are reduced from the squares instead of with norm() over the transposed weights,
+    which reads them out of order.
+    """
+    weight_calc = lora_diff.mul_(alpha).add_(weight)
+    channel_dims = [1] + list(range(3, weight_calc.dim()))
+    squares = torch.mul(weight_calc, weight_calc, out=scratch)
+    weight_norm = squares.sum(dim=channel_dims, keepdim=True).sqrt_()
+    weight_calc *= dora_scale / weight_norm
+    weight.lerp_(weight_calc, strength)
+
+
+def lora_factors(patches, device, dtype):
+    """up (batch, out, rank) and down (batch, rank, in) of lora patches with the same signature."""
+    up = stack([v[0] for v in patches], device, dtype).flatten(start_dim=2)
+    down = stack([v[1] for v in patches], device, dtype).flatten(start_dim=2)
+    return up, down
+
+
+def alphas(patches, rank_index):
+    return [1.0 if v[2] is None else v[2] / v[rank_index].shape[0] for v in patches]
+
+
+def lokr_factors(patches, device, dtype):
+    """The matrices of the kronecker products of lokr patches with the same signature, and the alpha of each patch."""
+    first = patches[0]
+    dim = None
+    if first[0] is None:
+        dim = first[4].shape[0]
+        w1 = torch.bmm(stack([v[3] for v in patches], device, dtype), stack([v[4] for v in patches], device, dtype))
+    else:
+        w1 = stack([v[0] for v in patches], device, dtype)
+    if first[1] is None:
+        dim = first[6].shape[0]
+        w2 = torch.bmm(stack([v[5] for v in patches], device, dtype), stack([v[6] for v in patches], device, dtype))
+    else:
+        w2 = stack([v[1] for v in patches], device, dtype)
+    alpha = [1.0 if v[2] is None or dim is None else v[2] / dim for v in patches]
+    return w1, w2, alpha
+
+
+def kron_operands(w1, w2):
+    """w1 and w2 as views whose product has the layout of their batched kronecker products."""
+    spatial = w2.shape[3:]
+    w1 = w1.reshape(w1.shape[0], w1.shape[1], 1, w1.shape[2], 1, *[1] * len(spatial))
+    w2 = w2.reshape(w2.shape[0], 1, w2.shape[1], 1, w2.shape[2], *spatial)
+    return w1, w2
+
+
+class Scratch:
+    """Temporary weights, reused by the batches of keys with the same shape: allocating new ones of that size each
+    time is slow on CPU."""
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, index, weight):
+        """A tensor of the shape, dtype and device of weight with undefined contents."""
+        buffer = self.buffers.get(index, None)
+        if buffer is None or buffer.shape[0] < weight.shape[0]:
+            buffer = torch.empty((weight.shape[0], weight[0].numel()), dtype=weight.dtype, device=weight.device)
+            self.buffers[index] = buffer
+        return buffer[:weight.shape[0]].view(weight.shape)
+
+
+def apply_patches(weight, patches, intermediate_dtype, scratch):
+    """Applies the patches of a batch of keys to weight, the stacked weights of the keys, in place.
+
+    patches[i] are the patches of key i, all with the same signatures. Consecutive plain lora patches are applied with
+    a single batched matmul, with their ranks concatenated. The other patches are added with addcmul_ when they can.
+    """
+    device = weight.device
+    flat_weight = weight.view(weight.shape[0], weight.shape[1], -1)
+    ups = []
+    downs = []
+
+    def apply_loras():
+        if len(ups) > 0:
+            flat_weight.baddbmm_(torch.cat(ups, dim=2), torch.cat(downs, dim=1))
+            ups.clear()
+            downs.clear()
+
+    for j in range(len(patches[0])):
+        strength = [p[j][0] for p in patches]
+        patch_type = patches[0][j][1][0]
+        values = [p[j][1][1] for p in patches]
+        dora = values[0][DORA_SCALE_INDEX[patch_type]] is not None
+        lora_diff = scratch.get(0, weight)
+        flat_diff = lora_diff.view(flat_weight.shape)
+
+        if patch_type == "lora":
+            up, down = lora_factors(values, device, intermediate_dtype)
+            alpha = alphas(values, 1)
+            if not dora:
+                ups.append(up * per_key([s * a for s, a in zip(strength, alpha)], up))
+                downs.append(down)
+                continue
+            torch.bmm(up, down, out=flat_diff)
+        elif patch_type == "loha":
+            alpha = alphas(values, 1)
+            m1 = torch.bmm(stack([v[0] for v in values], device, intermediate_dtype),
+                           stack([v[1] for v in values], device, intermediate_dtype), out=flat_diff)
+            m2 = torch.bmm(stack([v[3] for v in values], device, intermediate_dtype),
+                           stack([v[4] for v in values], device, intermediate_dtype), out=scratch.get(1, flat_weight))
+            if not dora:
+                m1 *= per_key([s * a for s, a in zip(strength, alpha)], m1)
+                apply_loras()
+                flat_weight.addcmul_(m1, m2)
+                continue
+            m1 *= m2
+        else:
+            w1, w2, alpha = lokr_factors(values, device, intermediate_dtype)
+            if not dora:
+                w1 *= per_key([s * a for s, a in zip(strength, alpha)], w1)
+            w1, w2 = kron_operands(w1, w2)
+            kron_shape = torch.broadcast_shapes(w1.shape, w2.shape)
+            if not dora:
+                apply_loras()
+                weight.view(kron_shape).addcmul_(w1, w2)
+                continue
+            torch.mul(w1, w2, out=lora_diff.view(kron_shape))
+
+        apply_loras()
+        dora_scale = stack([v[DORA_SCALE_INDEX[patch_type]] for v in values], device, intermediate_dtype)
+        weight_decompose(dora_scale, weight, lora_diff, per_key(alpha, weight), per_key(strength, weight), scratch.get(1, weight))
+    apply_loras()
+
+
+def calculate_weights(items, device=None, intermediate_dtype=torch.float32, max_batch_bytes=MAX_BATCH_BYTES):
+    """comfy.lora.calculate_weight for many keys, with the keys whose weights have the same shape and whose patches
+    have the same types and shapes patched together with batched matmuls.
+
+    items are (key, weight, patches). The weights aren't modified: yields (key, patched weight in intermediate_dtype
+    on device) for the keys that could be batched, one batch at a time. The other keys are skipped.
+    """
+    groups = {}
+    for key, weight, patches in items:
+        signature = batch_signature(weight, patches)
+        if signature is not None:
+            groups.setdefault(signature, []).append((key, weight, patches))
+
+    for signature, group in groups.items():
+        weight_bytes = group[0][1].numel() * torch.empty(0, dtype=intermediate_dtype).element_size()
+        batch_size = max(1, max_batch_bytes // weight_bytes)
+        scratch = Scratch()
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            weight_device = batch[0][1].device if device is None else device
+            weight = stack([x[1] for x in batch], weight_device, intermediate_dtype)
+            try:
+                apply_patches(weight, [x[2] for x in batch], intermediate_dtype, scratch)
+            except Exception as e:
+                # The keys are patched one by one instead
+                logging.warning("ERROR batched patches {} {}".format(batch[0][0], e))
+                continue
+            for j, x in enumerate(batch):
+                yield x[0], weight[j]
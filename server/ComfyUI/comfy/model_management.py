@@ -1095,23 +1095,50 @@ class InterruptProcessingException(Exception):
 
 interrupt_processing_mutex = threading.RLock()
 
-interrupt_processing = False
-def interrupt_current_processing(value=True):
-    global interrupt_processing
-    global interrupt_processing_mutex
+# Held by a prompt worker while it runs a node that uses models or the device, so concurrent prompt workers
+# (--prompt-workers) don't load, patch or run models at the same time. See execution.get_stage_lock
+device_lock = threading.RLock()
+
+# With several prompt workers, interrupting only stops the prompts it is meant for: the ids of the interrupted
+# prompts, the prompt each worker thread runs and the prompts that are running
+interrupted_prompts = set()
+running_prompts = set()
+processing_state = threading.local()
+
+def begin_processing(prompt_id):
+    """Called by the thread that starts running prompt_id, before it checks for interrupts."""
     with interrupt_processing_mutex:
-        interrupt_processing = value
+        processing_state.prompt_id = prompt_id
+        running_prompts.add(prompt_id)
+        interrupted_prompts.discard(prompt_id)
+
+def end_processing():
+    with interrupt_processing_mutex:
+        prompt_id = getattr(processing_state, "prompt_id", None)
+        running_prompts.discard(prompt_id)
+        interrupted_prompts.discard(prompt_id)
+        processing_state.prompt_id = None
+
+def interrupt_current_processing(value=True, prompt_id=None):
+    """Interrupts prompt_id if it is running, or every running prompt if prompt_id is None. With value False, clears
+    the interrupt of prompt_id or of every prompt."""
+    with interrupt_processing_mutex:
+        prompt_ids = running_prompts if prompt_id is None else {prompt_id} & running_prompts
+        if value:
+            interrupted_prompts.update(prompt_ids)
+        elif prompt_id is None:
+            interrupted_prompts.clear()
+        else:
+            interrupted_prompts.discard(prompt_id)
 
 def processing_interrupted():
-    global interrupt_processing
-    global interrupt_processing_mutex
+    """Whether the prompt of the calling thread was interrupted."""
     with interrupt_processing_mutex:
-        return interrupt_processing
+        return getattr(processing_state, "prompt_id", None) in interrupted_prompts
 
 def throw_exception_if_processing_interrupted():
-    global interrupt_processing
-    global interrupt_processing_mutex
     with interrupt_processing_mutex:
-        if interrupt_processing:
-            interrupt_processing = False
+        prompt_id = getattr(processing_state, "prompt_id", None)
+        if prompt_id in interrupted_prompts:
+            interrupted_prompts.discard(prompt_id)
             raise InterruptProcessingException()
@@ -30,8 +30,11 @@ import comfy.utils
 import comfy.float
 import comfy.model_management
 import comfy.lora
+import comfy.lora_batch
 import comfy.hooks
 import comfy.patcher_extension
+import comfy.patched_weight_cache
+import comfy.weight_streaming
 from comfy.patcher_extension import CallbacksMP, WrappersMP, PatcherInjection
 from comfy.comfy_types import UnetWrapperFunction
 
@@ -98,6 +101,8 @@ def wipe_lowvram_weight(m):
         del m.prev_comfy_cast_weights
     m.weight_function = None
     m.bias_function = None
+    if hasattr(m, "weight_streamer"):
+        del m.weight_streamer
 
 class LowVramPatch:
     def __init__(self, key, patches):
@@ -198,6 +203,8 @@ class ModelPatcher:
         self.offload_device = offload_device
         self.weight_inplace_update = weight_inplace_update
         self.patches_uuid = uuid.uuid4()
+        # (patches_uuid, cache size, whether the patched weights fit in the patched weight cache of that size)
+        self.patched_weight_cache_fits = None
         self.parent = None
 
         self.attachments: dict[str] = {}
@@ -493,7 +500,24 @@ class ModelPatcher:
                         sd.pop(k)
             return sd
 
-    def patch_weight_to_device(self, key, device_to=None, inplace_update=False):
+    def use_patched_weight_cache(self):
+        """Whether the patched weights of this model should go to the patched weight cache: only when they all fit. The
+        weights are loaded in the same order every time, so an LRU too small for all of them is cycled through without
+        ever being hit, and caching them would only cost a copy of each."""
+        cache = comfy.patched_weight_cache.patched_weight_cache
+        if cache.max_bytes <= 0:
+            return False
+        if self.patched_weight_cache_fits is None or self.patched_weight_cache_fits[:2] != (self.patches_uuid, cache.max_bytes):
+            nbytes = 0
+            for key in self.patches:
+                weight, set_func, _ = get_key_weight(self.model, key)
+                if set_func is None:
+                    nbytes += comfy.patched_weight_cache.tensor_nbytes(weight)
+            self.patched_weight_cache_fits = (self.patches_uuid, cache.max_bytes, nbytes <= cache.max_bytes)
+        return self.patched_weight_cache_fits[2]
+
+    def patch_weight_to_device(self, key, device_to=None, inplace_update=False, patched_weight=None):
+        """patched_weight: the result of comfy.lora.calculate_weight for the key if it was already computed."""
         if key not in self.patches:
             return
 
@@ -503,16 +527,38 @@ class ModelPatcher:
         if key not in self.backup:
             self.backup[key] = collections.namedtuple('Dimension', ['weight', 'inplace_update'])(weight.to(device=self.offload_device, copy=inplace_update), inplace_update)
 
-        if device_to is not None:
-            temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+        cache = comfy.patched_weight_cache.patched_weight_cache
+        cache_key = None
+        if set_func is None and self.use_patched_weight_cache():
+            cache_key = comfy.patched_weight_cache.cache_key(key, weight, self.patches_uuid, self.patches[key])
+        out_weight = cache.get(cache_key)
+        if out_weight is not None:
+            # Copied, the cached weight is shared with the next loads
+            out_weight = comfy.model_management.cast_to_device(out_weight, weight.device if device_to is None else device_to, None, copy=True)
+            if inplace_update:
+                comfy.utils.copy_to_param(self.model, key, out_weight)
+            else:
+                comfy.utils.set_attr_param(self.model, key, out_weight)
+            return
+
+        if patched_weight is not None:
+            out_weight = patched_weight
         else:
-            temp_weight = weight.to(torch.float32, copy=True)
-        if convert_func is not None:
-            temp_weight = convert_func(temp_weight, inplace=True)
+            if device_to is not None:
+                temp_weight = comfy.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weight = weight.to(torch.float32, copy=True)
+            if convert_func is not None:
+                temp_weight = convert_func(temp_weight, inplace=True)
 
-        out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
+            out_weight = comfy.lora.calculate_weight(self.patches[key], temp_weight, key)
         if set_func is None:
             out_weight = comfy.float.stochastic_rounding(out_weight, weight.dtype, seed=string_to_seed(key))
+            if out_weight is patched_weight:
+                # A view of the weights batched with it
+                out_weight = out_weight.clone()
+            if cache_key is not None:
+                cache.set(cache_key, out_weight.to("cpu", copy=True))
             if inplace_update:
                 comfy.utils.copy_to_param(self.model, key, out_weight)
             else:
@@ -520,6 +566,30 @@ class ModelPatcher:
         else:
             set_func(out_weight, inplace_update=inplace_update, seed=string_to_seed(key))
 
+    def patch_weights_to_device(self, keys, device_to=None):
+        """patch_weight_to_device for several keys. The patches of the keys with the same shapes and patch types are
+        applied together by comfy.lora_batch, the others one key at a time."""
+        cache = comfy.patched_weight_cache.patched_weight_cache
+        use_cache = self.use_patched_weight_cache()
+        items = []
+        for key in keys:
+            if key not in self.patches:
+                continue
+            weight, set_func, convert_func = get_key_weight(self.model, key)
+            if set_func is not None:
+                continue
+            if use_cache and cache.contains(comfy.patched_weight_cache.cache_key(key, weight, self.patches_uuid, self.patches[key])):
+                continue
+            items.append((key, weight, self.patches[key]))
+
+        patched = set()
+        for key, out_weight in comfy.lora_batch.calculate_weights(items, device=device_to):
+            self.patch_weight_to_device(key, device_to=device_to, patched_weight=out_weight)
+            patched.add(key)
+        for key in keys:
+            if key not in patched:
+                self.patch_weight_to_device(key, device_to=device_to)
+
     def _load_list(self):
         loading = []
         for n, m in self.model.named_modules():
@@ -538,10 +608,14 @@ class ModelPatcher:
     def load(self, device_to=None, lowvram_model_memory=0, force_patch_weights=False, full_load=False):
         with self.use_ejected():
             self.unpatch_hooks()
+            self.reset_weight_streaming()
             mem_counter = 0
             patch_counter = 0
             lowvram_counter = 0
             loading = self._load_list()
+            if not full_load:
+                # The lowvram modules' weights copied ahead of use take up to the streaming budget next to the others
+                lowvram_model_memory = max(0, lowvram_model_memory - comfy.weight_streaming.reserved_memory(device_to))
 
             load_completely = []
             loading.sort(reverse=True)
@@ -579,6 +653,7 @@ class ModelPatcher:
 
                     m.prev_comfy_cast_weights = m.comfy_cast_weights
                     m.comfy_cast_weights = True
+                    m.weight_streamer = self.get_weight_streamer(device_to)
                 else:
                     if hasattr(m, "comfy_cast_weights"):
                         if m.comfy_cast_weights:
@@ -589,6 +664,8 @@ class ModelPatcher:
                         load_completely.append((module_mem, n, m, params))
 
             load_completely.sort(reverse=True)
+            patch_modules = []
+            patch_keys = []
             for x in load_completely:
                 n = x[1]
                 m = x[2]
@@ -598,8 +675,11 @@ class ModelPatcher:
                         continue
 
                 for param in params:
-                    self.patch_weight_to_device("{}.{}".format(n, param), device_to=device_to)
+                    patch_keys.append("{}.{}".format(n, param))
+                patch_modules.append((n, m))
 
+            self.patch_weights_to_device(patch_keys, device_to=device_to)
+            for n, m in patch_modules:
                 logging.debug("lowvram: loaded module regularly {} {}".format(n, m))
                 m.comfy_patched_weights = True
 
@@ -626,6 +706,26 @@ class ModelPatcher:
 
             self.apply_hooks(self.forced_hooks, force_apply=True)
 
+    def get_weight_streamer(self, device):
+        """The comfy.weight_streaming.WeightStreamer of the lowvram modules of the model, shared by its clones."""
+        if device is None:
+            return None
+        streamer = getattr(self.model, "weight_streamer", None)
+        if streamer is None or streamer.device != device:
+            streamer = comfy.weight_streaming.create_streamer(device)
+            self.model.weight_streamer = streamer
+        return streamer
+
+    def reset_weight_streaming(self):
+        streamer = getattr(self.model, "weight_streamer", None)
+        if streamer is not None:
+            streamer.reset()
+
+    def release_weight_streaming(self):
+        streamer = getattr(self.model, "weight_streamer", None)
+        if streamer is not None:
+            streamer.release()
+
     def patch_model(self, device_to=None, lowvram_model_memory=0, load_weights=True, force_patch_weights=False):
         with self.use_ejected():
             for k in self.object_patches:
@@ -647,6 +747,7 @@ class ModelPatcher:
         self.eject_model()
         if unpatch_weights:
             self.unpatch_hooks()
+            self.reset_weight_streaming()
             if self.model.model_lowvram:
                 for m in self.model.modules():
                     wipe_lowvram_weight(m)
@@ -683,6 +784,7 @@ class ModelPatcher:
 
     def partially_unload(self, device_to, memory_to_free=0):
         with self.use_ejected():
+            self.reset_weight_streaming()
             memory_freed = 0
             patch_counter = 0
             unload_list = self._load_list()
@@ -726,6 +828,7 @@ class ModelPatcher:
 
                             m.prev_comfy_cast_weights = m.comfy_cast_weights
                             m.comfy_cast_weights = True
+                            m.weight_streamer = self.get_weight_streamer(self.model.device)
                         m.comfy_patched_weights = False
                         memory_freed += module_mem
                         logging.debug("freed {}".format(n))
@@ -778,6 +881,8 @@ class ModelPatcher:
 
     def cleanup(self):
         self.clean_hooks()
+        # The copies prefetched for the next step of the sampler that just finished
+        self.release_weight_streaming()
         if hasattr(self.model, "current_patcher"):
             self.model.current_patcher = None
         for callback in self.get_all_callbacks(CallbacksMP.ON_CLEANUP):
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+
+import torch
+
+import comfy.latent_formats
+import comfy.model_base
+import comfy.model_management
+import comfy.supported_models
+import comfy.supported_models_base
+import comfy.utils
+from comfy.cli_args import args
+
+# Bump when the layout of the snapshots or the way models are loaded changes, to ignore the old snapshots
+SNAPSHOT_FORMAT = 2
+METADATA_KEY = "model_snapshot"
+# Arguments that change the dtypes and operations a diffusion model is loaded with
+DTYPE_ARGS = ["cpu", "directml", "force_fp32", "force_fp16", "fp32_unet", "fp64_unet", "bf16_unet", "fp16_unet",
+              "fp8_e4m3fn_unet", "fp8_e5m2_unet", "fast", "gpu_only", "highvram", "normalvram", "lowvram", "novram"]
+
+
+def _encode(value):
+    # unet_config is json, except for dtypes and tuples
+    if isinstance(value, torch.dtype):
+        return {"__dtype__": str(value).split(".")[-1]}
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if "__dtype__" in value:
+            return getattr(torch, value["__dtype__"])
+        if "__tuple__" in value:
+            return tuple(_decode(v) for v in value["__tuple__"])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+
+def file_fingerprint(path):
+    """Size, modification time and, for .safetensors files, a hash of the header (names, dtypes, shapes and offsets)
+    instead of a hash of the whole file, which would take as long as loading it."""
+    stat = os.stat(path)
+    header = None
+    if path.lower().endswith(".safetensors") or path.lower().endswith(".sft"):
+        header = comfy.utils.safetensors_header(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "header_sha256": hashlib.sha256(header).hexdigest() if header is not None else None}
+
+
+def snapshot_path(ckpt_path, model_options={}):
+    """Where the snapshot of the diffusion model in ckpt_path loaded with model_options and the current arguments and
+    device is, None if snapshots are disabled or the model can't have one."""
+    if args.model_snapshot_dir is None or model_options.get("custom_operations", None) is not None:
+        return None
+    device = comfy.model_management.get_torch_device()
+    key = {
+        "format": SNAPSHOT_FORMAT,
+        "file": file_fingerprint(ckpt_path),
+        "model_options": {k: str(v) for k, v in sorted(model_options.items())},
+        "args": {k: getattr(args, k) for k in DTYPE_ARGS},
+        "device": comfy.model_management.get_torch_device_name(device),
+        "torch": torch.__version__,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(ckpt_path))[0]
+    return os.path.join(args.model_snapshot_dir, "{}-{}.safetensors".format(name, digest))
+
+
+def save(path, model, unet_prefix, parameters):
+    """Saves the loaded diffusion model with its config and final dtypes. Written to a temporary file first, so
+    a snapshot is either complete or missing.
+
+    The whole state dict of the BaseModel is saved, not only the diffusion model: some models have weights outside of
+    it that their config reads when the model is created (cc_projection of Stable_Zero123).
+    """
+    model_config = model.model_config
+    metadata = {
+        "format": SNAPSHOT_FORMAT,
+        "model_config": type(model_config).__name__,
+        "unet_config": _encode(model_config.unet_config),
+        "manual_cast_dtype": _encode(model_config.manual_cast_dtype),
+        "scaled_fp8": _encode(model_config.scaled_fp8),
+        "optimizations": model_config.optimizations,
+        "sampling_settings": model_config.sampling_settings,
+        "latent_format": type(model_config.latent_format).__name__,
+        "model_type": model.model_type.name,
+        "unet_prefix": unet_prefix,
+        "parameters": parameters,
+    }
+    sd = {k: v.detach().to("cpu").contiguous() for k, v in model.state_dict().items()}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    try:
+        comfy.utils.save_torch_file(sd, temp_path, metadata={METADATA_KEY: json.dumps(metadata)})
+        os.replace(temp_path, path)
+    except Exception as e:
+        logging.warning("Could not save the model snapshot {}: {}".format(path, e))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    logging.info("Saved model snapshot {}".format(path))
+
+
+def read_metadata(path):
+    header = comfy.utils.safetensors_header(path)
+    if header is None:
+        return None
+    metadata = json.loads(header).get("__metadata__", {})
+    if METADATA_KEY not in metadata:
+        return None
+    metadata = json.loads(metadata[METADATA_KEY])
+    if metadata.get("format", None) != SNAPSHOT_FORMAT:
+        return None
+    return metadata
+
+
+def load(path):
+    """Loads a snapshot saved by save(), without detecting the model or converting its weights.
+
+    Returns (model, unet_prefix, parameters), or None if there is no usable snapshot at path, in which case the model
+    should be loaded the normal way.
+    """
+    if path is None or not os.path.isfile(path):
+        return None
+    try:
+        metadata = read_metadata(path)
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring the model snapshot {}: {}".format(path, e))
+        return None
+    if metadata is None:
+        return None
+
+    config_class = getattr(comfy.supported_models, metadata["model_config"],
+                           getattr(comfy.supported_models_base, metadata["model_config"], None))
+    latent_format = getattr(comfy.latent_formats, metadata["latent_format"], None)
+    if config_class is None or latent_format is None:
+        logging.warning("Ignoring the model snapshot {}: unknown model {}".format(path, metadata["model_config"]))
+        return None
+
+    model_config = config_class({})
+    # The config as it was after detection, instead of the class defaults
+    model_config.unet_config = _decode(metadata["unet_config"])
+    model_config.manual_cast_dtype = _decode(metadata["manual_cast_dtype"])
+    model_config.scaled_fp8 = _decode(metadata["scaled_fp8"])
+    model_config.optimizations = metadata["optimizations"]
+    model_config.sampling_settings = metadata["sampling_settings"]
+    model_config.latent_format = latent_format()
+    # Some models tell their type from the values of the original weights
+    model_type = comfy.model_base.ModelType[metadata["model_type"]]
+    model_config.model_type = lambda state_dict, prefix="": model_type
+
+    try:
+        model = rebuild(path, model_config, metadata["parameters"])
+    except Exception as e:
+        logging.warning("Ignoring the model snapshot {}, it could not be loaded: {}".format(path, e))
+        return None
+    if model is None:
+        return None
+    logging.info("Loaded model snapshot {}".format(path))
+    return model, metadata["unet_prefix"], metadata["parameters"]
+
+
+def rebuild(path, model_config, parameters):
+    """The model of the snapshot at path, None if its weights don't match the model."""
+    sd = comfy.utils.load_torch_file(path)
+    device = comfy.model_management.unet_inital_load_device(parameters, model_config.unet_config["dtype"])
+    model = model_config.get_model(sd, "", device=device)
+    m, u = comfy.utils.load_module_weights(model, sd, strict=False)
+    if len(m) > 0 or len(u) > 0:
+        logging.warning("Ignoring the model snapshot {}: missing {} unexpected {}".format(path, m, u))
+        return None
+    return model
@@ -37,14 +37,24 @@ def cast_bias_weight(s, input=None, dtype=None, device=None, bias_dtype=None):
 
     bias = None
     non_blocking = comfy.model_management.device_supports_non_blocking(device)
-    if s.bias is not None:
+    weight, source_bias = s.weight, s.bias
+    streamed = False
+    weight_streamer = getattr(s, "weight_streamer", None)
+    if weight_streamer is not None and weight_streamer.device == device:
+        # Copies made ahead of time by comfy.weight_streaming, that the functions can modify in place
+        weight, source_bias = weight_streamer.get(s)
+        streamed = True
+
+    if source_bias is not None:
         has_function = s.bias_function is not None
-        bias = comfy.model_management.cast_to(s.bias, bias_dtype, device, non_blocking=non_blocking, copy=has_function)
+        copy = has_function and not streamed
+        bias = comfy.model_management.cast_to(source_bias, bias_dtype, device, non_blocking=non_blocking, copy=copy)
         if has_function:
             bias = s.bias_function(bias)
 
     has_function = s.weight_function is not None
-    weight = comfy.model_management.cast_to(s.weight, dtype, device, non_blocking=non_blocking, copy=has_function)
+    copy = has_function and not streamed
+    weight = comfy.model_management.cast_to(weight, dtype, device, non_blocking=non_blocking, copy=copy)
     if has_function:
         weight = s.weight_function(weight)
     return weight, bias
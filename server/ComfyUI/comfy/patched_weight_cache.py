@@ -0,0 +1,153 @@
+import atexit
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import comfy.utils
+from comfy.cli_args import args
+
+
+def tensor_nbytes(tensor):
+    return tensor.nelement() * tensor.element_size()
+
+
+def cache_key(key, weight, patches_uuid, patches):
+    """What a patched weight depends on: the original weight (its key, storage, shape and dtype), the patches of the
+    ModelPatcher (patches_uuid changes whenever they do) and their strengths. None if it can't be cached."""
+    if patches_uuid is None:
+        return None
+    strengths = tuple((p[0], p[2]) for p in patches)
+    cache_key = (key, weight.data_ptr(), tuple(weight.shape), weight.dtype, patches_uuid, strengths)
+    try:
+        hash(cache_key)
+    except TypeError:
+        return None
+    return cache_key
+
+
+class PatchedWeightCache:
+    """Weights with their patches (LoRAs...) applied, so that loading a model again with the same patches after it was
+    unloaded copies them instead of computing the patches again.
+
+    An LRU of at most max_bytes of host memory. When spill_dir is set, entries evicted from memory are saved there as
+    .safetensors files, up to max_spill_bytes, and loaded back on a hit. The patches_uuid in the keys is random, so the
+    files only last as long as the process: they are written to a temporary directory inside spill_dir that is deleted
+    at exit.
+    """
+    def __init__(self, max_bytes, spill_dir=None, max_spill_bytes=0):
+        self.max_bytes = max_bytes
+        self.max_spill_bytes = max_spill_bytes
+        self.spill_dir = spill_dir
+        self.spill_temp_dir = None
+        self.entries = OrderedDict()
+        self.size = 0
+        # key -> (path, bytes)
+        self.spilled = OrderedDict()
+        self.spilled_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """The patched weight on the CPU, don't modify it."""
+        if key is None or self.max_bytes <= 0:
+            return None
+        with self.lock:
+            weight = self.entries.get(key, None)
+            if weight is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return weight
+            spilled = self.spilled.pop(key, None)
+            if spilled is None:
+                self.misses += 1
+                return None
+            path, nbytes = spilled
+            self.spilled_size -= nbytes
+        try:
+            weight = comfy.utils.load_torch_file(path, safe_load=True)["weight"].clone()
+        except Exception as e:
+            logging.warning("Could not load the cached patched weight {}: {}".format(path, e))
+            weight = None
+        finally:
+            os.remove(path)
+        with self.lock:
+            if weight is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.set(key, weight)
+        return weight
+
+    def contains(self, key):
+        if key is None or self.max_bytes <= 0:
+            return False
+        with self.lock:
+            return key in self.entries or key in self.spilled
+
+    def set(self, key, weight):
+        """Caches weight, which must be a CPU tensor that isn't used anywhere else."""
+        if key is None or tensor_nbytes(weight) > self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= tensor_nbytes(old)
+            self.entries[key] = weight
+            self.size += tensor_nbytes(weight)
+            while self.size > self.max_bytes:
+                evicted_key, evicted_weight = self.entries.popitem(last=False)
+                self.size -= tensor_nbytes(evicted_weight)
+                evicted.append((evicted_key, evicted_weight))
+        for evicted_key, evicted_weight in evicted:
+            self.spill(evicted_key, evicted_weight)
+
+    def spill(self, key, weight):
+        nbytes = tensor_nbytes(weight)
+        if self.spill_dir is None or nbytes > self.max_spill_bytes:
+            return
+        with self.lock:
+            while self.spilled_size + nbytes > self.max_spill_bytes:
+                _, (old_path, old_nbytes) = self.spilled.popitem(last=False)
+                self.spilled_size -= old_nbytes
+                os.remove(old_path)
+        name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+        path = os.path.join(self.spill_directory(), "{}.safetensors".format(name))
+        try:
+            comfy.utils.save_torch_file({"weight": weight.contiguous()}, path)
+        except Exception as e:
+            logging.warning("Could not save the patched weight {} to {}: {}".format(key[0], path, e))
+            return
+        with self.lock:
+            self.spilled[key] = (path, nbytes)
+            self.spilled_size += nbytes
+
+    def spill_directory(self):
+        if self.spill_temp_dir is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_temp_dir = tempfile.mkdtemp(prefix="patched_weights_", dir=self.spill_dir)
+            atexit.register(shutil.rmtree, self.spill_temp_dir, ignore_errors=True)
+        return self.spill_temp_dir
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            for path, _ in self.spilled.values():
+                os.remove(path)
+            self.spilled.clear()
+            self.spilled_size = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size,
+                "spilled_entries": len(self.spilled), "spilled_bytes": self.spilled_size}
+
+
+patched_weight_cache = PatchedWeightCache(round(args.patched_weight_cache_size * 1024 * 1024),
+                                          spill_dir=args.patched_weight_cache_dir,
+                                          max_spill_bytes=round(args.patched_weight_cache_disk_size * 1024 * 1024))
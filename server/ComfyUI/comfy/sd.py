@@ -34,6 +34,7 @@ import comfy.text_encoders.lt
 import comfy.text_encoders.hunyuan_video
 
 import comfy.model_patcher
+import comfy.model_snapshot
 import comfy.lora
 import comfy.lora_convert
 import comfy.hooks
@@ -223,7 +224,7 @@ class CLIP:
 
     def load_sd(self, sd, full_model=False):
         if full_model:
-            return self.cond_stage_model.load_state_dict(sd, strict=False)
+            return comfy.utils.load_module_weights(self.cond_stage_model, sd, strict=False)
         else:
             return self.cond_stage_model.load_sd(sd)
 
@@ -367,7 +368,7 @@ class VAE:
             self.first_stage_model = AutoencoderKL(**(config['params']))
         self.first_stage_model = self.first_stage_model.eval()
 
-        m, u = self.first_stage_model.load_state_dict(sd, strict=False)
+        m, u = comfy.utils.load_module_weights(self.first_stage_model, sd, strict=False)
         if len(m) > 0:
             logging.warning("Missing VAE keys {}".format(m))
 
@@ -775,48 +776,61 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}):
     sd = comfy.utils.load_torch_file(ckpt_path)
-    out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options)
+    snapshot_path = comfy.model_snapshot.snapshot_path(ckpt_path, model_options) if output_model else None
+    out = load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision, embedding_directory, output_model, model_options, te_model_options=te_model_options, snapshot_path=snapshot_path)
     if out is None:
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(ckpt_path))
     return out
 
-def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}):
+def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, model_options={}, te_model_options={}, snapshot_path=None):
     clip = None
     clipvision = None
     vae = None
     model = None
     model_patcher = None
 
-    diffusion_model_prefix = model_detection.unet_prefix_from_state_dict(sd)
-    parameters = comfy.utils.calculate_parameters(sd, diffusion_model_prefix)
-    weight_dtype = comfy.utils.weight_dtype(sd, diffusion_model_prefix)
     load_device = model_management.get_torch_device()
+    snapshot = None
+    if output_model:
+        snapshot = comfy.model_snapshot.load(snapshot_path)
+    if snapshot is not None:
+        model, diffusion_model_prefix, parameters = snapshot
+        model_config = model.model_config
+        inital_load_device = model.device
+        for k in list(filter(lambda a: a.startswith(diffusion_model_prefix), sd.keys())):
+            sd.pop(k)
+    else:
+        diffusion_model_prefix = model_detection.unet_prefix_from_state_dict(sd)
+        parameters = comfy.utils.calculate_parameters(sd, diffusion_model_prefix)
+        weight_dtype = comfy.utils.weight_dtype(sd, diffusion_model_prefix)
 
-    model_config = model_detection.model_config_from_unet(sd, diffusion_model_prefix)
-    if model_config is None:
-        return None
+        model_config = model_detection.model_config_from_unet(sd, diffusion_model_prefix)
+        if model_config is None:
+            return None
 
-    unet_weight_dtype = list(model_config.supported_inference_dtypes)
-    if weight_dtype is not None and model_config.scaled_fp8 is None:
-        unet_weight_dtype.append(weight_dtype)
+        unet_weight_dtype = list(model_config.supported_inference_dtypes)
+        if weight_dtype is not None and model_config.scaled_fp8 is None:
+            unet_weight_dtype.append(weight_dtype)
 
-    model_config.custom_operations = model_options.get("custom_operations", None)
-    unet_dtype = model_options.get("dtype", model_options.get("weight_dtype", None))
+        model_config.custom_operations = model_options.get("custom_operations", None)
+        unet_dtype = model_options.get("dtype", model_options.get("weight_dtype", None))
 
-    if unet_dtype is None:
-        unet_dtype = model_management.unet_dtype(model_params=parameters, supported_dtypes=unet_weight_dtype)
+        if unet_dtype is None:
+            unet_dtype = model_management.unet_dtype(model_params=parameters, supported_dtypes=unet_weight_dtype)
 
-    manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device, model_config.supported_inference_dtypes)
-    model_config.set_inference_dtype(unet_dtype, manual_cast_dtype)
+        manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device, model_config.supported_inference_dtypes)
+        model_config.set_inference_dtype(unet_dtype, manual_cast_dtype)
 
     if model_config.clip_vision_prefix is not None:
         if output_clipvision:
             clipvision = clip_vision.load_clipvision_from_sd(sd, model_config.clip_vision_prefix, True)
 
-    if output_model:
+    if output_model and snapshot is None:
         inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
         model = model_config.get_model(sd, diffusion_model_prefix, device=inital_load_device)
         model.load_model_weights(sd, diffusion_model_prefix)
+        if snapshot_path is not None:
+            comfy.model_snapshot.save(snapshot_path, model, diffusion_model_prefix, parameters)
 
     if output_vae:
         vae_sd = comfy.utils.state_dict_prefix_replace(sd, {k: "" for k in model_config.vae_key_prefix}, filter_keys=True)
@@ -856,7 +870,13 @@ def load_state_dict_guess_config(sd, output_vae=True, output_clip=True, output_c
     return (model_patcher, clip, vae, clipvision)
 
 
-def load_diffusion_model_state_dict(sd, model_options={}): #load unet in diffusers or regular format
+def load_diffusion_model_state_dict(sd, model_options={}, snapshot_path=None): #load unet in diffusers or regular format
+    snapshot = comfy.model_snapshot.load(snapshot_path)
+    if snapshot is not None:
+        offload_device = model_management.unet_offload_device()
+        model = snapshot[0].to(offload_device)
+        return comfy.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device)
+
     dtype = model_options.get("dtype", None)
 
     #Allow loading unets from checkpoint files
@@ -915,12 +935,14 @@ def load_diffusion_model_state_dict(sd, model_options={}): #load unet in diffuse
     left_over = sd.keys()
     if len(left_over) > 0:
         logging.info("left over keys in unet: {}".format(left_over))
+    if snapshot_path is not None:
+        comfy.model_snapshot.save(snapshot_path, model, "", parameters)
     return comfy.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=offload_device)
 
 
 def load_diffusion_model(unet_path, model_options={}):
     sd = comfy.utils.load_torch_file(unet_path)
-    model = load_diffusion_model_state_dict(sd, model_options=model_options)
+    model = load_diffusion_model_state_dict(sd, model_options=model_options, snapshot_path=comfy.model_snapshot.snapshot_path(unet_path, model_options))
     if model is None:
         logging.error("ERROR UNSUPPORTED UNET {}".format(unet_path))
         raise RuntimeError("ERROR: Could not detect model type of: {}".format(unet_path))
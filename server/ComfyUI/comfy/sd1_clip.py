@@ -2,6 +2,7 @@ import os
 
 from transformers import CLIPTokenizer
 import comfy.ops
+import comfy.utils
 import torch
 import traceback
 import zipfile
@@ -249,7 +250,7 @@ class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
         return self(tokens)
 
     def load_sd(self, sd):
-        return self.transformer.load_state_dict(sd, strict=False)
+        return comfy.utils.load_module_weights(self.transformer, sd, strict=False)
 
 def parse_parentheses(string):
     result = []
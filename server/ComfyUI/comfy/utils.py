@@ -18,9 +18,12 @@
 
 
 import torch
+import json
 import math
+import os
 import struct
 import comfy.checkpoint_pickle
+from comfy.cli_args import args
 import safetensors.torch
 import numpy as np
 from PIL import Image
@@ -29,11 +32,60 @@ import itertools
 from torch.nn.functional import interpolate
 from einops import rearrange
 
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+def load_safetensors_mmap(ckpt):
+    """Loads a .safetensors file as tensors that are views of a single private memory map of the file.
+
+    Nothing is read until a tensor is used, and tensors that are only moved to another device or used as model weights
+    as they are (see load_module_weights) are never copied into process memory. Writing to a tensor doesn't change
+    the file.
+    """
+    with open(ckpt, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+    storage = torch.UntypedStorage.from_file(ckpt, shared=False, nbytes=os.path.getsize(ckpt))
+
+    sd = {}
+    for k, info in header.items():
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"], None)
+        if dtype is None:
+            raise ValueError("Unsupported safetensors dtype {} for {} in {}".format(info["dtype"], k, ckpt))
+        begin, end = info["data_offsets"]
+        start = data_start + begin
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        if start % itemsize == 0:
+            sd[k] = torch.empty(0, dtype=dtype).set_(storage, start // itemsize, info["shape"])
+        else:
+            # Unaligned tensors are rare, copy them
+            data = torch.empty(0, dtype=torch.uint8).set_(storage, start, (end - begin,))
+            sd[k] = data.clone().view(dtype).reshape(info["shape"])
+    return sd
+
 def load_torch_file(ckpt, safe_load=False, device=None):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors") or ckpt.lower().endswith(".sft"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        if device.type == "cpu" and not args.disable_mmap:
+            sd = load_safetensors_mmap(ckpt)
+        else:
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
             if not 'weights_only' in torch.load.__code__.co_varnames:
@@ -57,6 +109,26 @@ def load_torch_file(ckpt, safe_load=False, device=None):
                 sd = pl_sd
     return sd
 
+def load_module_weights(module, sd, strict=False):
+    """module.load_state_dict(sd, strict), using the tensors of sd as the module's weights instead of copying them into
+    the weights the module was created with.
+
+    Tensors are only converted when they don't have the dtype or aren't on the device of the weight they replace, so
+    memory mapped weights (see load_safetensors_mmap) go straight from the file to their device.
+    """
+    own = module.state_dict(keep_vars=True)
+    if args.disable_mmap or len(set(map(id, own.values()))) != len(own):
+        # Tied weights must keep sharing the same tensor
+        return module.load_state_dict(sd, strict=strict)
+
+    to_load = {}
+    for k, v in sd.items():
+        w = own.get(k, None)
+        if w is not None and isinstance(v, torch.Tensor) and w.shape == v.shape:
+            v = v.to(device=w.device, dtype=w.dtype)
+        to_load[k] = v
+    return module.load_state_dict(to_load, strict=strict, assign=True)
+
 def save_torch_file(sd, ckpt, metadata=None):
     if metadata is not None:
         safetensors.torch.save_file(sd, ckpt, metadata=metadata)
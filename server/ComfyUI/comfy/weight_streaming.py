@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from comfy.cli_args import args
+
+# Staging buffers are allocated in multiples of this, so that they can be reused for weights of similar sizes
+STAGING_ALIGNMENT = 1024 * 1024
+# For tests and benchmarks on CPU: bytes per second of the simulated transfer to a device without streams. When set,
+# lowvram modules stream their weights to the CPU as if it was a separate device behind a bus of that bandwidth.
+simulated_bandwidth = None
+
+
+def tensors_nbytes(tensors):
+    return sum(t.nelement() * t.element_size() for t in tensors if t is not None)
+
+
+class StagingPool:
+    """Reusable host buffers, pinned when pin is set, of at most max_bytes in total.
+
+    Copying to a GPU from pinned memory doesn't block, from pageable memory it goes through a driver buffer and does.
+    """
+    def __init__(self, max_bytes, pin):
+        self.max_bytes = max_bytes
+        self.pin = pin
+        self.free = {}
+        self.allocated = 0
+        self.lock = threading.Lock()
+
+    def get(self, tensor):
+        """A buffer with the dtype and shape of tensor, or None if the pool is full."""
+        nbytes = tensor.nelement() * tensor.element_size()
+        size = -(-nbytes // STAGING_ALIGNMENT) * STAGING_ALIGNMENT
+        with self.lock:
+            buffers = self.free.get(size, None)
+            if buffers:
+                buffer = buffers.pop()
+            else:
+                # Make room by dropping free buffers of other sizes
+                for other in list(self.free.keys()):
+                    if self.allocated + size <= self.max_bytes:
+                        break
+                    self.allocated -= other * len(self.free.pop(other))
+                if self.allocated + size > self.max_bytes:
+                    return None
+                try:
+                    buffer = torch.empty(size, dtype=torch.uint8, pin_memory=self.pin)
+                except RuntimeError as e:
+                    logging.warning("Could not allocate pinned memory for weight streaming, using pageable memory: {}".format(e))
+                    self.pin = False
+                    buffer = torch.empty(size, dtype=torch.uint8)
+                self.allocated += size
+        return buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+
+    def put(self, staging):
+        # The whole buffer the staging view was made from
+        buffer = torch.empty(0, dtype=torch.uint8).set_(staging.untyped_storage())
+        with self.lock:
+            self.free.setdefault(buffer.nelement(), []).append(buffer)
+
+
+class WeightStreamer:
+    """Copies the weights of lowvram modules to the device ahead of use.
+
+    The first pass over the model records the order the modules are used in. From then on, using a module queues the
+    copies of the modules that come after it (wrapping around to the first ones for the next step) on a background
+    thread, as long as the queued weights fit in budget bytes, so the copy of layer N+1 overlaps the compute of layer N.
+    On CUDA the copies go through a pool of pinned staging buffers on their own stream.
+    """
+    def __init__(self, device, budget, bandwidth=None):
+        self.device = device
+        self.budget = budget
+        self.bandwidth = bandwidth
+        self.stream = None
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+        self.pool = StagingPool(budget, pin=self.stream is not None)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="weight_streaming")
+        self.order = []
+        self.position = {}
+        self.last = None
+        # module -> (future, source tensors, bytes)
+        self.pending = {}
+        self.pending_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def transfer(self, tensors):
+        """Copies of tensors on the device, ready to use when this returns."""
+        if self.stream is None:
+            out = [None if t is None else t.to(self.device, copy=True) for t in tensors]
+            if self.bandwidth is not None:
+                time.sleep(tensors_nbytes(tensors) / self.bandwidth)
+            return out
+
+        out = []
+        staged = []
+        with torch.cuda.stream(self.stream):
+            for t in tensors:
+                if t is None:
+                    out.append(None)
+                    continue
+                staging = self.pool.get(t)
+                if staging is not None:
+                    staging.copy_(t)
+                    staged.append(staging)
+                    t = staging
+                r = torch.empty_like(t, device=self.device)
+                r.copy_(t, non_blocking=staging is not None)
+                out.append(r)
+        self.stream.synchronize()
+        for staging in staged:
+            self.pool.put(staging)
+        return out
+
+    def get(self, m):
+        """The weight and bias of module m on the device."""
+        entry = self.pending.pop(m, None)
+        self.prefetch(m)
+
+        tensors = None
+        if entry is not None:
+            future, sources, nbytes = entry
+            self.pending_bytes -= nbytes
+            tensors = future.result()
+            if sources[0] is not m.weight or sources[1] is not m.bias:
+                # The weights were replaced since
+                tensors = None
+        if tensors is None:
+            self.misses += 1
+            tensors = self.transfer((m.weight, m.bias))
+        else:
+            self.hits += 1
+
+        if self.stream is not None:
+            # Allocated on the copy stream, used on the compute stream
+            current_stream = torch.cuda.current_stream(self.device)
+            for t in tensors:
+                if t is not None:
+                    t.record_stream(current_stream)
+        return tensors[0], tensors[1]
+
+    def prefetch(self, m):
+        if m not in self.position:
+            self.position[m] = len(self.order)
+            self.order.append(m)
+        i = self.position[m]
+        if self.last is not None and i != self.last:
+            # Modules that were skipped this time, their copies would hold the budget until the next step
+            skipped = (i - self.last - 1) % len(self.order)
+            for step in range(1, skipped + 1):
+                self.drop(self.order[(self.last + step) % len(self.order)])
+        self.last = i
+        if self.budget <= 0:
+            return
+
+        for step in range(1, len(self.order)):
+            n = self.order[(i + step) % len(self.order)]
+            if n in self.pending:
+                continue
+            sources = (n.weight, n.bias)
+            nbytes = tensors_nbytes(sources)
+            if self.pending_bytes + nbytes > self.budget:
+                break
+            self.pending[n] = (self.executor.submit(self.transfer, sources), sources, nbytes)
+            self.pending_bytes += nbytes
+
+    def drop(self, m):
+        entry = self.pending.pop(m, None)
+        if entry is not None:
+            entry[0].result()
+            self.pending_bytes -= entry[2]
+
+    def release(self):
+        """Drops the queued copies, whose device memory would stay allocated until the model is used again, but keeps
+        the order of the modules. The next pass starts prefetching from the first module it uses."""
+        for m in list(self.pending.keys()):
+            self.drop(m)
+        self.last = None
+
+    def reset(self):
+        """Drops the queued copies and the order of the modules, before the weights of the model are changed or moved
+        or other modules become lowvram."""
+        self.release()
+        self.order = []
+        self.position = {}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "order": len(self.order)}
+
+
+def streaming_budget():
+    return max(0, round(args.weight_streaming_budget * 1024 * 1024))
+
+
+def reserved_memory(device):
+    """Memory of device that the copies queued by its WeightStreamer can take, which the weights a partially loaded
+    model keeps on the device have to leave free."""
+    if device is None:
+        return 0
+    if device.type == "cuda" or (device.type == "cpu" and simulated_bandwidth is not None):
+        return streaming_budget()
+    return 0
+
+
+def create_streamer(device):
+    """A WeightStreamer for the lowvram modules of a model loaded to device, None if weight streaming is disabled.
+
+    With simulated_bandwidth set, CPU devices get one even with a budget of 0, which copies each layer when it runs
+    like the lowvram modules without a streamer do, to compare against.
+    """
+    budget = streaming_budget()
+    if device.type == "cuda" and budget > 0:
+        return WeightStreamer(device, budget)
+    if device.type == "cpu" and simulated_bandwidth is not None:
+        return WeightStreamer(device, budget, bandwidth=simulated_bandwidth)
+    return None
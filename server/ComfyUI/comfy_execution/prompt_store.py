@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import sqlite3
+
+
+class PromptStore:
+    """SQLite persistence for the PromptQueue (--queue-db).
+
+    Prompts are written to the database before they are queued in memory and only removed once they are in the
+    history, so prompts that were queued or running when the process stopped are queued again on startup.
+    Also implements the same interface as execution.PromptHistory: history entries are read from the database a page
+    at a time instead of being kept in RAM.
+    Not thread safe, the PromptQueue calls it while holding its mutex.
+    """
+    def __init__(self, path, max_history_size):
+        self.max_history_size = max_history_size
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS queue (prompt_id TEXT PRIMARY KEY, item TEXT NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY AUTOINCREMENT, prompt_id TEXT NOT NULL UNIQUE, entry TEXT NOT NULL)")
+        self.size = self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+        logging.info("Prompt queue database: {}".format(path))
+
+    def close(self):
+        self.conn.close()
+
+    # Queue
+
+    def queue_items(self):
+        """The queued and the interrupted running items, to be queued again, in the order they were queued."""
+        # Items are (number, prompt_id, prompt, extra_data, outputs_to_execute) tuples, compared in the heap.
+        # The rowid grows with each insert. The schedulers break ties by the order the items are keyed in.
+        return [tuple(json.loads(row[0])) for row in self.conn.execute("SELECT item FROM queue ORDER BY rowid")]
+
+    def queue_put(self, item):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO queue (prompt_id, item) VALUES (?, ?)", (item[1], json.dumps(item)))
+
+    def queue_delete(self, prompt_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+
+    def queue_clear(self, keep=()):
+        """Delete every queued item except the prompt ids in keep (the running ones)."""
+        with self.conn:
+            if len(keep) == 0:
+                self.conn.execute("DELETE FROM queue")
+            else:
+                self.conn.execute("DELETE FROM queue WHERE prompt_id NOT IN ({})".format(",".join("?" * len(keep))), tuple(keep))
+
+    # History
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, prompt_id):
+        return self.conn.execute("SELECT 1 FROM history WHERE prompt_id = ?", (prompt_id,)).fetchone() is not None
+
+    def get(self, prompt_id):
+        row = self.conn.execute("SELECT entry FROM history WHERE prompt_id = ?", (prompt_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def add(self, prompt_id, entry):
+        """Add the finished prompt to the history and remove it from the queue, in one transaction."""
+        with self.conn:
+            self.size -= self.conn.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,)).rowcount
+            self.conn.execute("INSERT INTO history (prompt_id, entry) VALUES (?, ?)", (prompt_id, json.dumps(entry)))
+            self.conn.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+            self.size += 1
+            if self.size > self.max_history_size:
+                self.size -= self.conn.execute("DELETE FROM history WHERE seq IN (SELECT seq FROM history ORDER BY seq LIMIT ?)",
+                                               (self.size - self.max_history_size,)).rowcount
+
+    def remove(self, prompt_id):
+        with self.conn:
+            self.size -= self.conn.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,)).rowcount
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM history")
+        self.size = 0
+
+    def page(self, start, stop):
+        start = max(start, 0)
+        if stop <= start:
+            return {}
+        rows = self.conn.execute("SELECT prompt_id, entry FROM history ORDER BY seq LIMIT ? OFFSET ?", (stop - start, start))
+        return {prompt_id: json.loads(entry) for prompt_id, entry in rows}
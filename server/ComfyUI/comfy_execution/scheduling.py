@@ -0,0 +1,82 @@
+import itertools
+import math
+import time
+
+# Prompts of a higher class (lower rank) always run first. Set with "priority" in the prompt's extra_data.
+PRIORITY_CLASSES = {
+    "interactive": 0,
+    "normal": 1,
+    "batch": 2,
+}
+DEFAULT_PRIORITY_CLASS = "normal"
+# Forget the virtual finish time of tenants that have been idle, once there are this many
+MAX_IDLE_TENANTS = 1024
+
+
+class FifoScheduler:
+    """Orders prompts by their number, prompts sent to the front have a negative number."""
+    def __init__(self):
+        self.counter = itertools.count()
+
+    def key(self, item):
+        return (item[0], next(self.counter))
+
+    def dispatched(self, key):
+        pass
+
+
+class FairScheduler:
+    """Priority classes, then deadlines, then weighted fair queuing between tenants.
+
+    extra_data of a prompt may set:
+        "priority": one of PRIORITY_CLASSES, prompts of a higher class always run first.
+        "deadline": seconds after queueing by which the prompt should run. Within a class, prompts with a deadline run
+            earliest deadline first, before prompts without one.
+        "tenant": who the prompt is accounted to, the client id by default.
+    Within a class, prompts of different tenants are interleaved by start-time fair queuing: each tenant's prompts get
+    virtual finish times spaced 1 / weight apart, starting no earlier than the current virtual time, so a tenant that
+    queues many prompts doesn't delay a tenant that queues one more than its weight allows.
+    """
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.counter = itertools.count()
+        self.virtual_time = 0.0
+        # tenant -> virtual finish time of its last queued prompt
+        self.last_finish = {}
+
+    def key(self, item):
+        number, extra_data = item[0], item[3]
+        priority = PRIORITY_CLASSES.get(extra_data.get("priority", DEFAULT_PRIORITY_CLASS), PRIORITY_CLASSES[DEFAULT_PRIORITY_CLASS])
+        if number < 0:
+            # Sent to the front
+            priority = -1
+        deadline = math.inf
+        if extra_data.get("deadline", None) is not None:
+            deadline = time.time() + float(extra_data["deadline"])
+        tenant = extra_data.get("tenant", extra_data.get("client_id", None))
+        start = max(self.virtual_time, self.last_finish.get(tenant, 0.0))
+        finish = start + 1.0 / self.weights.get(tenant, 1.0)
+        self.last_finish[tenant] = finish
+        return (priority, deadline, finish, start, next(self.counter))
+
+    def dispatched(self, key):
+        self.virtual_time = max(self.virtual_time, key[3])
+        if len(self.last_finish) > MAX_IDLE_TENANTS:
+            self.last_finish = {k: v for k, v in self.last_finish.items() if v > self.virtual_time}
+
+
+def parse_weights(values):
+    """Parses --scheduler-weights TENANT=WEIGHT values."""
+    weights = {}
+    for value in values or []:
+        tenant, _, weight = value.rpartition("=")
+        if tenant == "" or float(weight) <= 0:
+            raise ValueError("Invalid scheduler weight {}, expected TENANT=WEIGHT with WEIGHT > 0".format(value))
+        weights[tenant] = float(weight)
+    return weights
+
+
+def create_scheduler(name, weights=None):
+    if name == "fair":
+        return FairScheduler(parse_weights(weights))
+    return FifoScheduler()
@@ -0,0 +1,83 @@
+import torch
+import comfy.sample
+from comfy.conds import lcm
+
+
+class ConditioningBatch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"conditioning1": ("CONDITIONING", ),
+                             "conditioning2": ("CONDITIONING", ),
+                             }}
+    RETURN_TYPES = ("CONDITIONING",)
+    FUNCTION = "batch"
+
+    CATEGORY = "conditioning/batch"
+    DESCRIPTION = "Stacks two conditionings along the batch dimension so each image of a latent batch gets its own prompt. Batch entries are matched to latent batch entries in order."
+
+    def batch(self, conditioning1, conditioning2):
+        out = []
+        for c1, c2 in zip(conditioning1, conditioning2):
+            t1 = c1[0]
+            t2 = c2[0]
+            if t1.shape[1] != t2.shape[1]:
+                # Same as CONDCrossAttn.concat: padding with repeat doesn't change the result
+                max_len = lcm(t1.shape[1], t2.shape[1])
+                t1 = t1.repeat(1, max_len // t1.shape[1], 1)
+                t2 = t2.repeat(1, max_len // t2.shape[1], 1)
+            n = c1[1].copy()
+            for k in ("pooled_output", "guidance"):
+                if torch.is_tensor(c1[1].get(k, None)) and torch.is_tensor(c2[1].get(k, None)):
+                    n[k] = torch.cat((c1[1][k], c2[1][k]))
+            out.append([torch.cat((t1, t2)), n])
+        return (out, )
+
+
+class Noise_BatchSeeds:
+    def __init__(self, seeds):
+        self.seeds = seeds
+        self.seed = seeds[0]
+
+    def generate_noise(self, input_latent):
+        # Each batch entry gets the same noise it would get when sampled on its own with its seed
+        latent_image = input_latent["samples"]
+        noises = []
+        for i in range(latent_image.shape[0]):
+            noises.append(comfy.sample.prepare_noise(latent_image[i:i + 1], self.seeds[min(i, len(self.seeds) - 1)]))
+        return torch.cat(noises, dim=0)
+
+
+class RandomNoiseBatch:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+                    "noise_seeds": ("STRING", {"default": "0", "tooltip": "Comma separated seeds, one for each entry of the latent batch. The last seed is reused if there are fewer seeds than entries."}),
+                    }}
+
+    RETURN_TYPES = ("NOISE",)
+    FUNCTION = "get_noise"
+    CATEGORY = "sampling/custom_sampling/noise"
+
+    def get_noise(self, noise_seeds):
+        return (Noise_BatchSeeds([int(x) for x in noise_seeds.split(",")]),)
+
+    @classmethod
+    def VALIDATE_INPUTS(s, noise_seeds):
+        try:
+            seeds = [int(x) for x in noise_seeds.split(",")]
+        except ValueError:
+            return "noise_seeds must be comma separated integers"
+        if any(x < 0 or x > 0xffffffffffffffff for x in seeds):
+            return "noise_seeds must be between 0 and 0xffffffffffffffff"
+        return True
+
+
+NODE_CLASS_MAPPINGS = {
+    "ConditioningBatch": ConditioningBatch,
+    "RandomNoiseBatch": RandomNoiseBatch,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "ConditioningBatch": "Conditioning (Batch)",
+    "RandomNoiseBatch": "Random Noise (Batch)",
+}
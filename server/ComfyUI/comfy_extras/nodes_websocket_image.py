@@ -0,0 +1,104 @@
+import base64
+import binascii
+from io import BytesIO
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+import node_helpers
+from server import BinaryEventTypes, PromptServer, encode_output_image
+
+
+def decode_base64_image(data):
+    if data.startswith("data:"):
+        data = data.split(",", 1)[1]
+    return base64.b64decode(data, validate=True)
+
+
+class LoadImageBase64:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"image": ("STRING", {"default": "", "tooltip": "The image file (PNG, WebP, JPEG...) encoded as base64, optionally as a data URL."})}}
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    FUNCTION = "load_image"
+    EXECUTION_STAGE = "cpu"
+
+    CATEGORY = "image"
+    DESCRIPTION = "Loads an image embedded in the prompt instead of from the input directory."
+
+    def load_image(self, image):
+        img = node_helpers.pillow(Image.open, BytesIO(decode_base64_image(image)))
+        img = node_helpers.pillow(ImageOps.exif_transpose, img)
+        if img.mode == 'I':
+            img = img.point(lambda i: i * (1 / 255))
+        output_image = torch.from_numpy(np.array(img.convert("RGB")).astype(np.float32) / 255.0)[None,]
+        if 'A' in img.getbands():
+            mask = 1. - torch.from_numpy(np.array(img.getchannel('A')).astype(np.float32) / 255.0)
+        else:
+            mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
+        return (output_image, mask.unsqueeze(0))
+
+    @classmethod
+    def VALIDATE_INPUTS(s, image):
+        try:
+            decode_base64_image(image)
+        except (binascii.Error, ValueError):
+            return "Invalid base64 image"
+        return True
+
+
+class SaveImageWebsocket:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"images": ("IMAGE", {"tooltip": "The images to send."}),
+                             "format": (["png", "webp"], {"tooltip": "webp is lossless."}),
+                             },
+                "hidden": {"unique_id": "UNIQUE_ID"},
+                }
+
+    RETURN_TYPES = ()
+    FUNCTION = "send_images"
+    EXECUTION_STAGE = "cpu"
+
+    OUTPUT_NODE = True
+
+    CATEGORY = "image"
+    DESCRIPTION = "Sends the images to the client that queued the prompt as binary websocket messages instead of saving them to the output directory."
+
+    def send_images(self, images, format="png", unique_id=None):
+        server = PromptServer.instance
+        pixels = node_helpers.images_to_uint8(images)
+
+        def encode(image):
+            buffer = BytesIO()
+            if format == "webp":
+                Image.fromarray(image).save(buffer, format="WEBP", lossless=True, method=0)
+            else:
+                Image.fromarray(image).save(buffer, format="PNG", compress_level=1)
+            return buffer.getvalue()
+
+        results = list()
+        for (batch_number, image_bytes) in enumerate(node_helpers.map_image_encode(encode, pixels)):
+            message = encode_output_image(server.last_prompt_id, unique_id, batch_number, format, image_bytes)
+            server.send_sync(BinaryEventTypes.OUTPUT_IMAGE, message, server.client_id)
+            results.append({"index": batch_number, "format": format})
+
+        return { "ui": { "websocket_images": results } }
+
+    @classmethod
+    def IS_CHANGED(s, **kwargs):
+        # Always send the images, even if the output is cached from an earlier prompt
+        return float("NaN")
+
+
+NODE_CLASS_MAPPINGS = {
+    "LoadImageBase64": LoadImageBase64,
+    "SaveImageWebsocket": SaveImageWebsocket,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "LoadImageBase64": "Load Image (Base64)",
+    "SaveImageWebsocket": "Save Image (Websocket)",
+}
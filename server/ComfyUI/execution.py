@@ -1,10 +1,12 @@
 import sys
 import copy
+import contextlib
 import logging
 import threading
 import heapq
 import time
 import traceback
+from collections import OrderedDict
 from enum import Enum
 import inspect
 from typing import List, Literal, NamedTuple, Optional
@@ -13,10 +15,12 @@ import torch
 import nodes
 
 import comfy.model_management
+from comfy.cli_args import args
 from comfy_execution.graph import get_input_info, ExecutionList, DynamicPrompt, ExecutionBlocker
 from comfy_execution.graph_utils import is_link, GraphBuilder
 from comfy_execution.caching import HierarchicalCache, LRUCache, CacheKeySetInputSignature, CacheKeySetID
 from comfy_execution.validation import validate_node_input
+from comfy_execution.scheduling import FifoScheduler
 
 class ExecutionResult(Enum):
     SUCCESS = 0
@@ -26,6 +30,64 @@ class ExecutionResult(Enum):
 class DuplicateNodeError(Exception):
     pass
 
+def get_stage_lock(class_def):
+    """The lock a node holds while it executes. Nodes use the device by default and take turns on it, nodes that only
+    do CPU work (EXECUTION_STAGE = "cpu") run concurrently with the other prompt workers."""
+    if getattr(class_def, "EXECUTION_STAGE", "device") == "cpu":
+        return contextlib.nullcontext()
+    return comfy.model_management.device_lock
+
+def shares_outputs(class_def):
+    """Whether the outputs of a node are shared between the prompt workers: loaders by default, a node class can set
+    SHARE_OUTPUTS to decide."""
+    share = getattr(class_def, "SHARE_OUTPUTS", None)
+    if share is not None:
+        return share
+    return "loaders" in getattr(class_def, "CATEGORY", "").split("/")
+
+class SharedOutputs:
+    """Outputs of the nodes that share them (see shares_outputs), for all the prompt workers, so that a model used
+    by the prompts of several workers is loaded once instead of once per worker's cache.
+
+    Keyed by the input signature of the node, the key of the outputs cache. An entry is kept as long as the last prompt
+    of one of the workers uses it, like the classic cache keeps outputs. Nodes that share their outputs run holding the
+    device lock, which serializes looking them up and loading them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.outputs = {}
+        # key -> workers whose last prompt uses it
+        self.users = {}
+        # worker -> keys of its last prompt
+        self.claims = {}
+
+    def claim(self, worker, keys):
+        """Keeps the entries of keys for worker, and drops the entries its previous prompt used that nobody uses."""
+        keys = set(keys)
+        with self.lock:
+            for key in self.claims.pop(worker, set()) - keys:
+                users = self.users.get(key, None)
+                if users is not None:
+                    users.discard(worker)
+                    if len(users) == 0:
+                        del self.users[key]
+                        self.outputs.pop(key, None)
+            for key in keys:
+                self.users.setdefault(key, set()).add(worker)
+            if len(keys) > 0:
+                self.claims[worker] = keys
+
+    def get(self, key):
+        with self.lock:
+            return self.outputs.get(key, None)
+
+    def set(self, key, value):
+        with self.lock:
+            if key in self.users:
+                self.outputs[key] = value
+
+shared_outputs = SharedOutputs()
+
 class IsChangedCache:
     def __init__(self, dynprompt, outputs_cache):
         self.dynprompt = dynprompt
@@ -295,7 +357,8 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                 caches.objects.set(unique_id, obj)
 
             if hasattr(obj, "check_lazy_status"):
-                required_inputs = _map_node_over_list(obj, input_data_all, "check_lazy_status", allow_interrupt=True)
+                with get_stage_lock(class_def):
+                    required_inputs = _map_node_over_list(obj, input_data_all, "check_lazy_status", allow_interrupt=True)
                 required_inputs = set(sum([r for r in required_inputs if isinstance(r,list)], []))
                 required_inputs = [x for x in required_inputs if isinstance(x,str) and (
                     x not in input_data_all or x in missing_keys
@@ -325,7 +388,17 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
                     return block
             def pre_execute_cb(call_index):
                 GraphBuilder.set_default_prefix(unique_id, call_index, 0)
-            output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+            shared_key = caches.outputs.cache_key_set.get_data_key(unique_id) if shares_outputs(class_def) else None
+            with get_stage_lock(class_def):
+                shared = shared_outputs.get(shared_key) if shared_key is not None else None
+                if shared is not None:
+                    # Loaded by another prompt worker
+                    output_data, output_ui = shared
+                    has_subgraph = False
+                else:
+                    output_data, output_ui, has_subgraph = get_output_data(obj, input_data_all, execution_block_cb=execution_block_cb, pre_execute_cb=pre_execute_cb)
+                    if shared_key is not None and not has_subgraph:
+                        shared_outputs.set(shared_key, (output_data, output_ui))
         if len(output_ui) > 0:
             caches.ui.set(unique_id, {
                 "meta": {
@@ -406,7 +479,8 @@ def execute(server, dynprompt, caches, current_item, extra_data, executed, promp
         }
         if isinstance(ex, comfy.model_management.OOM_EXCEPTION):
             logging.error("Got an OOM, unloading all loaded models.")
-            comfy.model_management.unload_all_models()
+            with comfy.model_management.device_lock:
+                comfy.model_management.unload_all_models()
 
         return (ExecutionResult.FAILURE, error_details, ex)
 
@@ -422,8 +496,10 @@ class PromptExecutor:
 
     def reset(self):
         self.caches = CacheSet(self.lru_size)
+        shared_outputs.claim(self, ())
         self.status_messages = []
         self.success = True
+        self.reset_requested = False
 
     def add_message(self, event, data: dict, broadcast: bool):
         data = {
@@ -463,7 +539,7 @@ class PromptExecutor:
             self.add_message("execution_error", mes, broadcast=False)
 
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
-        nodes.interrupt_processing(False)
+        comfy.model_management.begin_processing(prompt_id)
 
         if "client_id" in extra_data:
             self.server.client_id = extra_data["client_id"]
@@ -479,13 +555,16 @@ class PromptExecutor:
             for cache in self.caches.all:
                 cache.set_prompt(dynamic_prompt, prompt.keys(), is_changed_cache)
                 cache.clean_unused()
+            shared_outputs.claim(self, [self.caches.outputs.cache_key_set.get_data_key(node_id) for node_id in prompt
+                                        if shares_outputs(nodes.NODE_CLASS_MAPPINGS[prompt[node_id]["class_type"]])])
 
             cached_nodes = []
             for node_id in prompt:
                 if self.caches.outputs.get(node_id) is not None:
                     cached_nodes.append(node_id)
 
-            comfy.model_management.cleanup_models_gc()
+            with comfy.model_management.device_lock:
+                comfy.model_management.cleanup_models_gc()
             self.add_message("execution_cached",
                           { "nodes": cached_nodes, "prompt_id": prompt_id},
                           broadcast=False)
@@ -529,8 +608,108 @@ class PromptExecutor:
             }
             self.server.last_node_id = None
             if comfy.model_management.DISABLE_SMART_MEMORY:
-                comfy.model_management.unload_all_models()
+                with comfy.model_management.device_lock:
+                    comfy.model_management.unload_all_models()
+        comfy.model_management.end_processing()
+
+
+# Widget values longer than this (base64 images...) are validated again on every prompt instead of being cached
+MAX_CACHED_VALIDATION_VALUE_LENGTH = 1024
+VALIDATION_CACHE_SIZE = 4096
+
+class ValidationCache:
+    """Nodes that passed validation recently, so that prompts that only change a few widget values of the same graph
+    don't call INPUT_TYPES (which may list directories) and VALIDATE_INPUTS of every node again.
+
+    Keyed by validation_cache_key. Entries expire after ttl seconds, because INPUT_TYPES and VALIDATE_INPUTS may depend
+    on files that were deleted since. Only successes are cached, so files added since are found right away.
+    Only used from the server's event loop.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key is None or self.ttl <= 0:
+            return None
+        entry = self.entries.get(key, None)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        if key is None or self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
+
+validation_cache = ValidationCache(VALIDATION_CACHE_SIZE, args.validation_cache_ttl)
+# Node class -> argspec of its VALIDATE_INPUTS
+validate_argspecs = {}
+
+def validation_cache_key(prompt, obj_class, inputs):
+    """What validating a node checks besides its linked nodes: its class, its widget values and the classes and
+    output slots it is linked to. None if the node shouldn't be cached."""
+    key = [obj_class]
+    for x, val in inputs.items():
+        if isinstance(val, list):
+            if len(val) != 2 or not isinstance(val[1], int):
+                return None
+            try:
+                o_class = nodes.NODE_CLASS_MAPPINGS[prompt[val[0]]['class_type']]
+            except (KeyError, TypeError):
+                return None
+            key.append((x, o_class, val[1]))
+        elif val is None or isinstance(val, (bool, int, float, str)):
+            if isinstance(val, str) and len(val) > MAX_CACHED_VALIDATION_VALUE_LENGTH:
+                return None
+            # The type too: 1, 1.0 and True are equal but don't convert to the same STRING
+            key.append((x, type(val), val))
+        else:
+            return None
+    return tuple(key)
 
+def validate_linked_node(prompt, x, val, info, validated):
+    """Validates the node that input x is linked to, returns whether it is valid."""
+    o_id = val[0]
+    try:
+        r = validate_inputs(prompt, o_id, validated)
+        if r[0] is False:
+            # `r` will be set in `validated[o_id]` already
+            return False
+    except Exception as ex:
+        typ, _, tb = sys.exc_info()
+        exception_type = full_type_name(typ)
+        reasons = [{
+            "type": "exception_during_inner_validation",
+            "message": "Exception when validating inner node",
+            "details": str(ex),
+            "extra_info": {
+                "input_name": x,
+                "input_config": info,
+                "exception_message": str(ex),
+                "exception_type": exception_type,
+                "traceback": traceback.format_tb(tb),
+                "linked_node": val
+            }
+        }]
+        validated[o_id] = (False, reasons, o_id)
+        return False
+    return True
 
 def validate_inputs(prompt, item, validated):
     unique_id = item
@@ -541,6 +720,19 @@ def validate_inputs(prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
+    cache_key = validation_cache_key(prompt, obj_class, inputs)
+    cached = validation_cache.get(cache_key)
+    if cached is not None:
+        converted_values, linked_inputs = cached
+        inputs.update(converted_values)
+        valid = True
+        for x in linked_inputs:
+            if not validate_linked_node(prompt, x, inputs[x], None, validated):
+                valid = False
+        ret = (valid, [], unique_id)
+        validated[unique_id] = ret
+        return ret
+
     class_inputs = obj_class.INPUT_TYPES()
     valid_inputs = set(class_inputs.get('required',{})).union(set(class_inputs.get('optional',{})))
 
@@ -550,13 +742,15 @@ def validate_inputs(prompt, item, validated):
     validate_function_inputs = []
     validate_has_kwargs = False
     if hasattr(obj_class, "VALIDATE_INPUTS"):
-        argspec = inspect.getfullargspec(obj_class.VALIDATE_INPUTS)
+        argspec = validate_argspecs.get(obj_class, None)
+        if argspec is None:
+            argspec = validate_argspecs[obj_class] = inspect.getfullargspec(obj_class.VALIDATE_INPUTS)
         validate_function_inputs = argspec.args
         validate_has_kwargs = argspec.varkw is not None
     received_types = {}
 
     for x in valid_inputs:
-        type_input, input_category, extra_info = get_input_info(obj_class, x)
+        type_input, input_category, extra_info = get_input_info(obj_class, x, class_inputs)
         assert extra_info is not None
         if x not in inputs:
             if input_category == "required":
@@ -608,30 +802,8 @@ def validate_inputs(prompt, item, validated):
                 }
                 errors.append(error)
                 continue
-            try:
-                r = validate_inputs(prompt, o_id, validated)
-                if r[0] is False:
-                    # `r` will be set in `validated[o_id]` already
-                    valid = False
-                    continue
-            except Exception as ex:
-                typ, _, tb = sys.exc_info()
+            if not validate_linked_node(prompt, x, val, info, validated):
                 valid = False
-                exception_type = full_type_name(typ)
-                reasons = [{
-                    "type": "exception_during_inner_validation",
-                    "message": "Exception when validating inner node",
-                    "details": str(ex),
-                    "extra_info": {
-                        "input_name": x,
-                        "input_config": info,
-                        "exception_message": str(ex),
-                        "exception_type": exception_type,
-                        "traceback": traceback.format_tb(tb),
-                        "linked_node": val
-                    }
-                }]
-                validated[o_id] = (False, reasons, o_id)
                 continue
         else:
             try:
@@ -745,6 +917,12 @@ def validate_inputs(prompt, item, validated):
                     errors.append(error)
                     continue
 
+    if len(errors) == 0:
+        # Whether the linked nodes are valid is checked again on a cache hit
+        present_inputs = [x for x in valid_inputs if x in inputs]
+        validation_cache.set(cache_key, ({x: inputs[x] for x in present_inputs if not isinstance(inputs[x], list)},
+                                         tuple(x for x in present_inputs if isinstance(inputs[x], list))))
+
     if len(errors) > 0 or valid is not True:
         ret = (False, errors, unique_id)
     else:
@@ -869,35 +1047,143 @@ def validate_prompt(prompt):
 
 MAXIMUM_HISTORY_SIZE = 10000
 
+class PromptHistory:
+    """Finished prompts by prompt id, oldest first.
+
+    The order is kept in a fixed size ring buffer, so dropping the oldest entry is O(1) and a page at any offset is
+    found without walking the entries before it.
+    """
+    def __init__(self, max_size):
+        self.entries = {}
+        self.ring = [None] * max_size
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, prompt_id):
+        return prompt_id in self.entries
+
+    def get(self, prompt_id):
+        return self.entries.get(prompt_id, None)
+
+    def add(self, prompt_id, entry):
+        if prompt_id in self.entries:
+            self.remove(prompt_id)
+        if self.size == len(self.ring):
+            self.entries.pop(self.ring[self.start])
+            self.ring[self.start] = None
+            self.start = (self.start + 1) % len(self.ring)
+            self.size -= 1
+        self.ring[(self.start + self.size) % len(self.ring)] = prompt_id
+        self.size += 1
+        self.entries[prompt_id] = entry
+
+    def remove(self, prompt_id):
+        if self.entries.pop(prompt_id, None) is None:
+            return
+        # O(n), but deleting a single history item is rare
+        prompt_ids = [x for x in self.prompt_ids(0, self.size) if x != prompt_id]
+        self.ring = prompt_ids + [None] * (len(self.ring) - len(prompt_ids))
+        self.start = 0
+        self.size = len(prompt_ids)
+
+    def clear(self):
+        self.entries = {}
+        self.ring = [None] * len(self.ring)
+        self.start = 0
+        self.size = 0
+
+    def prompt_ids(self, start, stop):
+        for i in range(max(start, 0), min(stop, self.size)):
+            yield self.ring[(self.start + i) % len(self.ring)]
+
+    def page(self, start, stop):
+        return {prompt_id: self.entries[prompt_id] for prompt_id in self.prompt_ids(start, stop)}
+
+
 class PromptQueue:
-    def __init__(self, server):
+    """Prompts waiting to be executed, in the order of the scheduler (comfy_execution.scheduling), and the history of
+    finished prompts.
+
+    Queued items are kept in a heap of (scheduler key, item) entries indexed by prompt id: deleting one only drops it
+    from the index and the heap entry is skipped when it reaches the top. Items are never modified once queued, so readers get shared, immutable snapshots
+    instead of copies.
+    With a store (comfy_execution.prompt_store.PromptStore) the queue is written ahead to disk, prompts left over from
+    the last run are queued again and the history is kept on disk instead of in memory.
+    """
+    def __init__(self, server, store=None, scheduler=None, workers=1):
         self.server = server
+        self.store = store
+        self.scheduler = scheduler if scheduler is not None else FifoScheduler()
+        self.workers = workers
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
         self.queue = []
+        # prompt id -> queued item, the items in self.queue that are not in here were deleted
+        self.queue_index = {}
         self.currently_running = {}
-        self.history = {}
+        self.running_since = {}
+        # Moving average of how long a prompt takes, for the expected wait times
+        self.average_duration = None
+        self.snapshot = None
+        self.positions = None
+        self.history = PromptHistory(MAXIMUM_HISTORY_SIZE) if store is None else store
         self.flags = {}
         server.prompt_queue = self
+        if store is not None:
+            for item in store.queue_items():
+                try:
+                    key = self.scheduler.key(item)
+                except (TypeError, ValueError) as e:
+                    logging.warning("Dropping queued prompt {} that can't be scheduled: {}".format(item[1], e))
+                    store.queue_delete(item[1])
+                    continue
+                self.push(key, item)
+                # New prompts are queued after the restored ones
+                server.number = max(server.number, int(item[0]) + 1)
+            if len(self.queue_index) > 0:
+                logging.info("Restored {} queued prompts".format(len(self.queue_index)))
+
+    def queue_changed(self):
+        self.snapshot = None
+        self.positions = None
+        self.server.queue_updated()
+
+    def push(self, key, item):
+        entry = (key, item)
+        heapq.heappush(self.queue, entry)
+        self.queue_index[item[1]] = entry
 
     def put(self, item):
         with self.mutex:
-            heapq.heappush(self.queue, item)
-            self.server.queue_updated()
+            # Before the write ahead, so that an item the scheduler rejects isn't restored on every start
+            key = self.scheduler.key(item)
+            if self.store is not None:
+                self.store.queue_put(item)
+            self.push(key, item)
+            self.queue_changed()
             self.not_empty.notify()
 
     def get(self, timeout=None):
         with self.not_empty:
-            while len(self.queue) == 0:
+            while len(self.queue_index) == 0:
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                if timeout is not None and len(self.queue_index) == 0:
                     return None
-            item = heapq.heappop(self.queue)
+            entry = heapq.heappop(self.queue)
+            while self.queue_index.get(entry[1][1]) is not entry:
+                entry = heapq.heappop(self.queue)
+            key, item = entry
+            del self.queue_index[item[1]]
+            self.scheduler.dispatched(key)
             i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
+            self.currently_running[i] = item
+            self.running_since[i] = time.perf_counter()
             self.task_counter += 1
-            self.server.queue_updated()
+            self.queue_changed()
             return (item, i)
 
     class ExecutionStatus(NamedTuple):
@@ -909,76 +1195,110 @@ class PromptQueue:
                   status: Optional['PromptQueue.ExecutionStatus']):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
+            duration = time.perf_counter() - self.running_since.pop(item_id)
+            if self.average_duration is None:
+                self.average_duration = duration
+            else:
+                self.average_duration = 0.8 * self.average_duration + 0.2 * duration
 
             status_dict: Optional[dict] = None
             if status is not None:
                 status_dict = copy.deepcopy(status._asdict())
 
-            self.history[prompt[1]] = {
+            entry = {
                 "prompt": prompt,
                 "outputs": {},
                 'status': status_dict,
             }
-            self.history[prompt[1]].update(history_result)
-            self.server.queue_updated()
+            entry.update(history_result)
+            self.history.add(prompt[1], entry)
+            self.queue_changed()
 
     def get_current_queue(self):
+        """Returns the running and the pending items, in the order they will run. The snapshot is shared until the
+        queue changes, don't modify it."""
         with self.mutex:
-            out = []
-            for x in self.currently_running.values():
-                out += [x]
-            return (out, copy.deepcopy(self.queue))
+            if self.snapshot is None:
+                pending = tuple(entry[1] for entry in sorted(self.queue_index.values(), key=lambda entry: entry[0]))
+                self.snapshot = (tuple(self.currently_running.values()), pending)
+            return self.snapshot
+
+    def get_expected_wait(self, prompt_id=None):
+        """Estimated seconds until the queued prompt starts, or until a prompt queued now at the back would start.
+        None until a prompt has finished."""
+        with self.mutex:
+            if self.average_duration is None:
+                return None
+            pending = self.get_current_queue()[1]
+            if self.positions is None:
+                self.positions = {item[1]: i for i, item in enumerate(pending)}
+            ahead = self.positions.get(prompt_id, len(pending))
+            now = time.perf_counter()
+            running = sum(max(self.average_duration - (now - since), 0.0) for since in self.running_since.values())
+            return (running + ahead * self.average_duration) / max(self.workers, 1)
+
+    def has_prompt(self, prompt_id):
+        """Whether the prompt id is queued, running or in the history."""
+        with self.mutex:
+            if prompt_id in self.queue_index or any(item[1] == prompt_id for item in self.currently_running.values()):
+                return True
+            return self.history.get(prompt_id) is not None
 
     def get_tasks_remaining(self):
         with self.mutex:
-            return len(self.queue) + len(self.currently_running)
+            return len(self.queue_index) + len(self.currently_running)
 
     def wipe_queue(self):
         with self.mutex:
+            if self.store is not None:
+                self.store.queue_clear(keep=[x[1] for x in self.currently_running.values()])
             self.queue = []
-            self.server.queue_updated()
+            self.queue_index = {}
+            self.queue_changed()
+
+    def delete_queue_item_by_id(self, prompt_id):
+        with self.mutex:
+            if self.queue_index.pop(prompt_id, None) is None:
+                return False
+            if self.store is not None:
+                self.store.queue_delete(prompt_id)
+            # Compact once most of the heap is deleted entries
+            if len(self.queue) > 2 * len(self.queue_index) + 64:
+                self.queue = list(self.queue_index.values())
+                heapq.heapify(self.queue)
+            self.queue_changed()
+            return True
 
     def delete_queue_item(self, function):
         with self.mutex:
-            for x in range(len(self.queue)):
-                if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
-                    self.server.queue_updated()
-                    return True
+            for _, x in list(self.queue_index.values()):
+                if function(x):
+                    return self.delete_queue_item_by_id(x[1])
         return False
 
     def get_history(self, prompt_id=None, max_items=None, offset=-1):
+        """History entries are shared, don't modify them."""
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
                 if offset < 0 and max_items is not None:
                     offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
-            elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
+                stop = len(self.history)
+                if max_items is not None:
+                    stop = max(offset, 0) + max_items
+                return self.history.page(offset, stop)
             else:
-                return {}
+                entry = self.history.get(prompt_id)
+                if entry is None:
+                    return {}
+                return {prompt_id: entry}
 
     def wipe_history(self):
         with self.mutex:
-            self.history = {}
+            self.history.clear()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.history.remove(id_to_delete)
 
     def set_flag(self, name, data):
         with self.mutex:
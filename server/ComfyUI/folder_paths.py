@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import os
 import time
+import hashlib
+import threading
 import mimetypes
 import logging
 from typing import Literal
+from collections import OrderedDict
 from collections.abc import Collection
 
 supported_pt_extensions: set[str] = {'.ckpt', '.pt', '.bin', '.pth', '.safetensors', '.pkl', '.sft'}
@@ -46,6 +49,19 @@ user_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "user
 
 filename_list_cache: dict[str, tuple[list[str], dict[str, float], float]] = {}
 
+# Directory -> (mtime_ns, sorted file names), see list_files
+directory_files_cache: dict[str, tuple[int, list[str]]] = {}
+# (path, algorithm) -> ((size, mtime_ns, inode), hex digest), see get_file_hash
+file_hash_cache: OrderedDict[tuple[str, str], tuple[tuple[int, int, int], str]] = OrderedDict()
+file_hash_cache_lock = threading.Lock()
+FILE_HASH_CACHE_SIZE = 100000
+
+# Next free counter of each (output folder, filename prefix), see get_save_image_path
+save_counters: dict[tuple[str, str], int] = {}
+save_counters_lock = threading.Lock()
+# When > 0, files saved with get_save_image_path(..., count=N) go into subfolders of this many files each
+output_shard_size = 0
+
 class CacheHelper:
     """
     Helper class for managing file list cache data.
@@ -103,6 +119,10 @@ def set_input_directory(input_dir: str) -> None:
     global input_directory
     input_directory = input_dir
 
+def set_output_shard_size(shard_size: int) -> None:
+    global output_shard_size
+    output_shard_size = shard_size
+
 def get_output_directory() -> str:
     global output_directory
     return output_directory
@@ -288,6 +308,41 @@ def get_full_path_or_raise(folder_name: str, filename: str) -> str:
     return full_path
 
 
+def list_files(directory: str) -> list[str]:
+    """Sorted names of the files (not folders) in directory. The listing is cached until the directory's mtime changes,
+    which happens whenever a file is added, removed or renamed in it. Don't modify the returned list."""
+    mtime = os.stat(directory).st_mtime_ns
+    cached = directory_files_cache.get(directory, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with os.scandir(directory) as it:
+        files = sorted(entry.name for entry in it if entry.is_file())
+    directory_files_cache[directory] = (mtime, files)
+    return files
+
+def get_file_hash(path: str, algorithm: str = "sha256") -> str:
+    """Hex digest of the file's contents. The digest is reused as long as the file's size, mtime and inode are
+    unchanged, so unchanged files are only read once."""
+    st = os.stat(path)
+    fingerprint = (st.st_size, st.st_mtime_ns, st.st_ino)
+    key = (path, algorithm)
+    with file_hash_cache_lock:
+        cached = file_hash_cache.get(key, None)
+        if cached is not None and cached[0] == fingerprint:
+            file_hash_cache.move_to_end(key)
+            return cached[1]
+    m = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            m.update(chunk)
+    digest = m.digest().hex()
+    with file_hash_cache_lock:
+        file_hash_cache[key] = (fingerprint, digest)
+        file_hash_cache.move_to_end(key)
+        while len(file_hash_cache) > FILE_HASH_CACHE_SIZE:
+            file_hash_cache.popitem(last=False)
+    return digest
+
 def get_filename_list_(folder_name: str) -> tuple[list[str], dict[str, float], float]:
     folder_name = map_legacy(folder_name)
     global folder_names_and_paths
@@ -337,7 +392,15 @@ def get_filename_list(folder_name: str) -> list[str]:
     cache_helper.set(folder_name, out)
     return list(out[0])
 
-def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, image_height=0) -> tuple[str, str, int, str, str]:
+def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, image_height=0, count: int | None=None) -> tuple[str, str, int, str, str]:
+    """Returns the folder and counter to save files named {filename}_{counter:05}_... with.
+
+    Pass the number of files that will be saved as count to reserve counter..counter+count-1. The output folder is
+    then only listed the first time a prefix is used in this process, later calls take the next counter from memory.
+    Without count the folder is listed every time. With count and an output shard size, the files go into subfolders
+    named {filename}.{shard:05} of output_shard_size files each, which are included in the returned subfolder. A batch
+    that would cross a shard boundary starts at the next shard, only a batch larger than a shard overfills its shard.
+    """
     def map_filename(filename: str) -> tuple[int, str]:
         prefix_len = len(os.path.basename(filename_prefix))
         prefix = filename[:prefix_len + 1]
@@ -359,6 +422,23 @@ def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, im
         input = input.replace("%second%", str(now.tm_sec).zfill(2))
         return input
 
+    def scan_counter(folder: str) -> int:
+        try:
+            names = os.listdir(folder)
+        except FileNotFoundError:
+            os.makedirs(folder, exist_ok=True)
+            return 1
+        try:
+            counter = max(filter(lambda a: os.path.normcase(a[1][:-1]) == os.path.normcase(filename) and a[1][-1] == "_", map(map_filename, names)))[0] + 1
+        except ValueError:
+            counter = 1
+        # The newest files of a sharded prefix are in its last shard
+        shard_prefix = os.path.normcase(filename) + "."
+        shards = [int(name[len(shard_prefix):]) for name in names if os.path.normcase(name).startswith(shard_prefix) and name[len(shard_prefix):].isdigit()]
+        if len(shards) > 0:
+            counter = max(counter, scan_counter(os.path.join(folder, "{}.{:05}".format(filename, max(shards)))))
+        return counter
+
     if "%" in filename_prefix:
         filename_prefix = compute_vars(filename_prefix, image_width, image_height)
 
@@ -375,11 +455,23 @@ def get_save_image_path(filename_prefix: str, output_dir: str, image_width=0, im
         logging.error(err)
         raise Exception(err)
 
-    try:
-        counter = max(filter(lambda a: os.path.normcase(a[1][:-1]) == os.path.normcase(filename) and a[1][-1] == "_", map(map_filename, os.listdir(full_output_folder))))[0] + 1
-    except ValueError:
-        counter = 1
-    except FileNotFoundError:
+    key = (os.path.normcase(os.path.abspath(full_output_folder)), os.path.normcase(filename))
+    with save_counters_lock:
+        if count is None:
+            counter = max(scan_counter(full_output_folder), save_counters.get(key, 1))
+            save_counters[key] = counter + 1
+        else:
+            counter = save_counters.get(key, None)
+            if counter is None:
+                counter = scan_counter(full_output_folder)
+            if output_shard_size > 0 and (counter - 1) % output_shard_size != 0 and (counter - 1) // output_shard_size != (counter + count - 2) // output_shard_size:
+                # The batch would cross into the next shard, start it there instead
+                counter = ((counter - 1) // output_shard_size + 1) * output_shard_size + 1
+            save_counters[key] = counter + count
+
+    if count is not None and output_shard_size > 0:
+        shard = "{}.{:05}".format(filename, (counter - 1) // output_shard_size)
+        full_output_folder = os.path.join(full_output_folder, shard)
+        subfolder = os.path.join(subfolder, shard)
         os.makedirs(full_output_folder, exist_ok=True)
-        counter = 1
     return full_output_folder, filename, counter, subfolder, filename_prefix
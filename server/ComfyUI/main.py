@@ -35,6 +35,9 @@ def apply_custom_paths():
         logging.info(f"Setting output directory to: {output_dir}")
         folder_paths.set_output_directory(output_dir)
 
+    if args.output_shard_size > 0:
+        folder_paths.set_output_shard_size(args.output_shard_size)
+
     # These are the default folders that checkpoints, clip and vae models will be saved to when using CheckpointSave, etc.. nodes
     folder_paths.add_model_folder_path("checkpoints", os.path.join(folder_paths.get_output_directory(), "checkpoints"))
     folder_paths.add_model_folder_path("clip", os.path.join(folder_paths.get_output_directory(), "clip"))
@@ -130,6 +133,8 @@ if args.windows_standalone_build:
 import comfy.utils
 
 import execution
+import comfy_execution.prompt_store
+import comfy_execution.scheduling
 import server
 from server import BinaryEventTypes
 import nodes
@@ -146,9 +151,10 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
-def prompt_worker(q, server):
+def prompt_worker(q, server, executors):
     current_time: float = 0.0
     e = execution.PromptExecutor(server, lru_size=args.cache_lru)
+    executors.append(e)
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -160,6 +166,8 @@ def prompt_worker(q, server):
 
         queue_item = q.get(timeout=timeout)
         if queue_item is not None:
+            if e.reset_requested:
+                e.reset()
             item, item_id = queue_item
             execution_start_time = time.perf_counter()
             prompt_id = item[1]
@@ -184,11 +192,17 @@ def prompt_worker(q, server):
         free_memory = flags.get("free_memory", False)
 
         if flags.get("unload_models", free_memory):
-            comfy.model_management.unload_all_models()
+            with comfy.model_management.device_lock:
+                comfy.model_management.unload_all_models()
             need_gc = True
             last_gc_collect = 0
 
         if free_memory:
+            # The other workers reset their caches before their next prompt
+            for executor in executors:
+                executor.reset_requested = True
+
+        if e.reset_requested:
             e.reset()
             need_gc = True
             last_gc_collect = 0
@@ -242,7 +256,11 @@ if __name__ == "__main__":
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
-    q = execution.PromptQueue(server)
+    prompt_store = None
+    if args.queue_db is not None:
+        prompt_store = comfy_execution.prompt_store.PromptStore(args.queue_db, execution.MAXIMUM_HISTORY_SIZE)
+    scheduler = comfy_execution.scheduling.create_scheduler(args.scheduler, args.scheduler_weights)
+    q = execution.PromptQueue(server, prompt_store, scheduler, workers=max(args.prompt_workers, 1))
 
     nodes.init_extra_nodes(init_custom_nodes=not args.disable_all_custom_nodes)
 
@@ -251,7 +269,9 @@ if __name__ == "__main__":
     server.add_routes()
     hijack_progress(server)
 
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
+    executors = []
+    for i in range(max(args.prompt_workers, 1)):
+        threading.Thread(target=prompt_worker, name="prompt_worker_{}".format(i), daemon=True, args=(q, server, executors)).start()
 
     if args.quick_test_for_ci:
         exit(0)
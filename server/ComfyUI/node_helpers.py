@@ -1,4 +1,8 @@
 import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
 
 from comfy.cli_args import args
 
@@ -35,3 +39,22 @@ def hasher():
         "sha512": hashlib.sha512
     }
     return hashfuncs[args.default_hashing_function]
+
+def images_to_uint8(images):
+    """IMAGE batch (floats in 0..1) to a uint8 numpy array. Converted on the images' device, so only the uint8 pixels
+    are copied to the host."""
+    return torch.clamp(images * 255.0, 0, 255).to(torch.uint8).cpu().numpy()
+
+image_encode_executor = None
+
+def map_image_encode(fn, items):
+    """list(map(fn, items)), with the items encoded on parallel threads. PIL releases the GIL while it encodes."""
+    global image_encode_executor
+    threads = args.image_encode_threads
+    if threads is None:
+        threads = min(8, os.cpu_count() or 1)
+    if len(items) <= 1 or threads <= 1:
+        return list(map(fn, items))
+    if image_encode_executor is None:
+        image_encode_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image_encode")
+    return list(image_encode_executor.map(fn, items))
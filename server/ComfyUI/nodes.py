@@ -4,12 +4,12 @@ import torch
 import os
 import sys
 import json
-import hashlib
 import traceback
 import math
 import time
 import random
 import logging
+from io import BytesIO
 
 from PIL import Image, ImageOps, ImageSequence
 from PIL.PngImagePlugin import PngInfo
@@ -25,6 +25,7 @@ import comfy.sample
 import comfy.sd
 import comfy.utils
 import comfy.controlnet
+import comfy.conditioning_cache
 from comfy.comfy_types import IO, ComfyNodeABC, InputTypeDict
 
 import comfy.clip_vision
@@ -41,10 +42,12 @@ import node_helpers
 def before_node_execution():
     comfy.model_management.throw_exception_if_processing_interrupted()
 
-def interrupt_processing(value=True):
-    comfy.model_management.interrupt_current_processing(value)
+def interrupt_processing(value=True, prompt_id=None):
+    comfy.model_management.interrupt_current_processing(value, prompt_id=prompt_id)
 
 MAX_RESOLUTION=16384
+# What fits in the APP1 segment of a JPEG file, which holds its EXIF data
+JPEG_MAX_EXIF_BYTES = 65533
 
 class CLIPTextEncode(ComfyNodeABC):
     @classmethod
@@ -64,7 +67,7 @@ class CLIPTextEncode(ComfyNodeABC):
 
     def encode(self, clip, text):
         tokens = clip.tokenize(text)
-        return (clip.encode_from_tokens_scheduled(tokens), )
+        return (comfy.conditioning_cache.encode_from_tokens_scheduled(clip, tokens), )
         
 
 class ConditioningCombine:
@@ -441,13 +444,14 @@ class SaveLatent:
                 }
     RETURN_TYPES = ()
     FUNCTION = "save"
+    EXECUTION_STAGE = "cpu"
 
     OUTPUT_NODE = True
 
     CATEGORY = "_for_testing"
 
     def save(self, samples, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir)
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, count=1)
 
         # support save metadata for latent sharing
         prompt_info = ""
@@ -483,14 +487,14 @@ class SaveLatent:
 class LoadLatent:
     @classmethod
     def INPUT_TYPES(s):
-        input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f)) and f.endswith(".latent")]
-        return {"required": {"latent": [sorted(files), ]}, }
+        files = [f for f in folder_paths.list_files(folder_paths.get_input_directory()) if f.endswith(".latent")]
+        return {"required": {"latent": [files, ]}, }
 
     CATEGORY = "_for_testing"
 
     RETURN_TYPES = ("LATENT", )
     FUNCTION = "load"
+    EXECUTION_STAGE = "cpu"
 
     def load(self, latent):
         latent_path = folder_paths.get_annotated_filepath(latent)
@@ -503,11 +507,7 @@ class LoadLatent:
 
     @classmethod
     def IS_CHANGED(s, latent):
-        image_path = folder_paths.get_annotated_filepath(latent)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_hash(folder_paths.get_annotated_filepath(latent))
 
     @classmethod
     def VALIDATE_INPUTS(s, latent):
@@ -1537,6 +1537,13 @@ class KSamplerAdvanced:
         return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image, denoise=denoise, disable_noise=disable_noise, start_step=start_at_step, last_step=end_at_step, force_full_denoise=force_full_denoise)
 
 class SaveImage:
+    FORMATS = {
+        # format: (PIL format, file extension)
+        "png": ("PNG", "png"),
+        "webp": ("WEBP", "webp"),
+        "jpeg": ("JPEG", "jpg"),
+    }
+
     def __init__(self):
         self.output_dir = folder_paths.get_output_directory()
         self.type = "output"
@@ -1550,47 +1557,104 @@ class SaveImage:
                 "images": ("IMAGE", {"tooltip": "The images to save."}),
                 "filename_prefix": ("STRING", {"default": "ComfyUI", "tooltip": "The prefix for the file to save. This may include formatting information such as %date:yyyy-MM-dd% or %Empty Latent Image.width% to include values from nodes."})
             },
+            "optional": {
+                "format": (list(s.FORMATS.keys()), {"default": "png", "tooltip": "png and webp are lossless, jpeg is the fastest to save."}),
+                "compress_level": ("INT", {"default": 4, "min": 0, "max": 9, "tooltip": "PNG compression level. Lower levels save faster but make larger files."}),
+                "quality": ("INT", {"default": 95, "min": 1, "max": 100, "tooltip": "JPEG quality."}),
+                "save_metadata": ("BOOLEAN", {"default": True, "tooltip": "Embed the prompt and workflow in the images."}),
+                "send_to_client": ("BOOLEAN", {"default": False, "tooltip": "Also send the saved files to the client that queued the prompt as binary websocket messages, so it doesn't have to download them."}),
+            },
             "hidden": {
-                "prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"
+                "prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO", "unique_id": "UNIQUE_ID"
             },
         }
 
     RETURN_TYPES = ()
     FUNCTION = "save_images"
+    EXECUTION_STAGE = "cpu"
 
     OUTPUT_NODE = True
 
     CATEGORY = "image"
     DESCRIPTION = "Saves the input images to your ComfyUI output directory."
 
-    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
+    def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None, format="png", compress_level=None, quality=95, save_metadata=True, send_to_client=False, unique_id=None):
         filename_prefix += self.prefix_append
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
-        results = list()
-        for (batch_number, image) in enumerate(images):
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    metadata.add_text("prompt", json.dumps(prompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
-            filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-            file = f"{filename_with_batch_num}_{counter:05}_.png"
-            img.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=self.compress_level)
-            results.append({
-                "filename": file,
-                "subfolder": subfolder,
-                "type": self.type
-            })
-            counter += 1
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0], count=len(images))
+        if compress_level is None:
+            compress_level = self.compress_level
+        pil_format, extension = self.FORMATS[format]
 
+        # Built once for the whole batch
+        metadata = None
+        if save_metadata and not args.disable_metadata:
+            texts = {}
+            if prompt is not None:
+                texts["prompt"] = json.dumps(prompt)
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    texts[x] = json.dumps(extra_pnginfo[x])
+            if pil_format == "PNG":
+                metadata = PngInfo()
+                for k, v in texts.items():
+                    metadata.add_text(k, v)
+            else:
+                # Same EXIF layout as SaveAnimatedWEBP
+                metadata = Image.Exif()
+                if "prompt" in texts:
+                    metadata[0x0110] = "prompt:{}".format(texts.pop("prompt"))
+                inital_exif = 0x010f
+                for k, v in texts.items():
+                    metadata[inital_exif] = "{}:{}".format(k, v)
+                    inital_exif -= 1
+                if pil_format == "JPEG" and len(metadata.tobytes()) > JPEG_MAX_EXIF_BYTES:
+                    # JPEG keeps EXIF in a single APP1 segment, which large workflows don't fit in
+                    logging.warning("The metadata is too large for JPEG EXIF ({} bytes), saving the images without it.".format(len(metadata.tobytes())))
+                    metadata = None
+
+        save_args = {"PNG": {"pnginfo": metadata, "compress_level": compress_level},
+                     "WEBP": {"exif": metadata, "lossless": True, "method": 0},
+                     "JPEG": {"exif": metadata, "quality": quality}}[pil_format]
+        if metadata is None:
+            save_args.pop("pnginfo", None)
+            save_args.pop("exif", None)
+
+        pixels = node_helpers.images_to_uint8(images)
+        files = [f"{filename.replace('%batch_num%', str(batch_number))}_{counter + batch_number:05}_.{extension}" for batch_number in range(len(pixels))]
+
+        def save(batch_number):
+            img = Image.fromarray(pixels[batch_number])
+            if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+                # JPEG has no alpha channel
+                img = img.convert("RGB")
+            path = os.path.join(full_output_folder, files[batch_number])
+            if not send_to_client:
+                img.save(path, format=pil_format, **save_args)
+                return None
+            # Encoded once, for the file and the websocket message
+            buffer = BytesIO()
+            img.save(buffer, format=pil_format, **save_args)
+            with open(path, "wb") as f:
+                f.write(buffer.getbuffer())
+            return buffer.getvalue()
+
+        encoded = node_helpers.map_image_encode(save, range(len(pixels)))
+        results = [{"filename": file, "subfolder": subfolder, "type": self.type} for file in files]
+        if send_to_client:
+            from server import BinaryEventTypes, PromptServer, encode_output_image
+            server = PromptServer.instance
+            for (batch_number, image_bytes) in enumerate(encoded):
+                message = encode_output_image(server.last_prompt_id, unique_id, batch_number, format, image_bytes, **results[batch_number])
+                server.send_sync(BinaryEventTypes.OUTPUT_IMAGE, message, server.client_id)
         return { "ui": { "images": results } }
 
+    @classmethod
+    def IS_CHANGED(s, send_to_client=False, **kwargs):
+        if send_to_client:
+            # Send the images even if the output is cached from an earlier prompt
+            return float("NaN")
+        return False
+
 class PreviewImage(SaveImage):
     def __init__(self):
         self.output_dir = folder_paths.get_temp_directory()
@@ -1602,22 +1666,28 @@ class PreviewImage(SaveImage):
     def INPUT_TYPES(s):
         return {"required":
                     {"images": ("IMAGE", ), },
+                "optional": {
+                    "format": (list(s.FORMATS.keys()), {"default": "png", "tooltip": "png and webp are lossless, jpeg is the fastest to save."}),
+                    "compress_level": ("INT", {"default": 1, "min": 0, "max": 9, "tooltip": "PNG compression level. Lower levels save faster but make larger files."}),
+                    "quality": ("INT", {"default": 95, "min": 1, "max": 100, "tooltip": "JPEG quality."}),
+                    "save_metadata": ("BOOLEAN", {"default": True, "tooltip": "Embed the prompt and workflow in the images."}),
+                },
                 "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
                 }
 
 class LoadImage:
     @classmethod
     def INPUT_TYPES(s):
-        input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = folder_paths.list_files(folder_paths.get_input_directory())
         return {"required":
-                    {"image": (sorted(files), {"image_upload": True})},
+                    {"image": (files, {"image_upload": True})},
                 }
 
     CATEGORY = "image"
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
+    EXECUTION_STAGE = "cpu"
     def load_image(self, image):
         image_path = folder_paths.get_annotated_filepath(image)
         
@@ -1664,11 +1734,7 @@ class LoadImage:
 
     @classmethod
     def IS_CHANGED(s, image):
-        image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_hash(folder_paths.get_annotated_filepath(image))
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1681,10 +1747,9 @@ class LoadImageMask:
     _color_channels = ["alpha", "red", "green", "blue"]
     @classmethod
     def INPUT_TYPES(s):
-        input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+        files = folder_paths.list_files(folder_paths.get_input_directory())
         return {"required":
-                    {"image": (sorted(files), {"image_upload": True}),
+                    {"image": (files, {"image_upload": True}),
                      "channel": (s._color_channels, ), }
                 }
 
@@ -1692,6 +1757,7 @@ class LoadImageMask:
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
+    EXECUTION_STAGE = "cpu"
     def load_image(self, image, channel):
         image_path = folder_paths.get_annotated_filepath(image)
         i = node_helpers.pillow(Image.open, image_path)
@@ -1713,11 +1779,7 @@ class LoadImageMask:
 
     @classmethod
     def IS_CHANGED(s, image, channel):
-        image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        return m.digest().hex()
+        return folder_paths.get_file_hash(folder_paths.get_annotated_filepath(image))
 
     @classmethod
     def VALIDATE_INPUTS(s, image):
@@ -1738,6 +1800,7 @@ class ImageScale:
                               "crop": (s.crop_methods,)}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    EXECUTION_STAGE = "cpu"
 
     CATEGORY = "image/upscaling"
 
@@ -1765,6 +1828,7 @@ class ImageScaleBy:
                               "scale_by": ("FLOAT", {"default": 1.0, "min": 0.01, "max": 8.0, "step": 0.01}),}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "upscale"
+    EXECUTION_STAGE = "cpu"
 
     CATEGORY = "image/upscaling"
 
@@ -1784,6 +1848,7 @@ class ImageInvert:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "invert"
+    EXECUTION_STAGE = "cpu"
 
     CATEGORY = "image"
 
@@ -1799,6 +1864,7 @@ class ImageBatch:
 
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "batch"
+    EXECUTION_STAGE = "cpu"
 
     CATEGORY = "image"
 
@@ -1821,6 +1887,7 @@ class EmptyImage:
                               }}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "generate"
+    EXECUTION_STAGE = "cpu"
 
     CATEGORY = "image"
 
@@ -1847,6 +1914,7 @@ class ImagePadForOutpaint:
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "expand_image"
+    EXECUTION_STAGE = "cpu"
 
     CATEGORY = "image"
 
@@ -2189,6 +2257,8 @@ def init_builtin_extra_nodes():
         "nodes_lt.py",
         "nodes_hooks.py",
         "nodes_load_3d.py",
+        "nodes_websocket_image.py",
+        "nodes_sample_batch.py",
     ]
 
     import_failed = []
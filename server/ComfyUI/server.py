@@ -1,6 +1,7 @@
 import os
 import sys
 import asyncio
+import threading
 import traceback
 
 import nodes
@@ -11,6 +12,8 @@ import urllib
 import json
 import glob
 import struct
+import collections
+import math
 import ssl
 import socket
 import ipaddress
@@ -26,16 +29,99 @@ import mimetypes
 from comfy.cli_args import args
 import comfy.utils
 import comfy.model_management
+import comfy.conditioning_cache
+import comfy.patched_weight_cache
 import node_helpers
 from app.frontend_management import FrontendManager
 from app.user_manager import UserManager
 from app.model_manager import ModelFileManager
 from typing import Optional
 from api_server.routes.internal.internal_routes import InternalRoutes
+from comfy_execution.scheduling import DEFAULT_PRIORITY_CLASS, PRIORITY_CLASSES
 
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
     UNENCODED_PREVIEW_IMAGE = 2
+    OUTPUT_IMAGE = 3
+
+def encode_output_image(prompt_id, node_id, index, image_format, image_bytes, **extra):
+    # Payload of a BinaryEventTypes.OUTPUT_IMAGE message:
+    # 4 byte big endian header length, utf-8 json header, encoded image bytes
+    header = json.dumps({"prompt_id": prompt_id, "node": node_id, "index": index, "format": image_format, **extra}).encode("utf-8")
+    return struct.pack(">I", len(header)) + header + image_bytes
+
+def transform_view_image(file, preview, channel):
+    """Re-encodes an image for /view ?preview= or ?channel=, returns (body, content type)."""
+    with Image.open(file) as img:
+        if preview is not None:
+            preview_info = preview.split(';')
+            image_format = preview_info[0]
+            if image_format not in ['webp', 'jpeg'] or 'a' in channel:
+                image_format = 'webp'
+
+            quality = 90
+            if preview_info[-1].isdigit():
+                quality = int(preview_info[-1])
+
+            if image_format in ['jpeg'] or channel == 'rgb':
+                img = img.convert("RGB")
+            buffer = BytesIO()
+            img.save(buffer, format=image_format, quality=quality)
+            return buffer.getvalue(), f'image/{image_format}'
+
+        if channel == 'rgb':
+            if img.mode == "RGBA":
+                r, g, b, a = img.split()
+                new_img = Image.merge('RGB', (r, g, b))
+            else:
+                new_img = img.convert("RGB")
+        else:
+            if img.mode == "RGBA":
+                _, _, _, a = img.split()
+            else:
+                a = Image.new('L', img.size, 255)
+
+            # alpha img
+            new_img = Image.new('RGBA', img.size)
+            new_img.putalpha(a)
+
+        buffer = BytesIO()
+        new_img.save(buffer, format='PNG')
+        return buffer.getvalue(), 'image/png'
+
+class ViewTransformCache:
+    """LRU of /view preview and channel transforms, bounded by the size of the encoded images.
+
+    Keyed by the file's path, size and modification time and the transform, so overwritten files are encoded again.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, file, preview, channel):
+        stat = os.stat(file)
+        key = (file, stat.st_size, stat.st_mtime_ns, preview, channel)
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        entry = transform_view_image(file, preview, channel)
+        if len(entry[0]) <= self.max_bytes:
+            self.entries[key] = entry
+            self.size += len(entry[0])
+            while self.size > self.max_bytes:
+                _, (body, _) = self.entries.popitem(last=False)
+                self.size -= len(body)
+        return entry
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries), "bytes": self.size}
 
 async def send_socket_catch_exception(function, message):
     try:
@@ -144,6 +230,12 @@ def create_origin_only_middleware():
 
     return origin_only_middleware
 
+class ExecutionState:
+    def __init__(self):
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+
 class PromptServer():
     def __init__(self, loop):
         PromptServer.instance = self
@@ -160,6 +252,7 @@ class PromptServer():
         self.messages = asyncio.Queue()
         self.client_session:Optional[aiohttp.ClientSession] = None
         self.number = 0
+        self.view_cache = ViewTransformCache(round(args.view_cache_size * 1024 * 1024))
 
         middlewares = [cache_control]
         if args.enable_cors_header:
@@ -178,6 +271,8 @@ class PromptServer():
         logging.info(f"[Prompt Server] web root: {self.web_root}")
         routes = web.RouteTableDef()
         self.routes = routes
+        # What each prompt worker thread is executing, see execution_state
+        self.execution_states = {}
         self.last_node_id = None
         self.client_id = None
 
@@ -200,8 +295,9 @@ class PromptServer():
                 # Send initial state to the new client
                 await self.send("status", { "status": self.get_queue_info(), 'sid': sid }, sid)
                 # On reconnect if we are the currently executing client send the current node
-                if self.client_id == sid and self.last_node_id is not None:
-                    await self.send("executing", { "node": self.last_node_id }, sid)
+                for state in list(self.execution_states.values()):
+                    if state.client_id == sid and state.last_node_id is not None:
+                        await self.send("executing", { "node": state.last_node_id }, sid)
 
                 async for msg in ws:
                     if msg.type == aiohttp.WSMsgType.ERROR:
@@ -265,18 +361,13 @@ class PromptServer():
             return type_dir, dir_type
 
         def compare_image_hash(filepath, image):
-            hasher = node_helpers.hasher()
-            
             # function to compare hashes of two images to see if it already exists, fix to #3465
             if os.path.exists(filepath):
-                a = hasher()
-                b = hasher()
-                with open(filepath, "rb") as f:
-                    a.update(f.read())
-                    b.update(image.file.read())
-                    image.file.seek(0)
-                    f.close()
-                return a.hexdigest() == b.hexdigest()
+                b = node_helpers.hasher()()
+                b.update(image.file.read())
+                image.file.seek(0)
+                # The existing file's hash is cached until it changes
+                return folder_paths.get_file_hash(filepath, args.default_hashing_function) == b.hexdigest()
             return False
 
         def image_upload(post, image_save_function=None):
@@ -403,62 +494,12 @@ class PromptServer():
                 file = os.path.join(output_dir, filename)
 
                 if os.path.isfile(file):
-                    if 'preview' in request.rel_url.query:
-                        with Image.open(file) as img:
-                            preview_info = request.rel_url.query['preview'].split(';')
-                            image_format = preview_info[0]
-                            if image_format not in ['webp', 'jpeg'] or 'a' in request.rel_url.query.get('channel', ''):
-                                image_format = 'webp'
-
-                            quality = 90
-                            if preview_info[-1].isdigit():
-                                quality = int(preview_info[-1])
-
-                            buffer = BytesIO()
-                            if image_format in ['jpeg'] or request.rel_url.query.get('channel', '') == 'rgb':
-                                img = img.convert("RGB")
-                            img.save(buffer, format=image_format, quality=quality)
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type=f'image/{image_format}',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    if 'channel' not in request.rel_url.query:
-                        channel = 'rgba'
-                    else:
-                        channel = request.rel_url.query["channel"]
-
-                    if channel == 'rgb':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                r, g, b, a = img.split()
-                                new_img = Image.merge('RGB', (r, g, b))
-                            else:
-                                new_img = img.convert("RGB")
-
-                            buffer = BytesIO()
-                            new_img.save(buffer, format='PNG')
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    elif channel == 'a':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                _, _, _, a = img.split()
-                            else:
-                                a = Image.new('L', img.size, 255)
-
-                            # alpha img
-                            alpha_img = Image.new('RGBA', img.size)
-                            alpha_img.putalpha(a)
-                            alpha_buffer = BytesIO()
-                            alpha_img.save(alpha_buffer, format='PNG')
-                            alpha_buffer.seek(0)
-
-                            return web.Response(body=alpha_buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
+                    channel = request.rel_url.query.get('channel', '')
+                    preview = request.rel_url.query.get('preview', None)
+                    if preview is not None or channel in ('rgb', 'a'):
+                        body, content_type = self.view_cache.get(file, preview, channel)
+                        return web.Response(body=body, content_type=content_type,
+                                            headers={"Content-Disposition": f"filename=\"{filename}\""})
                     else:
                         # Get content type from mimetype, defaulting to 'application/octet-stream'
                         content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -532,7 +573,11 @@ class PromptServer():
                         "torch_vram_total": torch_vram_total,
                         "torch_vram_free": torch_vram_free,
                     }
-                ]
+                ],
+                "conditioning_cache": comfy.conditioning_cache.cache.stats(),
+                "view_cache": self.view_cache.stats(),
+                "validation_cache": execution.validation_cache.stats(),
+                "patched_weight_cache": comfy.patched_weight_cache.patched_weight_cache.stats(),
             }
             return web.json_response(system_stats)
 
@@ -608,6 +653,7 @@ class PromptServer():
             current_queue = self.prompt_queue.get_current_queue()
             queue_info['queue_running'] = current_queue[0]
             queue_info['queue_pending'] = current_queue[1]
+            queue_info['expected_wait'] = {x[1]: self.prompt_queue.get_expected_wait(x[1]) for x in current_queue[1]}
             return web.json_response(queue_info)
 
         @routes.post("/prompt")
@@ -635,11 +681,30 @@ class PromptServer():
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                priority = extra_data.get("priority", DEFAULT_PRIORITY_CLASS)
+                if not isinstance(priority, str) or priority not in PRIORITY_CLASSES:
+                    error = {"type": "invalid_priority", "message": "Invalid priority", "details": "Expected one of {}".format(", ".join(PRIORITY_CLASSES)), "extra_info": {}}
+                    return web.json_response({"error": error, "node_errors": {}}, status=400)
+                deadline = extra_data.get("deadline", None)
+                if deadline is not None and (isinstance(deadline, bool) or not isinstance(deadline, (int, float)) or not math.isfinite(deadline) or deadline < 0):
+                    error = {"type": "invalid_deadline", "message": "Invalid deadline", "details": "Expected a number of seconds >= 0", "extra_info": {}}
+                    return web.json_response({"error": error, "node_errors": {}}, status=400)
+                prompt_id = str(uuid.uuid4())
+                if "prompt_id" in json_data:
+                    # Clients may choose the id, to be ready for its events before the response arrives. It has to be a
+                    # new one, or /history, /interrupt and deleting by id would act on the other prompt.
+                    prompt_id = json_data["prompt_id"]
+                    try:
+                        valid_id = isinstance(prompt_id, str) and str(uuid.UUID(prompt_id)) == prompt_id
+                    except ValueError:
+                        valid_id = False
+                    if not valid_id or self.prompt_queue.has_prompt(prompt_id):
+                        error = {"type": "invalid_prompt_id", "message": "Invalid prompt id", "details": "Expected a lowercase UUID that isn't queued or in the history", "extra_info": {}}
+                        return web.json_response({"error": error, "node_errors": {}}, status=400)
                 if valid[0]:
-                    prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
                     self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
-                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
+                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3], "expected_wait": self.prompt_queue.get_expected_wait(prompt_id)}
                     return web.json_response(response)
                 else:
                     logging.warning("invalid prompt: {}".format(valid[1]))
@@ -656,14 +721,22 @@ class PromptServer():
             if "delete" in json_data:
                 to_delete = json_data['delete']
                 for id_to_delete in to_delete:
-                    delete_func = lambda a: a[1] == id_to_delete
-                    self.prompt_queue.delete_queue_item(delete_func)
+                    self.prompt_queue.delete_queue_item_by_id(id_to_delete)
 
             return web.Response(status=200)
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            # Without a prompt_id, every running prompt is interrupted
+            prompt_id = None
+            if request.can_read_body:
+                try:
+                    json_data = await request.json()
+                except json.JSONDecodeError:
+                    json_data = {}
+                if isinstance(json_data, dict):
+                    prompt_id = json_data.get("prompt_id", None)
+            nodes.interrupt_processing(prompt_id=prompt_id)
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -722,10 +795,41 @@ class PromptServer():
             web.static('/', self.web_root),
         ])
 
+    @property
+    def execution_state(self):
+        # Each prompt worker (--prompt-workers) executes its own prompt for its own client, so the client, prompt and
+        # node being executed are tracked per thread
+        return self.execution_states.setdefault(threading.get_ident(), ExecutionState())
+
+    @property
+    def client_id(self):
+        return self.execution_state.client_id
+
+    @client_id.setter
+    def client_id(self, value):
+        self.execution_state.client_id = value
+
+    @property
+    def last_node_id(self):
+        return self.execution_state.last_node_id
+
+    @last_node_id.setter
+    def last_node_id(self, value):
+        self.execution_state.last_node_id = value
+
+    @property
+    def last_prompt_id(self):
+        return self.execution_state.last_prompt_id
+
+    @last_prompt_id.setter
+    def last_prompt_id(self, value):
+        self.execution_state.last_prompt_id = value
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
         exec_info['queue_remaining'] = self.prompt_queue.get_tasks_remaining()
+        exec_info['expected_wait'] = self.prompt_queue.get_expected_wait()
         prompt_info['exec_info'] = exec_info
         return prompt_info
 
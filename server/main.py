@@ -1,56 +1,107 @@
-from fastapi import FastAPI, Query
-import timm
+import asyncio
+from collections.abc import Coroutine
+from contextlib import asynccontextmanager
+import time
+from typing import Any
+
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from loguru import logger
 import uvicorn
 
+from redoodle_server.batching import Img2ImgBatcher
+from redoodle_server.comfyui_client import ComfyUIClient
 from redoodle_server.constants import DEFAULT_NUM_GUESS_IMAGES
 from redoodle_server.data_model import PuzzleState
 from redoodle_server.database import create_database
-from redoodle_server.image_ai import compute_similarity_score, generate_image
-from redoodle_server.images import add_url_encoding
+from redoodle_server.images import image_media_type
+from redoodle_server.similarity import SimilarityBackend, SimilarityService
+
+STARTED_AT = time.perf_counter()
+
+# How often to check whether the client of a long running request has gone away
+DISCONNECT_POLL_SECONDS = 0.25
+# Status code used (by convention, e.g. nginx) when the client closed the connection before the response was ready
+CLIENT_CLOSED_REQUEST = 499
+# Images are addressed by the hash of their content, so a response for an image URL can be cached forever
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
 
 db = create_database()
 
-similarity_model = timm.create_model(
-    "vit_large_patch14_dinov2.lvd142m",
-    pretrained=True,
-    num_classes=0,
-)
-similarity_model = similarity_model.eval()
+# The model is loaded in the background once the server is up, see `lifespan`
+similarity = SimilarityService(SimilarityBackend())
+
+comfyui_client = ComfyUIClient()
+img2img_batcher = Img2ImgBatcher(comfyui_client)
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Subscribe to the ComfyUI websocket once for the lifetime of the server
+    await comfyui_client.start()
+    # Accept requests right away, /ready reports when scoring is available
+    similarity.start_loading()
+    logger.info(f"Accepting requests {time.perf_counter() - STARTED_AT:.2f} s after import")
+    yield
+    await comfyui_client.close()
 
 
-def convert_state(state: PuzzleState) -> PuzzleState:
-    """URL encode all the images in the state."""
-    for guess_image in state.guess_images:
-        guess_image.base64_image = add_url_encoding(guess_image.base64_image)
-    state.start_image.base64_image = add_url_encoding(state.start_image.base64_image)
-    state.goal_image.base64_image = add_url_encoding(state.goal_image.base64_image)
-    return state
+app = FastAPI(lifespan=lifespan)
+
+
+async def cancel_on_disconnect[T](request: Request, coro: Coroutine[Any, Any, T]) -> T:
+    """Run the coroutine, cancelling it if the client disconnects before it finishes.
+
+    Raises:
+        asyncio.CancelledError: If the client disconnected.
+    """
+    task = asyncio.ensure_future(coro)
+
+    async def watch_disconnect() -> None:
+        while not task.done():
+            if await request.is_disconnected():
+                task.cancel()
+                return
+            await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        return await task
+    finally:
+        watcher.cancel()
+
+
+def if_none_match_tags(header: str) -> set[str]:
+    """The entity tags listed in an If-None-Match header, without the weak `W/` prefix.
+
+    If-None-Match uses the weak comparison, so `W/"x"` matches `"x"`. The result contains `*` if any tag matches.
+    """
+    return {tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()}
 
 
 @app.get("/puzzle", response_model=PuzzleState)
 async def get_puzzle(player_id: str = Query(...)):
     """Load a new puzzle or the state of an existing puzzle the user is working on."""
-    with db.get_connection() as conn:
-        puzzle_state = db.get_puzzle(conn, player_id)
-    return convert_state(puzzle_state)
+    return await db.run(db.get_puzzle, player_id)
 
 
 @app.get("/submit_guess", response_model=PuzzleState)
-async def submit_guess(player_id: str = Query(...), guess: str = Query(...)):
+async def submit_guess(request: Request, player_id: str = Query(...), guess: str = Query(...)):
     """Submit a guess for the puzzle.
 
     - Gets the current puzzle the user is on to get the image (and num previous guesses) needed for image to image.
     - Generates the image
     - If the user is on the last guess, then we also need to generate a similarity score and return the final prompt.
+
+    Blocking work (database, similarity model) runs on bounded thread pools. Concurrent guesses from different
+    players are batched into one generation, and final images into one similarity forward pass. If the player
+    disconnects while the image is generating, the guess is dropped and not saved.
     """
     # Limit guess to 100 characters
     guess = guess[:100]
 
-    with db.get_connection() as conn:
-        puzzle: PuzzleState = db.get_puzzle(conn, player_id)
-    initial_image = puzzle.guess_images[-1].base64_image if puzzle.guess_images else puzzle.start_image.base64_image
+    puzzle: PuzzleState = await db.run(db.get_puzzle, player_id)
+    initial_image_hash = puzzle.guess_images[-1].image_hash if puzzle.guess_images else puzzle.start_image.image_hash
+    initial_image = await db.run(db.get_image, initial_image_hash)
     # If this is the first guess, set steps = 3 and the initial prompt gets added to the guess
     # Otherwise, set steps = 4 and leave the guess as is
     if len(puzzle.guess_images) == 0:
@@ -59,33 +110,61 @@ async def submit_guess(player_id: str = Query(...), guess: str = Query(...)):
     else:
         steps = 4
         modified_guess = guess
-    new_image = generate_image(initial_image, modified_guess, steps=steps)
+    try:
+        new_image = await cancel_on_disconnect(
+            request, img2img_batcher.generate(initial_image, modified_guess, steps=steps)
+        )
+    except asyncio.CancelledError:
+        if await request.is_disconnected():
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+        raise
 
-    with db.get_connection() as conn:
-        puzzle_state = db.submit_guess(conn, player_id, guess, new_image)
+    puzzle_state = await db.run_write(db.submit_guess, player_id, guess, new_image)
 
-        # Check if this is the last guess
-        if puzzle_state.guesses_submitted == DEFAULT_NUM_GUESS_IMAGES:
-            similarity_score = compute_similarity_score(initial_image, new_image, similarity_model)
-            puzzle_state.similarity_score = similarity_score
+    # Check if this is the last guess
+    if puzzle_state.guesses_submitted == DEFAULT_NUM_GUESS_IMAGES:
+        # Compare the final image with the goal image, whose embedding is precomputed
+        puzzle_state.similarity_score = await similarity.score(db, new_image, puzzle_state.goal_image.image_hash)
 
-    return convert_state(puzzle_state)
+    return puzzle_state
 
 
 @app.get("/next_puzzle", response_model=PuzzleState)
 async def next_puzzle(player_id: str = Query(...)):
     """Request the next puzzle."""
-    with db.get_connection() as conn:
-        puzzle_state = db.next_puzzle(conn, player_id)
-    return convert_state(puzzle_state)
+    return await db.run_write(db.next_puzzle, player_id)
 
 
 @app.get("/reset_puzzle", response_model=PuzzleState)
 async def reset_puzzle(player_id: str = Query(...)):
     """Reset the current puzzle to the initial state."""
-    with db.get_connection() as conn:
-        puzzle_state = db.reset_puzzle(conn, player_id)
-    return convert_state(puzzle_state)
+    return await db.run_write(db.reset_puzzle, player_id)
+
+
+@app.get("/ready")
+async def ready(response: Response):
+    """Readiness probe. Returns 503 until the similarity model is loaded."""
+    if not similarity.ready:
+        response.status_code = 503
+    return {"ready": similarity.ready, "similarity_model": similarity.ready, "comfyui": comfyui_client.connected}
+
+
+@app.get("/image/{image_hash}")
+async def get_image(request: Request, image_hash: str):
+    """Serve an image by the hash of its content, as referenced by the `image_url` of a PuzzleImage."""
+    etag = f'"{image_hash}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    match_tags = if_none_match_tags(request.headers.get("if-none-match", ""))
+    if etag in match_tags:
+        return Response(status_code=304, headers=headers)
+
+    image = await db.run(db.get_image, image_hash)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    # `*` matches any image that exists
+    if "*" in match_tags:
+        return Response(status_code=304, headers=headers)
+    return Response(content=image, media_type=image_media_type(image), headers=headers)
 
 
 if __name__ == "__main__":
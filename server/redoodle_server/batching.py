@@ -0,0 +1,141 @@
+import asyncio
+from dataclasses import dataclass, field
+import secrets
+
+from loguru import logger
+
+from redoodle_server.comfyui_client import ComfyUIClient, ComfyUIError
+from redoodle_server.constants import IMG2IMG_BATCH_WINDOW_SECONDS, IMG2IMG_MAX_BATCH_SIZE
+from redoodle_server.image_ai import (
+    IMG2IMG_BATCH_OUTPUT_NODE,
+    IMG2IMG_DENOISE,
+    build_img2img_batch_workflow,
+    generate_image,
+)
+from redoodle_server.images import image_size
+
+# Guesses can only share a sampler batch if these match: (steps, denoise, image size)
+BatchKey = tuple[int, float, tuple[int, int]]
+
+
+@dataclass
+class _PendingGuess:
+    initial_image: bytes
+    prompt: str
+    future: asyncio.Future
+
+
+@dataclass
+class BatchStats:
+    batches: int = 0
+    guesses: int = 0
+    batch_sizes: dict[int, int] = field(default_factory=dict)
+
+    @property
+    def mean_batch_size(self) -> float:
+        return self.guesses / self.batches if self.batches else 0.0
+
+
+class Img2ImgBatcher:
+    """Micro-batching scheduler for img2img guesses.
+
+    ComfyUI runs one prompt at a time, so under load each guess would otherwise be sampled at batch size 1.
+    Guesses that arrive within `window_seconds` of each other and share a BatchKey are combined into a single
+    workflow (see `build_img2img_batch_workflow`) and the resulting images are handed back to each caller.
+    A batch is sent early once it reaches `max_batch_size`. With `max_batch_size=1` this is the unbatched path.
+    """
+
+    def __init__(
+        self,
+        client: ComfyUIClient,
+        window_seconds: float = IMG2IMG_BATCH_WINDOW_SECONDS,
+        max_batch_size: int = IMG2IMG_MAX_BATCH_SIZE,
+    ) -> None:
+        self.client = client
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self.stats = BatchStats()
+        self._waiting: dict[BatchKey, list[_PendingGuess]] = {}
+        self._timers: dict[BatchKey, asyncio.TimerHandle] = {}
+        # Keeps references to running batches so they are not garbage collected
+        self._running: set[asyncio.Task] = set()
+
+    async def generate(
+        self, initial_image: bytes, prompt: str, steps: int = 3, denoise: float = IMG2IMG_DENOISE
+    ) -> bytes:
+        """Generate an image from the initial image and prompt, possibly batched with other players' guesses.
+        Cancelling the caller only drops this guess, the rest of its batch still runs. Once every caller of a batch is
+        cancelled, the batch is cancelled too, which removes its prompt from the ComfyUI queue.
+        """
+        if self.max_batch_size <= 1:
+            self._record_batch(1)
+            return await generate_image(self.client, initial_image, prompt, steps=steps, denoise=denoise)
+
+        key: BatchKey = (steps, denoise, image_size(initial_image))
+        guess = _PendingGuess(initial_image, prompt, asyncio.get_running_loop().create_future())
+        waiting = self._waiting.setdefault(key, [])
+        waiting.append(guess)
+        if len(waiting) >= self.max_batch_size:
+            self._flush(key)
+        elif len(waiting) == 1:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window_seconds, self._flush, key)
+        return await guess.future
+
+    def _flush(self, key: BatchKey) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        guesses = [guess for guess in self._waiting.pop(key, []) if not guess.future.done()]
+        if not guesses:
+            return
+        task = asyncio.create_task(self._run_batch(key, guesses))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        for guess in guesses:
+            guess.future.add_done_callback(lambda _: self._cancel_if_abandoned(task, guesses))
+
+    def _cancel_if_abandoned(self, task: asyncio.Task, guesses: list[_PendingGuess]) -> None:
+        """Cancel a running batch once nobody waits for any of its images.
+        `ComfyUIClient.run_prompt` then deletes the prompt, like it does for an unbatched guess.
+        """
+        if not task.done() and all(guess.future.cancelled() for guess in guesses):
+            task.cancel()
+
+    async def _run_batch(self, key: BatchKey, guesses: list[_PendingGuess]) -> None:
+        steps, denoise, _ = key
+        self._record_batch(len(guesses))
+        try:
+            if len(guesses) == 1:
+                images = [
+                    await generate_image(self.client, guesses[0].initial_image, guesses[0].prompt, steps, denoise)
+                ]
+            else:
+                workflow = build_img2img_batch_workflow(
+                    initial_images=[guess.initial_image for guess in guesses],
+                    prompts=[guess.prompt for guess in guesses],
+                    seeds=[secrets.randbits(32) for _ in guesses],
+                    steps=steps,
+                    denoise=denoise,
+                )
+                result = await self.client.run_prompt(workflow)
+                images = result.images.get(IMG2IMG_BATCH_OUTPUT_NODE, [])
+        except Exception as e:
+            logger.error(f"img2img batch of {len(guesses)} failed: {e}")
+            for guess in guesses:
+                if not guess.future.done():
+                    guess.future.set_exception(e)
+            return
+
+        for i, guess in enumerate(guesses):
+            if guess.future.done():
+                continue
+            if i < len(images):
+                guess.future.set_result(images[i])
+            else:
+                # E.g. the websocket reconnected while the prompt ran, images sent meanwhile are not in the history
+                guess.future.set_exception(ComfyUIError(f"ComfyUI did not send image {i} of the batch"))
+
+    def _record_batch(self, size: int) -> None:
+        self.stats.batches += 1
+        self.stats.guesses += size
+        self.stats.batch_sizes[size] = self.stats.batch_sizes.get(size, 0) + 1
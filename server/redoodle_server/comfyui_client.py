@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+import json
+import struct
+from typing import Any
+import uuid
+
+import httpx
+from loguru import logger
+import websockets
+
+from redoodle_server.constants import (
+    COMFY_UI_MAX_CONNECTIONS,
+    COMFY_UI_MAX_KEEPALIVE_CONNECTIONS,
+    COMFY_UI_PRIORITY,
+    COMFY_UI_PROMPT_TIMEOUT_SECONDS,
+    COMFY_UI_URL,
+)
+
+# How long to wait before trying to reconnect to the ComfyUI websocket after it drops.
+WS_RECONNECT_DELAY_SECONDS = 0.5
+# Binary websocket event sent by the ComfyUI `SaveImageWebsocket` node (`BinaryEventTypes.OUTPUT_IMAGE`)
+OUTPUT_IMAGE_EVENT = 3
+
+
+@dataclass
+class PromptResult:
+    """The result of a finished ComfyUI prompt."""
+
+    # UI outputs of each output node, keyed by node id (the same as `outputs` in `/history`)
+    outputs: dict[str, Any] = field(default_factory=dict)
+    # Encoded images sent over the websocket by `SaveImageWebsocket` nodes, keyed by node id, in batch order
+    images: dict[str, list[bytes]] = field(default_factory=dict)
+
+
+class ComfyUIError(RuntimeError):
+    """Raised when ComfyUI reports that a prompt failed or was interrupted."""
+
+
+class ComfyUIClient:
+    """Client for queueing prompts on ComfyUI and waiting for them to finish.
+
+    Instead of polling `/history/{prompt_id}`, a single websocket connection to ComfyUI's `/ws` endpoint is shared
+    by every in-flight prompt. ComfyUI sends `executed` events with each output node's result and an `executing`
+    event with `node: None` once a prompt is done, which resolves the future of the matching prompt_id.
+    HTTP requests go through one keep-alive connection pool shared by all callers.
+    """
+
+    def __init__(
+        self,
+        base_url: str = COMFY_UI_URL,
+        timeout: float = COMFY_UI_PROMPT_TIMEOUT_SECONDS,
+        priority: str = COMFY_UI_PRIORITY,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.ws_url = self.base_url.replace("http", "ws", 1) + "/ws"
+        self.timeout = timeout
+        self.priority = priority
+        self.client_id = uuid.uuid4().hex
+        self._http: httpx.AsyncClient | None = None
+        self._listener: asyncio.Task | None = None
+        self._connected = asyncio.Event()
+        # prompt_id -> future resolved with the PromptResult of the prompt
+        self._pending: dict[str, asyncio.Future] = {}
+        # prompt_id -> outputs and images received so far
+        self._results: dict[str, PromptResult] = {}
+        # Keeps references to fire-and-forget cleanup tasks so they are not garbage collected
+        self._background: set[asyncio.Task] = set()
+
+    @property
+    def connected(self) -> bool:
+        """Whether the websocket to ComfyUI is currently connected."""
+        return self._connected.is_set()
+
+    async def start(self) -> None:
+        """Open the HTTP client and start the shared websocket listener."""
+        if self._listener is not None:
+            return
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            limits=httpx.Limits(
+                max_connections=COMFY_UI_MAX_CONNECTIONS,
+                max_keepalive_connections=COMFY_UI_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=self.timeout,
+        )
+        self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        """Stop the websocket listener and fail any prompts still waiting on it."""
+        if self._listener is not None:
+            self._listener.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._listener
+            self._listener = None
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ComfyUIError("ComfyUI client was closed"))
+        self._pending.clear()
+        self._results.clear()
+
+    async def queue_prompt(self, prompt: dict) -> str:
+        """Queue a prompt (API format workflow) on ComfyUI and return its prompt_id."""
+        if self._http is None:
+            await self.start()
+        # Make sure the websocket is subscribed before the prompt can finish so no events are missed.
+        await asyncio.wait_for(self._connected.wait(), timeout=self.timeout)
+        # The priority class and deadline are used by ComfyUI's fair scheduler and ignored otherwise
+        extra_data = {"priority": self.priority, "deadline": self.timeout}
+        # Chosen here and registered before queueing, so the listener knows the prompt even if it finishes before the
+        # response arrives. Events of prompts that are not pending are ignored.
+        prompt_id = str(uuid.uuid4())
+        self._future_for(prompt_id)
+        try:
+            resp = await self._http.post(
+                "/prompt",
+                json={"prompt": prompt, "prompt_id": prompt_id, "client_id": self.client_id, "extra_data": extra_data},
+            )
+            resp.raise_for_status()
+        except BaseException:
+            self._pending.pop(prompt_id, None)
+            raise
+        return resp.json()["prompt_id"]
+
+    async def wait_for_result(self, prompt_id: str) -> PromptResult:
+        """Wait until ComfyUI finishes executing the prompt and return its outputs."""
+        future = self._future_for(prompt_id)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        finally:
+            self._pending.pop(prompt_id, None)
+            self._results.pop(prompt_id, None)
+
+    async def run_prompt(self, prompt: dict) -> PromptResult:
+        """Queue a prompt and wait for its outputs.
+        If the caller is cancelled (e.g. the player disconnected) or times out, the prompt is removed from the ComfyUI
+        queue so it does not use GPU time.
+        """
+        prompt_id = await self.queue_prompt(prompt)
+        try:
+            return await self.wait_for_result(prompt_id)
+        except (asyncio.CancelledError, TimeoutError):
+            task = asyncio.create_task(self.delete_prompt(prompt_id))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+            raise
+
+    async def delete_prompt(self, prompt_id: str) -> None:
+        """Remove a prompt from the ComfyUI queue if it has not started executing yet."""
+        try:
+            await self._http.post("/queue", json={"delete": [prompt_id]})
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to delete prompt {prompt_id} from the ComfyUI queue: {e}")
+
+    def _future_for(self, prompt_id: str) -> asyncio.Future:
+        """Get the future of a pending prompt_id, registering it if it is not pending yet."""
+        future = self._pending.get(prompt_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[prompt_id] = future
+        return future
+
+    async def _listen(self) -> None:
+        """Receive events from the ComfyUI websocket, reconnecting if the connection drops."""
+        while True:
+            try:
+                async with websockets.connect(f"{self.ws_url}?clientId={self.client_id}", max_size=None) as ws:
+                    self._connected.set()
+                    await self._recover_pending()
+                    async for message in ws:
+                        if isinstance(message, str):
+                            self._handle_message(json.loads(message))
+                        else:
+                            self._handle_binary_message(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket disconnected: {e}")
+            self._connected.clear()
+            await asyncio.sleep(WS_RECONNECT_DELAY_SECONDS)
+
+    async def _recover_pending(self) -> None:
+        """After (re)connecting, check the history for prompts that finished while the websocket was down."""
+        for prompt_id, future in list(self._pending.items()):
+            if future.done():
+                continue
+            resp = await self._http.get(f"/history/{prompt_id}")
+            history = resp.json()
+            if prompt_id in history:
+                self._finish(prompt_id, history[prompt_id])
+
+    def _handle_message(self, message: dict) -> None:
+        event = message.get("type")
+        data = message.get("data", {})
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None or prompt_id not in self._pending:
+            # Another client's prompt, or one whose caller stopped waiting
+            return
+
+        if event == "executed":
+            self._results.setdefault(prompt_id, PromptResult()).outputs[data["node"]] = data["output"]
+        elif event == "executing" and data.get("node") is None:
+            future = self._pending[prompt_id]
+            if not future.done():
+                future.set_result(self._results.pop(prompt_id, PromptResult()))
+        elif event == "execution_error":
+            self._fail(prompt_id, f"{data.get('exception_type')}: {data.get('exception_message')}")
+        elif event == "execution_interrupted":
+            self._fail(prompt_id, "Prompt execution was interrupted")
+
+    def _handle_binary_message(self, message: bytes) -> None:
+        """Collect output images. Other binary events (sampling previews) are not needed here."""
+        (event,) = struct.unpack(">I", message[:4])
+        if event != OUTPUT_IMAGE_EVENT:
+            return
+        (header_length,) = struct.unpack(">I", message[4:8])
+        header = json.loads(message[8 : 8 + header_length])
+        if header["prompt_id"] not in self._pending:
+            return
+        result = self._results.setdefault(header["prompt_id"], PromptResult())
+        result.images.setdefault(header["node"], []).append(bytes(message[8 + header_length :]))
+
+    def _finish(self, prompt_id: str, history_item: dict) -> None:
+        future = self._pending.get(prompt_id)
+        if future is None or future.done():
+            return
+        status = history_item.get("status") or {}
+        if status.get("status_str") == "error":
+            future.set_exception(ComfyUIError(f"Prompt {prompt_id} failed"))
+        else:
+            # Images sent while the websocket was down are lost, only the UI outputs can be recovered
+            future.set_result(PromptResult(outputs=history_item.get("outputs", {})))
+
+    def _fail(self, prompt_id: str, reason: str) -> None:
+        future = self._pending.get(prompt_id)
+        if future is not None and not future.done():
+            future.set_exception(ComfyUIError(reason))
+        self._results.pop(prompt_id, None)
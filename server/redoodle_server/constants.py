@@ -1 +1,37 @@
+from pathlib import Path
+
 DEFAULT_NUM_GUESS_IMAGES = 3
+
+COMFY_UI_URL = "http://127.0.0.1:8188"
+# Maximum time to wait for ComfyUI to finish generating an image
+COMFY_UI_PROMPT_TIMEOUT_SECONDS = 15.0
+# Connection pool limits for the HTTP client shared by all requests to ComfyUI
+COMFY_UI_MAX_CONNECTIONS = 32
+COMFY_UI_MAX_KEEPALIVE_CONNECTIONS = 16
+# Priority class of the prompts queued by the game server when ComfyUI runs with `--scheduler fair`.
+# Guesses are "interactive" so they are not stuck behind "batch" work such as puzzle generation.
+COMFY_UI_PRIORITY = "interactive"
+
+# Number of threads for blocking work, so it does not stall the event loop
+DB_MAX_WORKERS = 4
+# SQLite connection settings. Writes are serialized on one extra thread, so the pool holds DB_MAX_WORKERS + 1
+DB_MMAP_SIZE_BYTES = 256 * 1024 * 1024
+# How long a connection waits on a lock held by another process (e.g. scripts/add_puzzles.py) before failing
+DB_BUSY_TIMEOUT_SECONDS = 5.0
+
+SIMILARITY_MAX_WORKERS = 1
+# Smaller, faster variants: "vit_base_patch14_dinov2.lvd142m", "vit_small_patch14_dinov2.lvd142m"
+SIMILARITY_MODEL_NAME = "vit_large_patch14_dinov2.lvd142m"
+# How the similarity model runs on CPU: "fp32", "bf16" (autocast) or "int8" (dynamic quantization)
+SIMILARITY_PRECISION = "fp32"
+# torch.compile the similarity model. Slower startup and a recompile for each new batch size, faster inference
+SIMILARITY_COMPILE = False
+# Pretrained weights are downloaded once and then loaded from here, so startup does not depend on the network
+SIMILARITY_WEIGHTS_DIR = Path(__file__).parent.parent / "model_weights"
+# Images waiting for the similarity model are embedded together, up to this many per forward pass
+SIMILARITY_MAX_BATCH_SIZE = 8
+
+# Guesses arriving within this window are combined into one img2img sampler batch
+IMG2IMG_BATCH_WINDOW_SECONDS = 0.05
+# Set to 1 to disable batching
+IMG2IMG_MAX_BATCH_SIZE = 4
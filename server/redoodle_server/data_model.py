@@ -1,10 +1,16 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, computed_field
 
 
 class PuzzleImage(BaseModel):
-    base64_image: str
+    image_hash: str
     prompt: str | None
 
+    @computed_field
+    @property
+    def image_url(self) -> str:
+        """Where the client can load the image from. The content at the URL never changes, so it can be cached."""
+        return f"/image/{self.image_hash}"
+
 
 class PuzzleState(BaseModel):
     start_image: PuzzleImage
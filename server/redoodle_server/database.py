@@ -1,38 +1,238 @@
+import asyncio
+from base64 import b64decode
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 from dataclasses import dataclass
+import hashlib
 from pathlib import Path
+import queue
 import sqlite3
+from typing import Any, TypeVar
 
 from loguru import logger
 
-from redoodle_server.constants import DEFAULT_NUM_GUESS_IMAGES
+from redoodle_server.constants import (
+    DB_BUSY_TIMEOUT_SECONDS,
+    DB_MAX_WORKERS,
+    DB_MMAP_SIZE_BYTES,
+    DEFAULT_NUM_GUESS_IMAGES,
+)
 from redoodle_server.data_model import PuzzleImage, PuzzleState
+from redoodle_server.puzzle_cache import CachedPuzzle, PuzzleCache, PuzzleSnapshot
+
+T = TypeVar("T")
 
 
 @dataclass
 class DBConfig:
     db_path: Path
     schema_path: Path
+    max_workers: int = DB_MAX_WORKERS
+    mmap_size: int = DB_MMAP_SIZE_BYTES
+    busy_timeout: float = DB_BUSY_TIMEOUT_SECONDS
+    journal_mode: str = "WAL"
+    # In WAL mode NORMAL is safe from corruption, only the last transactions can be lost on power loss
+    synchronous: str = "NORMAL"
+
+
+class ConnectionPool:
+    """A fixed size pool of SQLite connections, in WAL mode by default.
+
+    Connections are opened once and shared between threads, so their prepared statement caches are reused across
+    requests. With WAL, readers do not block the writer and the writer does not block readers.
+    """
+
+    def __init__(self, config: DBConfig, size: int) -> None:
+        self.config = config
+        self._connections: queue.Queue[sqlite3.Connection] = queue.Queue()
+        for _ in range(size):
+            self._connections.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.config.db_path,
+            timeout=self.config.busy_timeout,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={self.config.journal_mode}")
+        conn.execute(f"PRAGMA synchronous={self.config.synchronous}")
+        conn.execute(f"PRAGMA mmap_size={int(self.config.mmap_size)}")
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a connection, waiting for one to be returned if all are in use.
+        The transaction is committed if the block succeeds and rolled back otherwise.
+        """
+        conn = self._connections.get()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._connections.put(conn)
+
+    def close(self) -> None:
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
 
 
 class Database:
     def __init__(self, config: DBConfig) -> None:
         self.db_path = config.db_path
         self.schema_path = config.schema_path
+        self._executor = ThreadPoolExecutor(max_workers=config.max_workers, thread_name_prefix="redoodle-db")
+        # All writes go through one thread so concurrent writers never contend for the SQLite write lock
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="redoodle-db-write")
+        self._pool = ConnectionPool(config, size=config.max_workers + 1)
+        self.puzzle_cache = PuzzleCache()
         self._init_db()
 
     def _init_db(self) -> None:
         """Initialize the database with schema if it doesn't exist."""
         with self.get_connection() as conn:
+            self._set_aside_inline_image_tables(conn)
             if self.schema_path.exists():
                 with self.schema_path.open() as f:
                     conn.executescript(f.read())
             conn.commit()
+            self._migrate_inline_images(conn)
 
-    def get_connection(self) -> sqlite3.Connection:
-        """Get a database connection with Row factory enabled."""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def _set_aside_inline_image_tables(self, conn: sqlite3.Connection) -> None:
+        """Rename the puzzles and guesses tables of databases that store base64 images inline,
+        so the schema can create the tables that reference the images table instead.
+        """
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(puzzles)")}
+        if "start_image" not in columns:
+            return
+        logger.info("Moving the inline images of the puzzles and guesses to the images table")
+        # Keep the references of other tables (user_state) pointing at the puzzles table
+        conn.execute("PRAGMA legacy_alter_table = ON")
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE puzzles RENAME TO legacy_puzzles")
+        conn.execute("ALTER TABLE guesses RENAME TO legacy_guesses")
+        # The index moved with the table, the schema recreates it on the new table
+        conn.execute("DROP INDEX IF EXISTS idx_guesses_player")
+        conn.execute("COMMIT")
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+
+    def _migrate_inline_images(self, conn: sqlite3.Connection) -> None:
+        """Copy the puzzles and guesses set aside by `_set_aside_inline_image_tables` into the new tables."""
+        legacy_tables = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('legacy_puzzles', 'legacy_guesses')"
+        ).fetchall()
+        if len(legacy_tables) != 2:
+            return
+        for row in conn.execute("SELECT * FROM legacy_puzzles").fetchall():
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO puzzles (puzzle_num, start_image_hash, goal_image_hash, start_prompt, goal_prompt)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    row["puzzle_num"],
+                    self.save_image(conn, b64decode(row["start_image"])),
+                    self.save_image(conn, b64decode(row["goal_image"])),
+                    row["start_prompt"],
+                    row["goal_prompt"],
+                ),
+            )
+        for row in conn.execute("SELECT * FROM legacy_guesses").fetchall():
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO guesses (player_id, puzzle_num, guess_num, image_hash, guess_prompt)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    row["player_id"],
+                    row["puzzle_num"],
+                    row["guess_num"],
+                    self.save_image(conn, b64decode(row["image"])),
+                    row["guess_prompt"],
+                ),
+            )
+        conn.execute("DROP TABLE legacy_guesses")
+        conn.execute("DROP TABLE legacy_puzzles")
+        conn.commit()
+
+    def get_connection(self) -> contextlib.AbstractContextManager[sqlite3.Connection]:
+        """Borrow a pooled database connection with Row factory enabled.
+
+        Example: `with db.get_connection() as conn: ...`
+        """
+        return self._pool.connection()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self._write_executor.shutdown()
+        self._pool.close()
+
+    async def run(self, func: Callable[..., T], *args: Any) -> T:
+        """Run a read only database method on the bounded database thread pool so it does not block the event loop.
+        The method is called with a pooled connection as its first argument.
+
+        Example: `puzzle_state = await db.run(db.get_puzzle, player_id)`
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._run_with_connection, func, args)
+
+    async def run_write(self, func: Callable[..., T], *args: Any) -> T:
+        """Like `run`, for methods that modify the database. Writes run one at a time, in the order they were
+        submitted, and the transaction is committed on success.
+
+        Example: `puzzle_state = await db.run_write(db.submit_guess, player_id, guess, image)`
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._write_executor, self._run_with_connection, func, args
+        )
+
+    def _run_with_connection(self, func: Callable[..., T], args: tuple[Any, ...]) -> T:
+        with self.get_connection() as conn:
+            return func(conn, *args)
+
+    def save_image(self, conn: sqlite3.Connection, image: bytes) -> str:
+        """Store the raw image bytes, if they are not already stored, and return the image hash used to reference it."""
+        image_hash = hashlib.sha256(image).hexdigest()
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO images (image_hash, image)
+            VALUES (?, ?)
+            """,
+            (image_hash, image),
+        )
+        return image_hash
+
+    def get_image(self, conn: sqlite3.Connection, image_hash: str) -> bytes | None:
+        """Get the raw bytes of an image by its hash."""
+        image = self.puzzle_cache.get_image(conn, image_hash)
+        if image is not None:
+            return image
+        row: sqlite3.Row | None = conn.execute(
+            """
+            SELECT image FROM images WHERE image_hash = ?
+            """,
+            (image_hash,),
+        ).fetchone()
+        return row["image"] if row else None
+
+    def save_embedding(self, conn: sqlite3.Connection, image_hash: str, model_name: str, embedding: bytes) -> None:
+        """Store the embedding of an image computed by the similarity model `model_name`."""
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO image_embeddings (image_hash, model_name, embedding)
+            VALUES (?, ?, ?)
+            """,
+            (image_hash, model_name, embedding),
+        )
+
+    def get_embedding(self, conn: sqlite3.Connection, image_hash: str, model_name: str) -> bytes | None:
+        row: sqlite3.Row | None = conn.execute(
+            """
+            SELECT embedding FROM image_embeddings WHERE image_hash = ? AND model_name = ?
+            """,
+            (image_hash, model_name),
+        ).fetchone()
+        return row["embedding"] if row else None
 
     def save_puzzle(
         self,
@@ -48,13 +248,19 @@ class Database:
         """
         conn.execute(
             """
-            INSERT INTO puzzles (puzzle_num, start_image, goal_image, start_prompt, goal_prompt)
+            INSERT INTO puzzles (puzzle_num, start_image_hash, goal_image_hash, start_prompt, goal_prompt)
             VALUES (?, ?, ?, ?, ?)
             """,
-            (puzzle_num, start_image, goal_image, start_prompt, goal_prompt),
+            (
+                puzzle_num,
+                self.save_image(conn, start_image),
+                self.save_image(conn, goal_image),
+                start_prompt,
+                goal_prompt,
+            ),
         )
 
-    def submit_guess(self, conn: sqlite3.Connection, player_id: str, guess: str, guess_image: str) -> PuzzleState:
+    def submit_guess(self, conn: sqlite3.Connection, player_id: str, guess: str, guess_image: bytes) -> PuzzleState:
         """Handles submitting a guess for a puzzle."""
         # First check if there is an in progress puzzle
         result = conn.execute(
@@ -70,6 +276,12 @@ class Database:
             (player_id, player_id),
         )
         row: sqlite3.Row | None = result.fetchone()
+        snapshot = self.puzzle_cache.get(conn)
+        if row and row["puzzle_num"] not in snapshot.puzzles:
+            # The puzzle was deleted since the player started it, they start over on their current puzzle
+            logger.warning(f"Resetting the guesses of player {player_id} for missing puzzle {row['puzzle_num']}")
+            self.delete_guesses(conn, player_id)
+            row = None
         if row:
             puzzle_num = row["puzzle_num"]
             guess_num = int(row["max_guess"]) + 1
@@ -77,82 +289,73 @@ class Database:
                 return None
         else:
             # If not, get the current puzzle and submit the first guess for that puzzle.
-            puzzle_num = self.get_current_puzzle_num(conn, player_id)
+            puzzle_num = self._current_puzzle_num(conn, player_id, snapshot)
             guess_num = 0
 
         conn.execute(
             """
-            INSERT INTO guesses (player_id, puzzle_num, guess_num, image, guess_prompt)
+            INSERT INTO guesses (player_id, puzzle_num, guess_num, image_hash, guess_prompt)
             VALUES (?, ?, ?, ?, ?)
             """,
-            (player_id, puzzle_num, guess_num, guess_image, guess),
+            (player_id, puzzle_num, guess_num, self.save_image(conn, guess_image), guess),
         )
-        return self.get_puzzle(conn, player_id)
+        return self._puzzle_state(conn, player_id, snapshot)
 
     def get_puzzle(self, conn: sqlite3.Connection, player_id: str) -> PuzzleState:
         """Gets the current puzzle state for the user."""
+        return self._puzzle_state(conn, player_id, self.puzzle_cache.get(conn))
+
+    def _puzzle_state(self, conn: sqlite3.Connection, player_id: str, snapshot: PuzzleSnapshot) -> PuzzleState:
         # First check for any in progress puzzles (indicated by having guesses)
         result = conn.execute(
             """
-            SELECT puzzles.start_image, puzzles.start_prompt, puzzles.goal_image, puzzles.goal_prompt,
-                guesses.image, guesses.guess_prompt, guesses.guess_num, puzzles.puzzle_num
-            FROM puzzles
-            INNER JOIN guesses ON guesses.puzzle_num = puzzles.puzzle_num
-            WHERE guesses.player_id = ?
-            ORDER BY guesses.guess_num ASC
+            SELECT image_hash, guess_prompt, guess_num, puzzle_num
+            FROM guesses
+            WHERE player_id = ?
+            ORDER BY guess_num ASC
             """,
             (player_id,),
         )
         rows: list[sqlite3.Row] = result.fetchall()
-        raw_data = [dict(row) for row in rows]
-        if rows:
+        puzzle = snapshot.puzzles.get(rows[0]["puzzle_num"]) if rows else None
+        if rows and puzzle is None:
+            # Read only here, submit_guess drops the guesses when the player guesses again
+            logger.warning(
+                f"Player {player_id} has guesses for missing puzzle {rows[0]['puzzle_num']}, showing their current puzzle"
+            )
+        if puzzle is not None:
             # Figure out if that was the last guess
-            last_guess_num = raw_data[-1]["guess_num"]
+            last_guess_num = rows[-1]["guess_num"]
             is_last_guess = last_guess_num == (DEFAULT_NUM_GUESS_IMAGES - 1)
-            goal_prompt = raw_data[0]["goal_prompt"] if is_last_guess else None
+            goal_prompt = puzzle.goal_prompt if is_last_guess else None
 
-            guess_images = [PuzzleImage(base64_image=(row["image"]), prompt=row["guess_prompt"]) for row in raw_data]
-            # For the rest, assume all the fields will be the same so we can just use the first row
+            guess_images = [PuzzleImage(image_hash=row["image_hash"], prompt=row["guess_prompt"]) for row in rows]
             return PuzzleState(
-                start_image=PuzzleImage(
-                    base64_image=raw_data[0]["start_image"],
-                    prompt=raw_data[0]["start_prompt"],
-                ),
-                goal_image=PuzzleImage(base64_image=raw_data[0]["goal_image"], prompt=goal_prompt),
+                start_image=PuzzleImage(image_hash=puzzle.start_image_hash, prompt=puzzle.start_prompt),
+                goal_image=PuzzleImage(image_hash=puzzle.goal_image_hash, prompt=goal_prompt),
                 guess_images=guess_images,
-                guesses_submitted=len(raw_data),
+                guesses_submitted=len(rows),
                 guesses_total=DEFAULT_NUM_GUESS_IMAGES,
-                puzzle_num=raw_data[0]["puzzle_num"],
+                puzzle_num=puzzle.puzzle_num,
                 similarity_score=None,
                 final_prompt=None,
             )
         else:
-            # Otherwise, get number of the puzzle they are on
-            current_puzzle_num = self.get_current_puzzle_num(conn, player_id)
-            # Return the next puzzle
-            result = conn.execute(
-                """
-                SELECT puzzle_num, start_image, start_prompt, goal_image
-                FROM puzzles
-                WHERE puzzle_num = ?
-                """,
-                (current_puzzle_num,),
-            )
-            row: sqlite3.Row | None = result.fetchone()
-            if row:
-                return PuzzleState(
-                    start_image=PuzzleImage(base64_image=row["start_image"], prompt=row["start_prompt"]),
-                    goal_image=PuzzleImage(base64_image=row["goal_image"], prompt=None),
-                    guess_images=[],
-                    guesses_submitted=0,
-                    guesses_total=DEFAULT_NUM_GUESS_IMAGES,
-                    puzzle_num=row["puzzle_num"],
-                    similarity_score=None,
-                    final_prompt=None,
-                )
-            else:
-                logger.error("No puzzles found in `get_puzzle`")
-                raise ValueError("No puzzles found in `get_puzzle`")
+            # Otherwise, return the puzzle they are on
+            return self._new_puzzle_state(snapshot.puzzles[self._current_puzzle_num(conn, player_id, snapshot)])
+
+    def _new_puzzle_state(self, puzzle: CachedPuzzle) -> PuzzleState:
+        """The state of a puzzle without any guesses."""
+        return PuzzleState(
+            start_image=PuzzleImage(image_hash=puzzle.start_image_hash, prompt=puzzle.start_prompt),
+            goal_image=PuzzleImage(image_hash=puzzle.goal_image_hash, prompt=None),
+            guess_images=[],
+            guesses_submitted=0,
+            guesses_total=DEFAULT_NUM_GUESS_IMAGES,
+            puzzle_num=puzzle.puzzle_num,
+            similarity_score=None,
+            final_prompt=None,
+        )
 
     def complete_puzzle(self, conn: sqlite3.Connection, player_id: str, finished_puzzle: int) -> None:
         """Inserts or updates the user state with the finished puzzle number and similarity score.
@@ -174,122 +377,69 @@ class Database:
         If the user has no finished puzzles, get the first puzzle number.
         If there are no higher puzzle numbers, return the MAX puzzle number (keep repeating the last puzzle)
         """
-        result = conn.execute(
+        return self._current_puzzle_num(conn, player_id, self.puzzle_cache.get(conn))
+
+    def _current_puzzle_num(self, conn: sqlite3.Connection, player_id: str, snapshot: PuzzleSnapshot) -> int:
+        row: sqlite3.Row = conn.execute(
             """
-            -- Gets the last puzzle this player finished (if any)
-            WITH last_finished AS (
-                SELECT finished_puzzle 
-                FROM user_state 
-                WHERE player_id = ? 
-                ORDER BY finished_puzzle DESC 
-                LIMIT 1
-            )
-            SELECT 
-                CASE 
-                    -- For users with no finished puzzles, return the first puzzle
-                    WHEN (SELECT finished_puzzle FROM last_finished) IS NULL 
-                    THEN (SELECT MIN(puzzle_num) FROM puzzles)
-                    ELSE (
-                        COALESCE(
-                            -- Try to get the next available puzzle number
-                            (
-                                SELECT MIN(puzzle_num)
-                                FROM puzzles
-                                WHERE puzzle_num > (SELECT finished_puzzle FROM last_finished)
-                            ),
-                            -- If no higher numbers exist, return the highest puzzle
-                            (SELECT MAX(puzzle_num) FROM puzzles)
-                        )
-                    )
-                END AS puzzle_num
+            SELECT MAX(finished_puzzle) AS finished_puzzle FROM user_state WHERE player_id = ?
             """,
             (player_id,),
-        )
-        row: sqlite3.Row | None = result.fetchone()
-        if row:
-            puzzle_num = row["puzzle_num"]
-            return puzzle_num
-        else:
-            logger.error("No puzzles found in `get_current_puzzle_num`")
-            raise ValueError("No puzzles found in `get_current_puzzle_num`")
+        ).fetchone()
+        return snapshot.current_puzzle_num(row["finished_puzzle"])
 
     def get_next_puzzle_num(self, conn: sqlite3.Connection, player_id: str) -> int:
         """Get the next puzzle number for the user.
         If the user has no finished puzzles, get the first puzzle number.
         If there are no higher puzzle numbers, return the MAX puzzle number (keep repeating the last puzzle)
         """
-        current_puzzle_num = self.get_current_puzzle_num(conn, player_id)
-        result = conn.execute(
-            """
-            SELECT COALESCE(
-                (
-                    SELECT puzzles.puzzle_num
-                    FROM puzzles
-                    WHERE puzzles.puzzle_num > ?
-                    ORDER BY puzzles.puzzle_num ASC
-                    LIMIT 1
-                ),
-                (SELECT MAX(puzzle_num) FROM puzzles)
-            ) AS puzzle_num
-            """,
-            (current_puzzle_num,),
-        )
-        row: sqlite3.Row | None = result.fetchone()
-        if row:
-            return row["puzzle_num"]
-        else:
-            logger.error("No puzzles found in `get_next_puzzle_num`")
-            raise ValueError("No puzzles found in `get_next_puzzle_num`")
+        snapshot = self.puzzle_cache.get(conn)
+        return snapshot.next_puzzle_num(self._current_puzzle_num(conn, player_id, snapshot))
 
     def next_puzzle(self, conn: sqlite3.Connection, player_id: str) -> PuzzleState:
         """Handles the database changes when the user moves to the next puzzle."""
+        snapshot = self.puzzle_cache.get(conn)
         # Get the current puzzle number to mark it as finished
-        puzzle_num = self.get_current_puzzle_num(conn, player_id)
+        puzzle_num = self._current_puzzle_num(conn, player_id, snapshot)
         # Get the next puzzle number before completing the current puzzle
-        next_puzzle_num = self.get_next_puzzle_num(conn, player_id)
+        next_puzzle_num = snapshot.next_puzzle_num(puzzle_num)
         self.complete_puzzle(conn, player_id, puzzle_num)
         # Delete all guesses for the player
+        self.delete_guesses(conn, player_id)
+
+        # Return the next puzzle
+        return self._new_puzzle_state(snapshot.puzzles[next_puzzle_num])
+
+    def delete_guesses(self, conn: sqlite3.Connection, player_id: str) -> None:
+        """Delete all guesses for the player along with their images, unless another row still uses the image."""
+        image_hashes = conn.execute(
+            """
+            SELECT DISTINCT image_hash FROM guesses WHERE player_id = ?
+            """,
+            (player_id,),
+        ).fetchall()
         conn.execute(
             """
             DELETE FROM guesses WHERE player_id = ?
             """,
             (player_id,),
         )
-
-        # Return the next puzzle
-        result = conn.execute(
+        conn.executemany(
             """
-            SELECT puzzle_num, start_image, start_prompt, goal_image
-            FROM puzzles
-            WHERE puzzle_num = ?
+            DELETE FROM images
+            WHERE image_hash = :image_hash
+            AND NOT EXISTS (SELECT 1 FROM guesses WHERE image_hash = :image_hash)
+            AND NOT EXISTS (
+                SELECT 1 FROM puzzles WHERE start_image_hash = :image_hash OR goal_image_hash = :image_hash
+            )
             """,
-            (next_puzzle_num,),
+            [{"image_hash": row["image_hash"]} for row in image_hashes],
         )
-        row: sqlite3.Row | None = result.fetchone()
-        if row:
-            return PuzzleState(
-                start_image=PuzzleImage(base64_image=row["start_image"], prompt=row["start_prompt"]),
-                goal_image=PuzzleImage(base64_image=row["goal_image"], prompt=None),
-                guess_images=[],
-                guesses_submitted=0,
-                guesses_total=DEFAULT_NUM_GUESS_IMAGES,
-                puzzle_num=row["puzzle_num"],
-                similarity_score=None,
-                final_prompt=None,
-            )
-        else:
-            logger.error("No puzzles found in `next_puzzle`")
-            raise ValueError("No puzzles found in `next_puzzle`")
 
     def reset_puzzle(self, conn: sqlite3.Connection, player_id: str) -> PuzzleState:
         """Handles the database changes when the user resets a puzzle."""
         # Delete all guesses for the player
-        conn.execute(
-            """
-            DELETE FROM guesses WHERE player_id = ?
-            """,
-            (player_id,),
-        )
+        self.delete_guesses(conn, player_id)
 
         # Get the puzzle state again
         return self.get_puzzle(conn, player_id)
@@ -310,5 +460,6 @@ def reset_database() -> Database:
         db_path=Path(__file__).parent / "puzzle_game_test.db",
         schema_path=Path(__file__).parent / "schema.sql",
     )
-    config.db_path.unlink(missing_ok=True)
+    for path in (config.db_path, *(config.db_path.with_name(config.db_path.name + s) for s in ("-wal", "-shm"))):
+        path.unlink(missing_ok=True)
     return Database(config)
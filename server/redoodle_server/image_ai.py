@@ -1,18 +1,15 @@
+import asyncio
 from copy import deepcopy
-import json
 from pathlib import Path
 import secrets
-import time
-from urllib import request
 
-import timm
-import torch.nn.functional as f
+from redoodle_server.comfyui_client import ComfyUIClient, ComfyUIError
+from redoodle_server.images import encode_binary_to_base64
+from redoodle_server.similarity import SimilarityBackend, SimilarityService, similarity_score
 
-from redoodle_server.images import base64_to_pil, load_base64_image, save_base64_image
-
-COMFY_UI_INPUT_DIR = Path(__file__).parent.parent / "ComfyUI" / "input"
-COMFY_UI_OUTPUT_DIR = Path(__file__).parent.parent / "ComfyUI" / "output"
-IMG2IMG_MAX_ATTEMPTS = 300
+IMG2IMG_DENOISE = 0.81
+# Node id of the SaveImageWebsocket node in the workflow built by `build_img2img_batch_workflow`
+IMG2IMG_BATCH_OUTPUT_NODE = "save"
 
 IMG2IMG_TEMPLATE = {
     "3": {
@@ -22,7 +19,7 @@ IMG2IMG_TEMPLATE = {
             "cfg": 1,
             "sampler_name": "euler",
             "scheduler": "sgm_uniform",
-            "denoise": 0.81,
+            "denoise": IMG2IMG_DENOISE,
             "model": ["14", 0],
             "positive": ["16", 0],
             "negative": ["17", 0],
@@ -37,14 +34,14 @@ IMG2IMG_TEMPLATE = {
         "_meta": {"title": "VAE Decode"},
     },
     "9": {
-        "inputs": {"filename_prefix": "OUTPUT FILE NAME IN /output FOLDER", "images": ["8", 0]},
-        "class_type": "SaveImage",
-        "_meta": {"title": "Save Image"},
+        "inputs": {"format": "png", "images": ["8", 0]},
+        "class_type": "SaveImageWebsocket",
+        "_meta": {"title": "Save Image (Websocket)"},
     },
     "10": {
-        "inputs": {"image": "INPUT IMAGE FILE NAME IN /input FOLDER", "upload": "image"},
-        "class_type": "LoadImage",
-        "_meta": {"title": "Load Image"},
+        "inputs": {"image": "BASE64 INPUT IMAGE"},
+        "class_type": "LoadImageBase64",
+        "_meta": {"title": "Load Image (Base64)"},
     },
     "12": {
         "inputs": {"pixels": ["10", 0], "vae": ["14", 2]},
@@ -81,7 +78,9 @@ IMG2IMG_TEMPLATE = {
 }
 
 
-def generate_image(initial_image: str, prompt: str, steps: int = 3) -> str:
+async def generate_image(
+    client: ComfyUIClient, initial_image: bytes, prompt: str, steps: int = 3, denoise: float = IMG2IMG_DENOISE
+) -> bytes:
     """Using ComfyUI, use img2img to generate a new image using the initial image and the user's prompt."""
     api_template = deepcopy(IMG2IMG_TEMPLATE)
 
@@ -89,77 +88,122 @@ def generate_image(initial_image: str, prompt: str, steps: int = 3) -> str:
     api_template["3"]["inputs"]["seed"] = secrets.randbits(32)
     # Set the positive image generation prompt
     api_template["16"]["inputs"]["text"] = prompt
-    # Set the number of steps
+    # Set the number of steps and how much of the initial image to keep
     api_template["3"]["inputs"]["steps"] = steps
-    # Set the file name prefix
-    api_template["9"]["inputs"]["filename_prefix"] = "img2img_redoodle"
-    # Set the initial image
-    save_base64_image(initial_image, COMFY_UI_INPUT_DIR / "initial_image.png")
-    api_template["10"]["inputs"]["image"] = "initial_image.png"
-
-    data = json.dumps({"prompt": api_template}).encode("utf-8")
-    req = request.Request("http://127.0.0.1:8188/prompt", data=data)
-    result = request.urlopen(req)
-    prompt_id = json.loads(result.read())["prompt_id"]
-
-    # Poll until the image is generated
-    attempts = 0
-    while attempts < IMG2IMG_MAX_ATTEMPTS:
-        req = request.Request(f"http://127.0.0.1:8188/history/{prompt_id}")
-        resp = request.urlopen(req)
-        history = json.loads(resp.read())
-
-        # Get the filename of the output image
-        if history:
-            new_image_path = COMFY_UI_OUTPUT_DIR / history[prompt_id]["outputs"]["9"]["images"][0]["filename"]
-
-            # Check if this image exists
-            if Path(new_image_path).exists():
-                return load_base64_image(COMFY_UI_OUTPUT_DIR / new_image_path)
-
-        time.sleep(0.05)
-        attempts += 1
-
-    return ""
-
-
-def compute_similarity_score(initial_image: str, generated_image: str, model) -> float:
-    """Compute the similarity score between two images using a Vision Transformer (ViT) image feature model.
-    https://huggingface.co/timm/vit_large_patch14_dinov2.lvd142m
-
-    Returns:
-        float: The similarity score between the two images, normalized to 0.00-100.00
+    api_template["3"]["inputs"]["denoise"] = denoise
+    # Set the initial image. It is sent inline with the prompt and the result comes back over the websocket,
+    # so nothing is written to the ComfyUI input or output folders.
+    api_template["10"]["inputs"]["image"] = encode_binary_to_base64(initial_image)
+
+    result = await client.run_prompt(api_template)
+    images = result.images.get("9", [])
+    if not images:
+        # E.g. the websocket reconnected while the prompt ran, images sent meanwhile are not in the history
+        raise ComfyUIError("ComfyUI did not send the generated image")
+    return images[0]
+
+
+def build_img2img_batch_workflow(
+    initial_images: list[bytes], prompts: list[str], seeds: list[int], steps: int, denoise: float
+) -> dict:
+    """Build a ComfyUI workflow that runs img2img for several guesses as one sampler batch.
+
+    Equivalent to running IMG2IMG_TEMPLATE once per guess: the initial images are encoded as one latent batch,
+    each entry gets its own prompt (ConditioningBatch) and its own seed (RandomNoiseBatch), and the decoded images
+    are sent back over the websocket by IMG2IMG_BATCH_OUTPUT_NODE in the same order as the inputs.
     """
-    img1 = base64_to_pil(initial_image)
-    img2 = base64_to_pil(generated_image)
-
-    # get model specific transforms (normalization, resize)
-    data_config = timm.data.resolve_model_data_config(model)
-    transforms = timm.data.create_transform(**data_config, is_training=False)
+    template = IMG2IMG_TEMPLATE
+    workflow = {
+        "14": deepcopy(template["14"]),
+        "17": deepcopy(template["17"]),
+        "18": deepcopy(template["18"]),
+    }
+
+    image_node = positive_node = None
+    for i, (initial_image, prompt) in enumerate(zip(initial_images, prompts, strict=True)):
+        workflow[f"load_{i}"] = {
+            "inputs": {"image": encode_binary_to_base64(initial_image)},
+            "class_type": "LoadImageBase64",
+        }
+        workflow[f"positive_{i}"] = {"inputs": {"text": prompt, "clip": ["18", 0]}, "class_type": "CLIPTextEncode"}
+        if i == 0:
+            image_node, positive_node = [f"load_{i}", 0], [f"positive_{i}", 0]
+        else:
+            workflow[f"image_batch_{i}"] = {
+                "inputs": {"image1": image_node, "image2": [f"load_{i}", 0]},
+                "class_type": "ImageBatch",
+            }
+            workflow[f"positive_batch_{i}"] = {
+                "inputs": {"conditioning1": positive_node, "conditioning2": [f"positive_{i}", 0]},
+                "class_type": "ConditioningBatch",
+            }
+            image_node, positive_node = [f"image_batch_{i}", 0], [f"positive_batch_{i}", 0]
+
+    sampler_inputs = template["3"]["inputs"]
+    workflow.update(
+        {
+            "encode": {"inputs": {"pixels": image_node, "vae": ["14", 2]}, "class_type": "VAEEncode"},
+            "noise": {
+                "inputs": {"noise_seeds": ",".join(str(seed) for seed in seeds)},
+                "class_type": "RandomNoiseBatch",
+            },
+            "guider": {
+                "inputs": {
+                    "model": ["14", 0],
+                    "positive": positive_node,
+                    "negative": ["17", 0],
+                    "cfg": sampler_inputs["cfg"],
+                },
+                "class_type": "CFGGuider",
+            },
+            "sampler": {"inputs": {"sampler_name": sampler_inputs["sampler_name"]}, "class_type": "KSamplerSelect"},
+            "sigmas": {
+                "inputs": {
+                    "model": ["14", 0],
+                    "scheduler": sampler_inputs["scheduler"],
+                    "steps": steps,
+                    "denoise": denoise,
+                },
+                "class_type": "BasicScheduler",
+            },
+            "sample": {
+                "inputs": {
+                    "noise": ["noise", 0],
+                    "guider": ["guider", 0],
+                    "sampler": ["sampler", 0],
+                    "sigmas": ["sigmas", 0],
+                    "latent_image": ["encode", 0],
+                },
+                "class_type": "SamplerCustomAdvanced",
+            },
+            "decode": {"inputs": {"samples": ["sample", 0], "vae": ["14", 2]}, "class_type": "VAEDecode"},
+            IMG2IMG_BATCH_OUTPUT_NODE: {
+                "inputs": {"format": "png", "images": ["decode", 0]},
+                "class_type": "SaveImageWebsocket",
+            },
+        }
+    )
+    return workflow
 
-    output_1 = model(transforms(img1).unsqueeze(0))
-    output_2 = model(transforms(img2).unsqueeze(0))
 
-    # Compute cosine similarity between the two outputs
-    similarity = f.cosine_similarity(output_1, output_2, dim=1)
-    # Normalize to 0-1
-    similarity = (similarity + 1) / 2
-    return round(similarity.item() * 100, 2)
+async def _generate_example() -> bytes:
+    client = ComfyUIClient()
+    await client.start()
+    try:
+        return await generate_image(
+            client,
+            (Path(__file__).parent.parent / "data" / "start_images" / "1.png").read_bytes(),
+            "a happy sun shining water color painting",
+            4,
+        )
+    finally:
+        await client.close()
 
 
 if __name__ == "__main__":
-    image = generate_image(
-        load_base64_image(Path(__file__).parent.parent / "data" / "start_images" / "1.png"),
-        "a happy sun shining water color painting",
-        4,
-    )
+    image = asyncio.run(_generate_example())
 
-    model = timm.create_model(
-        "vit_large_patch14_dinov2.lvd142m",
-        pretrained=True,
-        num_classes=0,
-    )
-    model = model.eval()
-    img1 = load_base64_image(Path(__file__).parent.parent / "temp_images" / "happytree.png")
-    img2 = load_base64_image(Path(__file__).parent.parent / "temp_images" / "robotfallout.png")
-    print(compute_similarity_score(img1, img2, model))
+    similarity = SimilarityService(SimilarityBackend())
+    img1 = (Path(__file__).parent.parent / "temp_images" / "happytree.png").read_bytes()
+    img2 = (Path(__file__).parent.parent / "temp_images" / "robotfallout.png").read_bytes()
+    print(similarity_score(*similarity.embed_images([img1, img2])))
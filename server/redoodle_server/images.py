@@ -2,6 +2,7 @@ import base64
 from base64 import b64decode
 from io import BytesIO
 from pathlib import Path
+import struct
 
 from PIL import Image
 
@@ -41,6 +42,29 @@ def base64_to_pil(base64_image: str) -> Image.Image:
     return Image.open(BytesIO(img_data))
 
 
+def bytes_to_pil(image: bytes) -> Image.Image:
+    return Image.open(BytesIO(image))
+
+
+def image_size(image: bytes) -> tuple[int, int]:
+    """Width and height of encoded image bytes, read from the header without decoding the pixels."""
+    # PNG: the signature, then the IHDR chunk (length, type, width, height)
+    if image.startswith(b"\x89PNG\r\n\x1a\n") and image[12:16] == b"IHDR":
+        return struct.unpack(">II", image[16:24])
+    # PIL only reads the header until the pixels are accessed
+    with Image.open(BytesIO(image)) as img:
+        return img.size
+
+
+def image_media_type(image: bytes) -> str:
+    """Detect the media type of encoded image bytes from their magic number, defaulting to PNG."""
+    if image.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image[:4] == b"RIFF" and image[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
 def save_base64_image(base64_str: str, output_path: Path) -> None:
     """Save a base64 encoded image string to a file.
 
@@ -0,0 +1,107 @@
+import bisect
+from dataclasses import dataclass, field
+import sqlite3
+import threading
+
+from loguru import logger
+
+
+@dataclass(frozen=True)
+class CachedPuzzle:
+    puzzle_num: int
+    start_image_hash: str
+    start_prompt: str
+    goal_image_hash: str
+    goal_prompt: str
+
+
+@dataclass
+class PuzzleSnapshot:
+    """All puzzles as of one version of the puzzles table."""
+
+    version: int
+    puzzles: dict[int, CachedPuzzle]
+    # Sorted, for O(log n) lookups of the puzzle after a given one
+    puzzle_nums: list[int]
+    image_hashes: frozenset[str]
+    # Puzzle images, filled in as they are requested
+    images: dict[str, bytes] = field(default_factory=dict)
+
+    def current_puzzle_num(self, last_finished: int | None) -> int:
+        """The first puzzle number higher than the last finished puzzle.
+        If the user has no finished puzzles, the first puzzle number.
+        If there are no higher puzzle numbers, the last puzzle number (keep repeating the last puzzle).
+        """
+        if not self.puzzle_nums:
+            logger.error("No puzzles found in `current_puzzle_num`")
+            raise ValueError("No puzzles found in `current_puzzle_num`")
+        if last_finished is None:
+            return self.puzzle_nums[0]
+        return self.next_puzzle_num(last_finished)
+
+    def next_puzzle_num(self, puzzle_num: int) -> int:
+        """The first puzzle number higher than `puzzle_num`, or the last puzzle number if there is none."""
+        if not self.puzzle_nums:
+            logger.error("No puzzles found in `next_puzzle_num`")
+            raise ValueError("No puzzles found in `next_puzzle_num`")
+        i = bisect.bisect_right(self.puzzle_nums, puzzle_num)
+        return self.puzzle_nums[min(i, len(self.puzzle_nums) - 1)]
+
+
+class PuzzleCache:
+    """In process cache of the puzzles table, which every player reads on every request but rarely changes.
+
+    The `puzzle_version` row is bumped by triggers (see schema.sql) whenever puzzles are inserted, updated or deleted,
+    including by other processes like scripts/add_puzzles.py. Each lookup reads that one row and reloads the
+    snapshot if it changed.
+    """
+
+    def __init__(self) -> None:
+        self._snapshot: PuzzleSnapshot | None = None
+        self._lock = threading.Lock()
+
+    def get(self, conn: sqlite3.Connection) -> PuzzleSnapshot:
+        version = self._read_version(conn)
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = self._load(conn, version)
+            return self._snapshot
+
+    def get_image(self, conn: sqlite3.Connection, image_hash: str) -> bytes | None:
+        """Get a puzzle image from the cache, loading it on first use. Returns None if it is not a puzzle image."""
+        snapshot = self.get(conn)
+        image = snapshot.images.get(image_hash)
+        if image is None and image_hash in snapshot.image_hashes:
+            row: sqlite3.Row | None = conn.execute(
+                """
+                SELECT image FROM images WHERE image_hash = ?
+                """,
+                (image_hash,),
+            ).fetchone()
+            if row:
+                image = snapshot.images[image_hash] = row["image"]
+        return image
+
+    def _read_version(self, conn: sqlite3.Connection) -> int:
+        row: sqlite3.Row | None = conn.execute("SELECT version FROM puzzle_version WHERE id = 0").fetchone()
+        return row["version"] if row else 0
+
+    def _load(self, conn: sqlite3.Connection, version: int) -> PuzzleSnapshot:
+        rows: list[sqlite3.Row] = conn.execute(
+            """
+            SELECT puzzle_num, start_image_hash, start_prompt, goal_image_hash, goal_prompt
+            FROM puzzles
+            ORDER BY puzzle_num ASC
+            """
+        ).fetchall()
+        puzzles = {row["puzzle_num"]: CachedPuzzle(**dict(row)) for row in rows}
+        image_hashes = frozenset(
+            image_hash
+            for puzzle in puzzles.values()
+            for image_hash in (puzzle.start_image_hash, puzzle.goal_image_hash)
+        )
+        logger.info(f"Loaded {len(puzzles)} puzzles into the puzzle cache (version {version})")
+        return PuzzleSnapshot(version=version, puzzles=puzzles, puzzle_nums=list(puzzles), image_hashes=image_hashes)
@@ -1,22 +1,60 @@
 -- schema.sql
+CREATE TABLE IF NOT EXISTS images (
+    image_hash TEXT PRIMARY KEY, -- sha256 hex digest of the image bytes
+    image BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS image_embeddings (
+    image_hash TEXT NOT NULL,
+    model_name TEXT NOT NULL, -- the similarity model that computed the embedding
+    embedding BLOB NOT NULL, -- float32 values
+    PRIMARY KEY (image_hash, model_name),
+    FOREIGN KEY (image_hash) REFERENCES images(image_hash)
+);
+
 CREATE TABLE IF NOT EXISTS guesses (
     player_id TEXT NOT NULL,
     puzzle_num INTEGER NOT NULL,
     guess_num INTEGER NOT NULL,
-    image BLOB NOT NULL,
+    image_hash TEXT NOT NULL,
     guess_prompt TEXT NOT NULL,
     PRIMARY KEY (player_id, guess_num),
-    FOREIGN KEY (player_id) REFERENCES user_state(player_id)
+    FOREIGN KEY (player_id) REFERENCES user_state(player_id),
+    FOREIGN KEY (image_hash) REFERENCES images(image_hash)
 );
 
 CREATE TABLE IF NOT EXISTS puzzles (
     puzzle_num INTEGER PRIMARY KEY,
-    start_image BLOB NOT NULL,
-    goal_image BLOB NOT NULL,
+    start_image_hash TEXT NOT NULL,
+    goal_image_hash TEXT NOT NULL,
     start_prompt TEXT NOT NULL,
-    goal_prompt TEXT NOT NULL
+    goal_prompt TEXT NOT NULL,
+    FOREIGN KEY (start_image_hash) REFERENCES images(image_hash),
+    FOREIGN KEY (goal_image_hash) REFERENCES images(image_hash)
 );
 
+-- Bumped whenever the puzzles change, so servers know to reload their puzzle cache
+CREATE TABLE IF NOT EXISTS puzzle_version (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO puzzle_version (id, version) VALUES (0, 0);
+
+CREATE TRIGGER IF NOT EXISTS puzzles_insert_version AFTER INSERT ON puzzles
+BEGIN
+    UPDATE puzzle_version SET version = version + 1 WHERE id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS puzzles_update_version AFTER UPDATE ON puzzles
+BEGIN
+    UPDATE puzzle_version SET version = version + 1 WHERE id = 0;
+END;
+
+CREATE TRIGGER IF NOT EXISTS puzzles_delete_version AFTER DELETE ON puzzles
+BEGIN
+    UPDATE puzzle_version SET version = version + 1 WHERE id = 0;
+END;
+
 CREATE TABLE IF NOT EXISTS user_state (
     player_id TEXT,
     finished_puzzle INTEGER NOT NULL,
@@ -25,3 +63,4 @@ CREATE TABLE IF NOT EXISTS user_state (
 );
 
 CREATE INDEX IF NOT EXISTS idx_guesses_player ON guesses(player_id);
+CREATE INDEX IF NOT EXISTS idx_guesses_image ON guesses(image_hash);
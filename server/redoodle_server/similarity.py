@@ -0,0 +1,212 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+import threading
+import time
+
+from loguru import logger
+import numpy as np
+import safetensors.torch
+import timm
+import torch
+import torch.nn.functional as f
+
+from redoodle_server.constants import (
+    SIMILARITY_COMPILE,
+    SIMILARITY_MAX_BATCH_SIZE,
+    SIMILARITY_MAX_WORKERS,
+    SIMILARITY_MODEL_NAME,
+    SIMILARITY_PRECISION,
+    SIMILARITY_WEIGHTS_DIR,
+)
+from redoodle_server.database import Database
+from redoodle_server.images import bytes_to_pil
+
+SIMILARITY_PRECISIONS = ("fp32", "bf16", "int8")
+
+
+@dataclass(frozen=True)
+class SimilarityBackend:
+    """Which similarity model to use and how to run it on CPU."""
+
+    model_name: str = SIMILARITY_MODEL_NAME
+    # "fp32", "bf16" (autocast) or "int8" (dynamic quantization of the Linear layers)
+    precision: str = SIMILARITY_PRECISION
+    compile: bool = SIMILARITY_COMPILE
+
+    def __post_init__(self) -> None:
+        if self.precision not in SIMILARITY_PRECISIONS:
+            raise ValueError(
+                f"Unknown similarity precision {self.precision!r}, expected one of {SIMILARITY_PRECISIONS}"
+            )
+
+    @property
+    def embedding_key(self) -> str:
+        """Identifies the embeddings computed by this backend. Only embeddings with the same key are compared."""
+        return self.model_name if self.precision == "fp32" else f"{self.model_name}:{self.precision}"
+
+
+def create_similarity_model(backend: SimilarityBackend, weights_dir: Path = SIMILARITY_WEIGHTS_DIR) -> torch.nn.Module:
+    """Create a Vision Transformer (ViT) image feature model.
+    https://huggingface.co/timm/vit_large_patch14_dinov2.lvd142m
+
+    The pretrained weights are loaded from `weights_dir` if they were saved there, otherwise they are downloaded
+    and saved there for the next time.
+    """
+    weights_path = weights_dir / f"{backend.model_name}.safetensors"
+    if weights_path.exists():
+        model = timm.create_model(
+            backend.model_name, pretrained=True, pretrained_cfg_overlay={"file": str(weights_path)}, num_classes=0
+        )
+    else:
+        model = timm.create_model(backend.model_name, pretrained=True, num_classes=0)
+        weights_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = weights_path.with_suffix(".tmp")
+        safetensors.torch.save_file(model.state_dict(), tmp_path)
+        tmp_path.replace(weights_path)
+    model = model.eval()
+    if backend.precision == "int8":
+        # Almost all of the compute of a ViT is in its Linear layers
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def encode_embedding(embedding: torch.Tensor) -> bytes:
+    return embedding.detach().cpu().numpy().astype(np.float32).tobytes()
+
+
+def decode_embedding(data: bytes) -> torch.Tensor:
+    return torch.from_numpy(np.frombuffer(data, dtype=np.float32).copy())
+
+
+def similarity_score(embedding_1: torch.Tensor, embedding_2: torch.Tensor) -> float:
+    """Cosine similarity between two image embeddings, normalized to 0.00-100.00"""
+    similarity = f.cosine_similarity(embedding_1.unsqueeze(0), embedding_2.unsqueeze(0), dim=1)
+    # Normalize to 0-1
+    similarity = (similarity + 1) / 2
+    return round(similarity.item() * 100, 2)
+
+
+@dataclass
+class _PendingImage:
+    image: bytes
+    future: asyncio.Future
+
+
+class SimilarityService:
+    """Scores how similar a generated image is to a puzzle's goal image.
+
+    The model transform is built once, goal image embeddings are computed ahead of time (by scripts/add_puzzles.py)
+    and stored in the database, so scoring a guess only embeds the generated image. Images submitted while the model
+    is busy are embedded together in one batch, up to `max_batch_size`.
+    The model is loaded on first use, or in the background with `start_loading`.
+    """
+
+    def __init__(self, backend: SimilarityBackend, max_batch_size: int = SIMILARITY_MAX_BATCH_SIZE) -> None:
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.model: torch.nn.Module | None = None
+        self.transform = None
+        self._load_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=SIMILARITY_MAX_WORKERS, thread_name_prefix="redoodle-similarity"
+        )
+        self._pending: list[_PendingImage] = []
+        self._worker: asyncio.Task | None = None
+        # Goal image embeddings by image hash
+        self._goal_embeddings: dict[str, torch.Tensor] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.model is not None
+
+    def load(self) -> None:
+        """Load the model if it is not loaded yet. Blocking."""
+        with self._load_lock:
+            if self.model is not None:
+                return
+            start = time.perf_counter()
+            model = create_similarity_model(self.backend)
+            # Get model specific transforms (normalization, resize)
+            data_config = timm.data.resolve_model_data_config(model)
+            self.transform = timm.data.create_transform(**data_config, is_training=False)
+            # Compiled lazily, on the first forward pass
+            self.model = torch.compile(model) if self.backend.compile else model
+            logger.info(f"Loaded similarity model {self.backend.embedding_key} in {time.perf_counter() - start:.1f} s")
+
+    def start_loading(self) -> asyncio.Future:
+        """Load the model in the background on the similarity thread, so the server can accept requests meanwhile.
+        Requests that need the model before it is loaded wait for it.
+        """
+
+        def log_error(future: asyncio.Future) -> None:
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Loading similarity model failed, retrying on first use: {future.exception()}")
+
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self.load)
+        future.add_done_callback(log_error)
+        return future
+
+    def embed_images(self, images: list[bytes]) -> torch.Tensor:
+        """Embed the images in one forward pass. Blocking, returns one row per image."""
+        self.load()
+        batch = torch.stack([self.transform(bytes_to_pil(image).convert("RGB")) for image in images])
+        with (
+            torch.inference_mode(),
+            torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.backend.precision == "bf16"),
+        ):
+            return self.model(batch).float()
+
+    async def embed(self, image: bytes) -> torch.Tensor:
+        """Embed the image on the similarity thread, batched with any other images waiting for the model."""
+        pending = _PendingImage(image, asyncio.get_running_loop().create_future())
+        self._pending.append(pending)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._embed_pending())
+        return await pending.future
+
+    async def _embed_pending(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            batch = [pending for pending in self._pending[: self.max_batch_size] if not pending.future.done()]
+            del self._pending[: self.max_batch_size]
+            if not batch:
+                continue
+            try:
+                embeddings = await loop.run_in_executor(
+                    self._executor, self.embed_images, [pending.image for pending in batch]
+                )
+            except Exception as e:
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+            for pending, embedding in zip(batch, embeddings, strict=True):
+                if not pending.future.done():
+                    pending.future.set_result(embedding)
+
+    async def goal_embedding(self, db: Database, image_hash: str) -> torch.Tensor:
+        """Get the embedding of a goal image, from memory, the database, or by computing and storing it if the
+        puzzle was added without one.
+        """
+        embedding = self._goal_embeddings.get(image_hash)
+        if embedding is None:
+            data = await db.run(db.get_embedding, image_hash, self.backend.embedding_key)
+            if data is not None:
+                embedding = decode_embedding(data)
+            else:
+                image = await db.run(db.get_image, image_hash)
+                embedding = await self.embed(image)
+                await db.run_write(
+                    db.save_embedding, image_hash, self.backend.embedding_key, encode_embedding(embedding)
+                )
+            self._goal_embeddings[image_hash] = embedding
+        return embedding
+
+    async def score(self, db: Database, generated_image: bytes, goal_image_hash: str) -> float:
+        """Compute the similarity score between the generated image and the goal image, normalized to 0.00-100.00"""
+        goal_embedding, embedding = await asyncio.gather(
+            self.goal_embedding(db, goal_image_hash), self.embed(generated_image)
+        )
+        return similarity_score(embedding, goal_embedding)
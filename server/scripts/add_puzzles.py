@@ -1,7 +1,8 @@
 from pathlib import Path
 
+from redoodle_server.constants import SIMILARITY_MAX_BATCH_SIZE
 from redoodle_server.database import create_database
-from redoodle_server.images import load_base64_image
+from redoodle_server.similarity import SimilarityBackend, SimilarityService, encode_embedding
 
 PUZZLE_IMAGES_DIR = Path(__file__).parent.parent / "data" / "puzzle_images"
 PROMPTS_FILE = PUZZLE_IMAGES_DIR / "prompts.txt"
@@ -19,6 +20,9 @@ def main() -> None:
     )
 
     db = create_database()
+    # Must match the backend the server scores with, see redoodle_server.constants
+    similarity = SimilarityService(SimilarityBackend())
+    goal_image_paths: list[Path] = []
 
     # Process images in pairs
     for i in range(0, len(image_paths) - 1, 2):
@@ -38,11 +42,21 @@ def main() -> None:
             db.save_puzzle(
                 conn=conn,
                 puzzle_num=(i // 2) + 1,  # Puzzle numbers start at 1
-                start_image=load_base64_image(start_image_path),
-                goal_image=load_base64_image(goal_image_path),
+                start_image=start_image_path.read_bytes(),
+                goal_image=goal_image_path.read_bytes(),
                 start_prompt=start_prompt,
                 goal_prompt=goal_prompt,
             )
+        goal_image_paths.append(goal_image_path)
+
+    # Precompute the goal image embeddings, so scoring a guess only has to embed the generated image
+    for i in range(0, len(goal_image_paths), SIMILARITY_MAX_BATCH_SIZE):
+        goal_images = [path.read_bytes() for path in goal_image_paths[i : i + SIMILARITY_MAX_BATCH_SIZE]]
+        embeddings = similarity.embed_images(goal_images)
+        with db.get_connection() as conn:
+            for goal_image, embedding in zip(goal_images, embeddings, strict=True):
+                image_hash = db.save_image(conn, goal_image)
+                db.save_embedding(conn, image_hash, similarity.backend.embedding_key, encode_embedding(embedding))
 
 
 if __name__ == "__main__":
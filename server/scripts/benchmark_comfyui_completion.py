@@ -0,0 +1,87 @@
+"""Compare how quickly prompt completion is detected by polling `/history` versus the ComfyUI websocket.
+
+Runs against `scripts.fake_comfyui`, so no GPU or models are needed:
+    python -m scripts.benchmark_comfyui_completion --prompts 50 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+from scripts.fake_comfyui import FakeComfyUI, start_fake_server
+
+from redoodle_server.comfyui_client import ComfyUIClient
+from redoodle_server.image_ai import IMG2IMG_TEMPLATE
+
+POLL_INTERVAL_SECONDS = 0.05
+POLL_MAX_ATTEMPTS = 300
+
+
+async def run_polling(base_url: str) -> float:
+    """The previous `generate_image` behavior: queue the prompt, then poll the history every 50 ms."""
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        start = time.perf_counter()
+        resp = await http.post("/prompt", json={"prompt": IMG2IMG_TEMPLATE})
+        prompt_id = resp.json()["prompt_id"]
+        for _ in range(POLL_MAX_ATTEMPTS):
+            history = (await http.get(f"/history/{prompt_id}")).json()
+            if history:
+                return time.perf_counter() - start
+            await asyncio.sleep(POLL_INTERVAL_SECONDS)
+    raise TimeoutError(prompt_id)
+
+
+async def run_websocket(client: ComfyUIClient) -> float:
+    start = time.perf_counter()
+    await client.run_prompt(IMG2IMG_TEMPLATE)
+    return time.perf_counter() - start
+
+
+async def measure(name: str, fake: FakeComfyUI, make_request, num_prompts: int, concurrency: int) -> None:
+    fake.request_counts.clear()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited():
+        async with semaphore:
+            return await make_request()
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(limited() for _ in range(num_prompts)))
+    elapsed = time.perf_counter() - start
+    # Prompts run one at a time, so the minimum possible wall time is num_prompts * generation_seconds
+    overhead_ms = (elapsed - num_prompts * fake.generation_seconds) / num_prompts * 1000
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    print(
+        f"{name:>10}: mean {statistics.mean(latencies) * 1000:8.1f} ms | p95 {p95 * 1000:8.1f} ms | "
+        f"overhead/prompt {overhead_ms:6.1f} ms | HTTP requests to ComfyUI {sum(fake.request_counts.values())}"
+    )
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    fake = FakeComfyUI(generation_seconds=args.generation_seconds)
+    server, base_url = start_fake_server(fake)
+    try:
+        await measure("polling", fake, lambda: run_polling(base_url), args.prompts, args.concurrency)
+
+        client = ComfyUIClient(base_url=base_url)
+        await client.start()
+        try:
+            await measure("websocket", fake, lambda: run_websocket(client), args.prompts, args.concurrency)
+        finally:
+            await client.close()
+    finally:
+        server.should_exit = True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompts", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--generation-seconds", type=float, default=0.2)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
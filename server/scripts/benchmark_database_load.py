@@ -0,0 +1,143 @@
+"""Load test the database access of /puzzle and /submit_guess with many concurrent players.
+
+Image generation is stubbed out, so this only measures the database layer. Compares the pooled WAL database
+against the previous setup: a new connection per call, rollback journal and concurrent writers.
+    python -m scripts.benchmark_database_load --players 1000 --guesses 3
+With full size generated images (~1.6MB PNGs, --image-bytes 0) writing the blobs dominates both setups.
+"""
+
+import argparse
+import asyncio
+from collections.abc import Callable, Iterator
+import contextlib
+from pathlib import Path
+import sqlite3
+import statistics
+import tempfile
+import time
+from typing import Any, TypeVar
+
+from redoodle_server.database import Database, DBConfig
+
+T = TypeVar("T")
+
+PUZZLE_IMAGES_DIR = Path(__file__).parent.parent / "data" / "puzzle_images"
+SCHEMA_PATH = Path(__file__).parent.parent / "redoodle_server" / "schema.sql"
+
+
+class UnpooledDatabase(Database):
+    """The database access before pooling: every call opens a new connection and writes run concurrently."""
+
+    @contextlib.contextmanager
+    def _new_connection(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_connection(self) -> contextlib.AbstractContextManager[sqlite3.Connection]:
+        return self._new_connection()
+
+    async def run_write(self, func: Callable[..., T], *args: Any) -> T:
+        return await self.run(func, *args)
+
+
+def create_benchmark_database(db_class: type[Database], config: DBConfig) -> Database:
+    db = db_class(config)
+    image_paths = sorted(PUZZLE_IMAGES_DIR.glob("*.png"))[:4]
+    with db.get_connection() as conn:
+        for puzzle_num in range(1, 3):
+            db.save_puzzle(
+                conn,
+                puzzle_num,
+                image_paths[2 * puzzle_num - 2].read_bytes(),
+                image_paths[2 * puzzle_num - 1].read_bytes(),
+                "start prompt",
+                "goal prompt",
+            )
+    return db
+
+
+async def run_players(
+    db: Database, num_players: int, guesses_per_player: int, generation_seconds: float, image_bytes: int
+) -> tuple[float, dict[str, list[float]], int]:
+    latencies: dict[str, list[float]] = {"/puzzle": [], "/submit_guess": []}
+    errors = 0
+
+    async def timed(endpoint: str, coro) -> None:
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            await coro
+        except sqlite3.OperationalError:
+            # e.g. database is locked
+            errors += 1
+        latencies[endpoint].append(time.perf_counter() - start)
+
+    async def puzzle(player_id: str) -> None:
+        await db.run(db.get_puzzle, player_id)
+
+    async def submit_guess(player_id: str, guess: str) -> None:
+        # Same database calls as main.submit_guess, with the image generation replaced by a sleep
+        puzzle_state = await db.run(db.get_puzzle, player_id)
+        image_hash = (puzzle_state.guess_images or [puzzle_state.start_image])[-1].image_hash
+        initial_image = await db.run(db.get_image, image_hash)
+        await asyncio.sleep(generation_seconds)
+        # Make each generated image unique, so it is stored like a real one
+        new_image = (initial_image[:image_bytes] if image_bytes else initial_image) + guess.encode()
+        await db.run_write(db.submit_guess, player_id, guess, new_image)
+
+    async def player(player_num: int) -> None:
+        player_id = f"player-{player_num}"
+        await timed("/puzzle", puzzle(player_id))
+        for guess_num in range(guesses_per_player):
+            await timed("/submit_guess", submit_guess(player_id, f"{player_id} guess {guess_num}"))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(player(i) for i in range(num_players)))
+    return time.perf_counter() - start, latencies, errors
+
+
+def report(name: str, elapsed: float, latencies: dict[str, list[float]], errors: int) -> None:
+    num_requests = sum(len(values) for values in latencies.values())
+    print(f"{name}: {num_requests / elapsed:8.1f} requests/s | {errors} errors")
+    for endpoint, values in latencies.items():
+        p95 = statistics.quantiles(values, n=20)[-1] if len(values) > 1 else values[0]
+        print(f"  {endpoint:>13}: mean {statistics.mean(values) * 1000:8.1f} ms | p95 {p95 * 1000:8.1f} ms")
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, db_class, config in (
+            (
+                "unpooled",
+                UnpooledDatabase,
+                DBConfig(Path(tmp_dir) / "unpooled.db", SCHEMA_PATH, journal_mode="DELETE", synchronous="FULL"),
+            ),
+            ("pooled", Database, DBConfig(Path(tmp_dir) / "pooled.db", SCHEMA_PATH)),
+        ):
+            db = create_benchmark_database(db_class, config)
+            try:
+                report(
+                    name, *await run_players(db, args.players, args.guesses, args.generation_seconds, args.image_bytes)
+                )
+            finally:
+                db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=1000)
+    parser.add_argument("--guesses", type=int, default=3)
+    parser.add_argument("--generation-seconds", type=float, default=0.0)
+    parser.add_argument(
+        "--image-bytes", type=int, default=64 * 1024, help="Size of the stubbed generated images, 0 for full size"
+    )
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compare throughput and latency of batched vs unbatched img2img generation with many concurrent players.
+
+Against a running ComfyUI (with the sd3.5 models installed):
+    python -m scripts.benchmark_img2img_batching --players 8 --guesses 3
+Without a GPU, against `scripts.fake_comfyui` (batch_cost models how much an extra image in a batch costs):
+    python -m scripts.benchmark_img2img_batching --fake --batch-cost 0.35
+"""
+
+import argparse
+import asyncio
+from pathlib import Path
+import statistics
+import time
+
+from scripts.fake_comfyui import FakeComfyUI, start_fake_server
+
+from redoodle_server.batching import Img2ImgBatcher
+from redoodle_server.comfyui_client import ComfyUIClient
+from redoodle_server.constants import COMFY_UI_URL, IMG2IMG_BATCH_WINDOW_SECONDS, IMG2IMG_MAX_BATCH_SIZE
+
+START_IMAGE = Path(__file__).parent.parent / "data" / "puzzle_images" / "1.png"
+GUESSES = ["a watercolor painting", "make it night time", "add a red balloon", "in the style of a comic book"]
+
+
+async def run_players(batcher: Img2ImgBatcher, num_players: int, guesses_per_player: int) -> tuple[float, list[float]]:
+    initial_image = START_IMAGE.read_bytes()
+    latencies: list[float] = []
+
+    async def player(player_num: int) -> None:
+        for guess_num in range(guesses_per_player):
+            start = time.perf_counter()
+            await batcher.generate(initial_image, GUESSES[(player_num + guess_num) % len(GUESSES)], steps=4)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(player(i) for i in range(num_players)))
+    return time.perf_counter() - start, latencies
+
+
+def report(name: str, batcher: Img2ImgBatcher, elapsed: float, latencies: list[float]) -> None:
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    print(
+        f"{name:>10}: {len(latencies) / elapsed:6.2f} images/s | mean {statistics.mean(latencies):6.2f} s | "
+        f"p95 {p95:6.2f} s | mean batch size {batcher.stats.mean_batch_size:4.2f}"
+    )
+
+
+async def main_async(args: argparse.Namespace) -> None:
+    server = None
+    url = args.url
+    if args.fake:
+        server, url = start_fake_server(FakeComfyUI(args.generation_seconds, args.batch_cost))
+
+    client = ComfyUIClient(base_url=url, timeout=args.timeout)
+    await client.start()
+    try:
+        # Warm up so model loading is not part of the measurement
+        await Img2ImgBatcher(client, max_batch_size=1).generate(START_IMAGE.read_bytes(), GUESSES[0], steps=4)
+
+        unbatched = Img2ImgBatcher(client, max_batch_size=1)
+        report("unbatched", unbatched, *await run_players(unbatched, args.players, args.guesses))
+
+        batched = Img2ImgBatcher(client, window_seconds=args.window, max_batch_size=args.max_batch_size)
+        report("batched", batched, *await run_players(batched, args.players, args.guesses))
+    finally:
+        await client.close()
+        if server is not None:
+            server.should_exit = True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default=COMFY_UI_URL)
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--guesses", type=int, default=3)
+    parser.add_argument("--window", type=float, default=IMG2IMG_BATCH_WINDOW_SECONDS)
+    parser.add_argument("--max-batch-size", type=int, default=IMG2IMG_MAX_BATCH_SIZE)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--fake", action="store_true", help="Run against scripts.fake_comfyui instead of --url")
+    parser.add_argument("--generation-seconds", type=float, default=0.5)
+    parser.add_argument("--batch-cost", type=float, default=0.35)
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Measure applying stacked LoRAs to the weights of an SD3 size model on CPU, one key at a time with
+`comfy.lora.calculate_weight` and in batches with `comfy.lora_batch.calculate_weights`.
+
+The keys are those of the linear layers of the joint blocks of an MMDiT with `--depth` blocks (SD3 medium has 24),
+with fp16 weights. Each key gets `--loras` random patches of the `--adapter` type. The patched weights are discarded
+after they are computed, as ModelPatcher would set them on the model. Afterwards every batched weight is compared
+with the one computed by `calculate_weight`, and the script fails if they differ by more than `--tolerance`:
+    python -m scripts.benchmark_lora_patching --depth 24 --loras 3 --rank 16
+    python -m scripts.benchmark_lora_patching --depth 8 --adapter loha --dora
+"""
+
+import argparse
+import sys
+import time
+
+from scripts.comfyui_cpu import import_comfy, mmdit_model_config
+
+ADAPTERS = ["lora", "loha", "lokr"]
+# The factor of the first kronecker product matrix of the lokr patches
+LOKR_FACTOR = 4
+
+
+def mmdit_shapes(depth: int) -> dict:
+    """Shapes of the linear weights of the joint blocks of an MMDiT with `depth` blocks, without allocating it."""
+    import torch
+
+    model = mmdit_model_config(depth).get_model({}, device=torch.device("meta"))
+    return {
+        k: tuple(v.shape)
+        for k, v in model.diffusion_model.state_dict().items()
+        if k.startswith("joint_blocks.") and k.endswith(".weight") and v.dim() == 2
+    }
+
+
+def random_patch(adapter: str, shape: tuple, rank: int, dora: bool):
+    """The values of a patch as comfy.lora.load_lora makes them."""
+    import torch
+
+    out_features, in_features = shape
+    dora_scale = torch.rand((1, in_features)) + 0.5 if dora else None
+    if adapter == "lora":
+        up = torch.randn((out_features, rank), dtype=torch.float16) * 0.01
+        down = torch.randn((rank, in_features), dtype=torch.float16) * 0.01
+        return ("lora", (up, down, float(rank), None, dora_scale, None))
+    if adapter == "loha":
+        w1a, w2a = (torch.randn((out_features, rank), dtype=torch.float16) * 0.1 for _ in range(2))
+        w1b, w2b = (torch.randn((rank, in_features), dtype=torch.float16) * 0.1 for _ in range(2))
+        return ("loha", (w1a, w1b, float(rank), w2a, w2b, None, None, dora_scale))
+    w1 = torch.randn((LOKR_FACTOR, LOKR_FACTOR), dtype=torch.float16) * 0.1
+    w2_a = torch.randn((out_features // LOKR_FACTOR, rank), dtype=torch.float16) * 0.1
+    w2_b = torch.randn((rank, in_features // LOKR_FACTOR), dtype=torch.float16) * 0.1
+    return ("lokr", (w1, None, float(rank), None, None, w2_a, w2_b, None, dora_scale))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=24, help="Blocks of the model")
+    parser.add_argument("--loras", type=int, default=3, help="Stacked patches on each key")
+    parser.add_argument("--rank", type=int, default=16, help="Rank of the patches")
+    parser.add_argument("--adapter", choices=ADAPTERS, default="lora", help="Type of the patches")
+    parser.add_argument("--dora", action="store_true", help="Give the patches a DoRA scale")
+    parser.add_argument("--repeat", type=int, default=2, help="Runs of each way, the fastest is reported")
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Largest difference relative to the weight")
+    args = parser.parse_args()
+
+    import_comfy([])
+    import comfy.lora
+    import comfy.lora_batch
+    import torch
+
+    torch.manual_seed(0)
+    shapes = mmdit_shapes(args.depth)
+    # One base weight per shape, the patches don't modify it
+    weights = {shape: torch.randn(shape, dtype=torch.float16) for shape in set(shapes.values())}
+    items = []
+    for key, shape in shapes.items():
+        patches = [
+            (1.0 - 0.2 * i, random_patch(args.adapter, shape, args.rank, args.dora), 1.0, None, None)
+            for i in range(args.loras)
+        ]
+        items.append((key, weights[shape], patches))
+    parameters = sum(weight.nelement() for _, weight, _ in items)
+    print(f"{len(items)} keys, {parameters / 1e9:.2f}B parameters, {args.loras} {args.adapter} of rank {args.rank}")
+
+    per_key = batched = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for key, weight, patches in items:
+            comfy.lora.calculate_weight(patches, weight.to(torch.float32), key)
+        per_key = min(per_key, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        batched_keys = 0
+        for _ in comfy.lora_batch.calculate_weights(items):
+            batched_keys += 1
+        batched = min(batched, time.perf_counter() - start)
+    print(f"per key: {per_key:.2f} s, batched: {batched:.2f} s ({batched_keys} keys batched)")
+
+    patches = {key: (weight, key_patches) for key, weight, key_patches in items}
+    largest_error = 0.0
+    for key, batched_weight in comfy.lora_batch.calculate_weights(items):
+        weight, key_patches = patches[key]
+        expected = comfy.lora.calculate_weight(key_patches, weight.to(torch.float32), key)
+        error = ((batched_weight - expected).abs().max() / expected.abs().max()).item()
+        largest_error = max(largest_error, error)
+    print(f"largest relative difference: {largest_error:.2e}")
+    if largest_error > args.tolerance:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
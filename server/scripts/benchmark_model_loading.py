@@ -0,0 +1,138 @@
+"""Measure ComfyUI's load time and peak RSS for a diffusion model, memory mapped and with `--disable-mmap`.
+
+Each mode loads the fp16 model with `comfy.sd.load_diffusion_model` in a fresh process on CPU. The load time is
+followed by the time of the first pass over the weights, which is when memory mapped weights are read from the
+file. Without `--checkpoint`, a randomly initialized model with the SD3.5 large architecture and fewer blocks is
+saved to a temporary directory first:
+    python -m scripts.benchmark_model_loading --depth 16
+    python -m scripts.benchmark_model_loading --checkpoint ComfyUI/models/unet/model.safetensors
+"""
+
+import argparse
+import json
+from pathlib import Path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from scripts.comfyui_cpu import SERVER_DIR, import_comfy, mmdit_model_config
+
+MODES = {"mmap": [], "copy": ["--disable-mmap"]}
+READ_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def rss_mb() -> float:
+    with Path("/proc/self/status").open() as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def save_synthetic_checkpoint(path: Path, depth: int) -> None:
+    """Saves an SD3.5 large style MMDiT with `depth` blocks (SD3.5 large has 38) as fp16."""
+    import_comfy([])
+    import comfy.utils
+    import torch
+
+    model_config = mmdit_model_config(depth)
+    model_config.set_inference_dtype(torch.float16, None)
+    model = model_config.get_model({}, device=torch.device("cpu"))
+    sd = model.diffusion_model.state_dict()
+    for v in sd.values():
+        v.normal_(0.0, 0.02)
+    comfy.utils.save_torch_file(sd, str(path))
+
+
+def load(checkpoint: Path) -> dict:
+    """Runs in the child process, after ComfyUI's arguments are set."""
+    import comfy.sd
+    import torch
+
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    # The dtype of the file, as on a GPU. On CPU, ComfyUI would convert the weights to fp32
+    patcher = comfy.sd.load_diffusion_model(str(checkpoint), model_options={"dtype": torch.float16})
+    loaded = time.perf_counter()
+    with torch.no_grad():
+        for param in patcher.model.parameters():
+            param.float().sum()
+    used = time.perf_counter()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "load_seconds": loaded - start,
+        "first_use_seconds": used - loaded,
+        "peak_rss_mb": peak - rss_before,
+        "parameters": sum(p.nelement() for p in patcher.model.parameters()),
+    }
+
+
+def run_mode(checkpoint: Path, mode: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-m", "scripts.benchmark_model_loading", "--checkpoint", str(checkpoint), "--child", mode],
+        cwd=SERVER_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def warm_page_cache(checkpoint: Path) -> None:
+    """Read the file once so that every mode starts with it in the page cache."""
+    with checkpoint.open("rb") as f:
+        while f.read(READ_CHUNK_BYTES):
+            pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--checkpoint", type=Path, default=None, help="A diffusion model .safetensors file")
+    parser.add_argument("--depth", type=int, default=16, help="Blocks of the synthetic model")
+    # Steps that run in their own process
+    parser.add_argument("--child", choices=list(MODES), default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--save-synthetic", type=Path, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.save_synthetic is not None:
+        save_synthetic_checkpoint(args.save_synthetic, args.depth)
+        return
+    if args.child is not None:
+        import_comfy(MODES[args.child])
+        print(json.dumps(load(args.checkpoint)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = args.checkpoint
+        if checkpoint is None:
+            checkpoint = Path(tmp) / "benchmark_mmdit.safetensors"
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "scripts.benchmark_model_loading",
+                    "--save-synthetic",
+                    str(checkpoint),
+                    "--depth",
+                    str(args.depth),
+                ],
+                cwd=SERVER_DIR,
+                check=True,
+            )
+        size_mb = checkpoint.stat().st_size / 1024 / 1024
+        print(f"{checkpoint.name}: {size_mb:.0f} MB")
+        warm_page_cache(checkpoint)
+
+        print(f"{'mode':>5} {'load s':>7} {'first use s':>11} {'peak RSS MB':>11}")
+        for mode in MODES:
+            result = run_mode(checkpoint, mode)
+            print(
+                f"{mode:>5} {result['load_seconds']:7.2f} {result['first_use_seconds']:11.2f} "
+                f"{result['peak_rss_mb']:11.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
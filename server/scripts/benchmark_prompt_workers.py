@@ -0,0 +1,126 @@
+"""Measure ComfyUI prompt throughput on CPU with one and with several prompt workers (`--prompt-workers`).
+
+Runs ComfyUI's `PromptQueue` and `prompt_worker` in-process, without the web server. Each prompt creates an image,
+encodes and decodes it with a small randomly initialized TAESD VAE (the device stage) and saves it as a PNG (a CPU
+stage), so no model downloads are needed:
+    python -m scripts.benchmark_prompt_workers --workers 1 2 4 --prompts 16
+"""
+
+import argparse
+import importlib
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+SERVER_DIR = Path(__file__).parent.parent
+COMFYUI_DIR = SERVER_DIR / "ComfyUI"
+VAE_NAME = "benchmark_taesd.safetensors"
+POLL_INTERVAL_SECONDS = 0.005
+
+
+class HeadlessServer:
+    """The parts of ComfyUI's `PromptServer` that the prompt workers use, without a web server or clients."""
+
+    def __init__(self) -> None:
+        self.prompt_queue = None
+        self.client_id = None
+        self.last_prompt_id = None
+        self.last_node_id = None
+
+    def send_sync(self, event: str, data: object, sid: str | None = None) -> None:
+        pass
+
+    def queue_updated(self) -> None:
+        pass
+
+
+def load_comfyui(output_dir: Path) -> dict:
+    """Import ComfyUI on CPU, saving images and loading the benchmark VAE from `output_dir`."""
+    sys.argv = [sys.argv[0], "--cpu", "--disable-all-custom-nodes", "--output-directory", str(output_dir)]
+    sys.path.insert(0, str(COMFYUI_DIR))
+    # ComfyUI's main.py, not the ReDoodle server's
+    sys.modules.pop("main", None)
+    modules = {
+        name: importlib.import_module(name) for name in ("main", "execution", "folder_paths", "comfy.taesd.taesd")
+    }
+    modules["folder_paths"].add_model_folder_path("vae", str(output_dir))
+    return modules
+
+
+def save_benchmark_vae(comfy_modules: dict, output_dir: Path) -> None:
+    import safetensors.torch
+
+    taesd = comfy_modules["comfy.taesd.taesd"].TAESD()
+    for param in taesd.parameters():
+        param.data.normal_(0.0, 0.02)
+    safetensors.torch.save_file(taesd.state_dict(), output_dir / VAE_NAME)
+
+
+def make_prompt(index: int, size: int, batch_size: int) -> dict:
+    # A different color per prompt so no node output is reused from the cache
+    return {
+        "1": {"class_type": "VAELoader", "inputs": {"vae_name": VAE_NAME}},
+        "2": {
+            "class_type": "EmptyImage",
+            "inputs": {"width": size, "height": size, "batch_size": batch_size, "color": index * 7919 % 0xFFFFFF},
+        },
+        "3": {"class_type": "VAEEncode", "inputs": {"pixels": ["2", 0], "vae": ["1", 0]}},
+        "4": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["1", 0]}},
+        "5": {"class_type": "SaveImage", "inputs": {"images": ["4", 0], "filename_prefix": f"benchmark_{index}"}},
+    }
+
+
+def run_prompts(queue: object, first_index: int, count: int, size: int, batch_size: int) -> float:
+    """Queue `count` prompts and wait for all of them to finish. Returns the elapsed seconds."""
+    start = time.perf_counter()
+    for index in range(first_index, first_index + count):
+        queue.put((index, str(uuid.uuid4()), make_prompt(index, size, batch_size), {}, ["5"]))
+    while queue.get_tasks_remaining() > 0:
+        time.sleep(POLL_INTERVAL_SECONDS)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--prompts", type=int, default=16)
+    parser.add_argument("--size", type=int, default=512, help="Image width and height")
+    parser.add_argument("--batch-size", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output_dir = Path(tmp)
+        comfy = load_comfyui(output_dir)
+        save_benchmark_vae(comfy, output_dir)
+
+        print(f"{'workers':>7} {'prompts/s':>9} {'images/s':>8} {'s/prompt':>8}")
+        index = 0
+        for workers in args.workers:
+            server = HeadlessServer()
+            queue = comfy["execution"].PromptQueue(server)
+            executors = []
+            for _ in range(workers):
+                threading.Thread(
+                    target=comfy["main"].prompt_worker, daemon=True, args=(queue, server, executors)
+                ).start()
+            # Warm up, so that every worker has loaded the VAE
+            run_prompts(queue, index, workers, args.size, args.batch_size)
+            index += workers
+            failed = [item for item in queue.get_history().values() if not item["status"]["completed"]]
+            if failed:
+                raise RuntimeError(f"Benchmark prompt failed: {failed[0]['status']['messages']}")
+
+            seconds = run_prompts(queue, index, args.prompts, args.size, args.batch_size)
+            index += args.prompts
+            print(
+                f"{workers:7d} {args.prompts / seconds:9.2f} {args.prompts * args.batch_size / seconds:8.2f} "
+                f"{seconds / args.prompts:8.3f}"
+            )
+            # The idle workers of this configuration stay blocked on their own queue
+
+
+if __name__ == "__main__":
+    main()
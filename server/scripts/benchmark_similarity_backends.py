@@ -0,0 +1,102 @@
+"""Compare the accuracy and CPU latency of the similarity backends against the current model (ViT-L fp32).
+
+Scores every pair of the first --images images in data/puzzle_images with each backend and reports how far the
+scores are from the reference scores, along with the time to embed one image and a batch of images.
+    python -m scripts.benchmark_similarity_backends --images 8
+    python -m scripts.benchmark_similarity_backends --compile
+"""
+
+import argparse
+import itertools
+from pathlib import Path
+import statistics
+import time
+
+import torch
+
+from redoodle_server.similarity import SimilarityBackend, SimilarityService, similarity_score
+
+PUZZLE_IMAGES_DIR = Path(__file__).parent.parent / "data" / "puzzle_images"
+
+LARGE = "vit_large_patch14_dinov2.lvd142m"
+BASE = "vit_base_patch14_dinov2.lvd142m"
+SMALL = "vit_small_patch14_dinov2.lvd142m"
+REFERENCE = SimilarityBackend(LARGE, "fp32")
+BACKENDS = [
+    REFERENCE,
+    SimilarityBackend(LARGE, "int8"),
+    SimilarityBackend(LARGE, "bf16"),
+    SimilarityBackend(BASE, "fp32"),
+    SimilarityBackend(BASE, "int8"),
+    SimilarityBackend(SMALL, "fp32"),
+    SimilarityBackend(SMALL, "int8"),
+]
+
+
+def rank(values: list[float]) -> torch.Tensor:
+    return torch.tensor(values).argsort().argsort().float()
+
+
+def spearman(a: list[float], b: list[float]) -> float:
+    """Rank correlation, i.e. whether the backend orders the pairs the same way as the reference."""
+    return torch.corrcoef(torch.stack([rank(a), rank(b)]))[0, 1].item()
+
+
+def run_backend(
+    backend: SimilarityBackend, images: list[bytes], repeats: int
+) -> tuple[list[float], float, float, float]:
+    start = time.perf_counter()
+    service = SimilarityService(backend)
+    # Warm up, which is also when torch.compile compiles the model
+    service.embed_images(images[:1])
+    load_seconds = time.perf_counter() - start
+
+    single = []
+    for image in images[:repeats]:
+        start = time.perf_counter()
+        service.embed_images([image])
+        single.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    embeddings = service.embed_images(images)
+    batch_seconds = (time.perf_counter() - start) / len(images)
+
+    scores = [similarity_score(embeddings[i], embeddings[j]) for i, j in itertools.combinations(range(len(images)), 2)]
+    return scores, load_seconds, statistics.median(single), batch_seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3, help="Number of single image embeddings to time")
+    parser.add_argument("--compile", action="store_true", help="Also benchmark the torch.compile'd backends")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    image_paths = sorted((p for p in PUZZLE_IMAGES_DIR.glob("*.png") if p.stem.isdigit()), key=lambda p: int(p.stem))
+    images = [path.read_bytes() for path in image_paths[: args.images]]
+    backends = BACKENDS
+    if args.compile:
+        backends = BACKENDS + [SimilarityBackend(b.model_name, b.precision, compile=True) for b in BACKENDS]
+
+    print(
+        f"{'backend':<48} {'load s':>7} {'1 image s':>9} {'batched s/img':>13} "
+        f"{'mean |err|':>10} {'max |err|':>9} {'spearman':>8}"
+    )
+    reference_scores = None
+    for backend in backends:
+        scores, load_seconds, single_seconds, batch_seconds = run_backend(backend, images, args.repeats)
+        if reference_scores is None:
+            reference_scores = scores
+        errors = [abs(a - b) for a, b in zip(scores, reference_scores, strict=True)]
+        name = backend.embedding_key + (" compiled" if backend.compile else "")
+        print(
+            f"{name:<48} {load_seconds:7.2f} {single_seconds:9.3f} {batch_seconds:13.3f} "
+            f"{statistics.mean(errors):10.2f} {max(errors):9.2f} {spearman(scores, reference_scores):8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
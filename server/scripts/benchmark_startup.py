@@ -0,0 +1,70 @@
+"""Measure how long the server takes to start accepting requests and to become ready (similarity model loaded).
+
+Starts `uvicorn main:app` in a subprocess and polls /ready.
+    python -m scripts.benchmark_startup --runs 3
+The first run downloads the similarity model weights into the local cache if they are not there yet.
+"""
+
+import argparse
+from pathlib import Path
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+SERVER_DIR = Path(__file__).parent.parent
+POLL_INTERVAL_SECONDS = 0.05
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_startup(timeout: float) -> tuple[float | None, float | None]:
+    """Returns the seconds until the server answered /ready at all, and until it answered 200."""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"], cwd=SERVER_DIR
+    )
+    accepting = ready = None
+    try:
+        while ready is None and time.perf_counter() - start < timeout and process.poll() is None:
+            try:
+                resp = httpx.get(f"http://127.0.0.1:{port}/ready", timeout=1.0)
+            except httpx.TransportError:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            if accepting is None:
+                accepting = time.perf_counter() - start
+            if resp.status_code == 200:
+                ready = time.perf_counter() - start
+            else:
+                time.sleep(POLL_INTERVAL_SECONDS)
+    finally:
+        process.terminate()
+        process.wait()
+    return accepting, ready
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    results = [measure_startup(args.timeout) for _ in range(args.runs)]
+    for name, values in (("accepting requests", [r[0] for r in results]), ("ready", [r[1] for r in results])):
+        measured = [value for value in values if value is not None]
+        runs = ", ".join(f"{value:.2f}" for value in measured)
+        median = f"{statistics.median(measured):6.2f} s" if measured else "     -  "
+        print(f"{name:>18}: median {median} | runs {runs} | {len(values) - len(measured)} timed out")
+
+
+if __name__ == "__main__":
+    main()
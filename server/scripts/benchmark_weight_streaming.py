@@ -0,0 +1,138 @@
+"""Measure ComfyUI's lowvram mode with and without weight streaming (`--weight-streaming-budget`).
+
+Runs a randomly initialized model with the SD3.5 large architecture and fewer blocks for a few steps on CPU, in a
+fresh process per mode. The CPU stands in for the GPU: the lowvram modules copy their weights at a simulated host
+to device bandwidth (`comfy.weight_streaming.simulated_bandwidth`), which takes as long as the copy over PCIe would.
+- full: every weight stays on the device, no copies.
+- lowvram: only `--resident-mb` of weights stay on the device, each other layer is copied when it runs.
+- streaming: the same, with the copies of the next layers made while the current one computes.
+The outputs of the modes are compared, they should be identical:
+    python -m scripts.benchmark_weight_streaming --depth 8 --bandwidth-gb 1 --budget-mb 64
+"""
+
+import argparse
+import hashlib
+import json
+import subprocess
+import sys
+import time
+
+from scripts.comfyui_cpu import SERVER_DIR, import_comfy, mmdit_model_config
+
+MODES = ["full", "lowvram", "streaming"]
+
+
+def synthetic_model(depth: int):
+    """An SD3.5 large style MMDiT with `depth` blocks (SD3.5 large has 38) and random fp32 weights."""
+    import torch
+
+    model_config = mmdit_model_config(depth)
+    model_config.set_inference_dtype(torch.float32, None)
+    model = model_config.get_model({}, device=torch.device("cpu"))
+    generator = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for v in model.diffusion_model.state_dict().values():
+            v.copy_(torch.randn(v.shape, generator=generator) * 0.02)
+    return model
+
+
+def run(mode: str, depth: int, steps: int, resident_mb: float, bandwidth_gb: float) -> dict:
+    """Runs in the child process, after ComfyUI's arguments are set."""
+    import comfy.model_patcher
+    import comfy.weight_streaming
+    import torch
+
+    torch.set_num_threads(1)
+    if mode != "full":
+        comfy.weight_streaming.simulated_bandwidth = bandwidth_gb * 1024**3
+    device = torch.device("cpu")
+    model = synthetic_model(depth)
+    patcher = comfy.model_patcher.ModelPatcher(model, load_device=device, offload_device=device)
+    lowvram_model_memory = 0 if mode == "full" else round(resident_mb * 1024 * 1024)
+    patcher.patch_model(device_to=device, lowvram_model_memory=lowvram_model_memory)
+
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn((1, 16, 64, 64), generator=generator)
+    context = torch.randn((1, 154, 4096), generator=generator)
+    y = torch.randn((1, 2048), generator=generator)
+    times = []
+    with torch.no_grad():
+        for step in range(steps + 1):
+            start = time.perf_counter()
+            t = torch.full((1,), 1.0 - step / (steps + 1))
+            out = model.apply_model(x, t, c_crossattn=context, y=y)
+            times.append(time.perf_counter() - start)
+
+    streamer = getattr(model, "weight_streamer", None)
+    stats = streamer.stats() if streamer is not None else {"hits": 0, "misses": 0}
+    return {
+        # The first step records the order of the layers
+        "seconds_per_step": sum(times[1:]) / steps,
+        "first_step_seconds": times[0],
+        "streamed_mb": sum(p.nelement() * p.element_size() for p in model.parameters()) / 1024 / 1024,
+        "hits": stats["hits"],
+        "misses": stats["misses"],
+        "output_sha256": hashlib.sha256(out.numpy().tobytes()).hexdigest(),
+    }
+
+
+def run_mode(mode: str, args: argparse.Namespace) -> dict:
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "scripts.benchmark_weight_streaming",
+            "--child",
+            mode,
+            "--depth",
+            str(args.depth),
+            "--steps",
+            str(args.steps),
+            "--resident-mb",
+            str(args.resident_mb),
+            "--bandwidth-gb",
+            str(args.bandwidth_gb),
+            "--budget-mb",
+            str(args.budget_mb),
+        ],
+        cwd=SERVER_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=8, help="Blocks of the synthetic model")
+    parser.add_argument("--steps", type=int, default=3, help="Timed steps, after a first untimed one")
+    parser.add_argument("--resident-mb", type=float, default=1, help="MB of weights that stay on the device")
+    parser.add_argument("--bandwidth-gb", type=float, default=1, help="Simulated host to device GB/s")
+    parser.add_argument("--budget-mb", type=float, default=64, help="--weight-streaming-budget of the streaming mode")
+    # The mode that runs in its own process
+    parser.add_argument("--child", choices=MODES, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        budget = args.budget_mb if args.child == "streaming" else 0
+        import_comfy(["--weight-streaming-budget", str(budget)])
+        result = run(args.child, args.depth, args.steps, args.resident_mb, args.bandwidth_gb)
+        print(json.dumps(result))
+        return
+
+    print(f"{'mode':>9} {'s/step':>7} {'first step s':>12} {'hits':>6} {'misses':>6} {'same output':>11}")
+    reference = None
+    for mode in MODES:
+        result = run_mode(mode, args)
+        if reference is None:
+            reference = result["output_sha256"]
+        print(
+            f"{mode:>9} {result['seconds_per_step']:7.2f} {result['first_step_seconds']:12.2f} "
+            f"{result['hits']:6d} {result['misses']:6d} {result['output_sha256'] == reference!s:>11}"
+        )
+    print(f"weights: {result['streamed_mb']:.0f} MB, simulated bandwidth: {args.bandwidth_gb} GB/s")
+
+
+if __name__ == "__main__":
+    main()
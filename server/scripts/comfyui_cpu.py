@@ -0,0 +1,39 @@
+"""Helpers for the benchmarks that run ComfyUI in process on CPU, with synthetic models instead of downloaded ones."""
+
+from pathlib import Path
+import sys
+
+SERVER_DIR = Path(__file__).parent.parent
+COMFYUI_DIR = SERVER_DIR / "ComfyUI"
+
+
+def import_comfy(comfy_args: list[str]) -> None:
+    """Makes ComfyUI importable, on CPU with `comfy_args` as its other command line arguments."""
+    sys.argv = [sys.argv[0], "--cpu", *comfy_args]
+    sys.path.insert(0, str(COMFYUI_DIR))
+    import comfy.options
+
+    comfy.options.enable_args_parsing()
+
+
+def mmdit_model_config(depth: int):
+    """The model config of an SD3.5 large style MMDiT with `depth` blocks (SD3.5 large has 38), as
+    comfy.model_detection detects it, without allocating the weights of the model.
+    """
+    import comfy.model_detection
+    import torch
+
+    hidden_size = depth * 64
+    # Only the shapes of the keys that comfy.model_detection looks at
+    shapes = {
+        "x_embedder.proj.weight": (hidden_size, 16, 2, 2),
+        "final_layer.linear.weight": (2 * 2 * 16, hidden_size),
+        "y_embedder.mlp.0.weight": (hidden_size, 2048),
+        "context_embedder.weight": (hidden_size, 4096),
+        "pos_embed": (1, 192 * 192, hidden_size),
+        "joint_blocks.0.context_block.attn.qkv.weight": (hidden_size * 3, hidden_size),
+        "joint_blocks.0.context_block.attn.ln_q.weight": (64,),
+    }
+    detection_sd = {k: torch.empty(shape, device="meta") for k, shape in shapes.items()}
+    unet_config = comfy.model_detection.detect_unet_config(detection_sd, "")
+    return comfy.model_detection.model_config_from_unet_config(unet_config, detection_sd)
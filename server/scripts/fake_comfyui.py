@@ -0,0 +1,138 @@
+"""A minimal stand-in for the ComfyUI server, for exercising the ReDoodle server without a GPU.
+
+Implements the parts of the ComfyUI API the ReDoodle server uses: `POST /prompt`, `GET /history/{prompt_id}` and the
+`/ws` websocket with the `executing`/`executed` events that `PromptServer` sends to the submitting client, plus the
+binary output image messages of the `SaveImageWebsocket` node.
+Prompts are executed one at a time like ComfyUI's `PromptQueue`. A prompt with a batch of N input images takes
+`generation_seconds * (1 + batch_cost * (N - 1))`, so `batch_cost` < 1 models the GPU being faster per image in a batch.
+"""
+
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+from io import BytesIO
+import json
+import socket
+import struct
+import threading
+import time
+import uuid
+
+from fastapi import FastAPI, Query, WebSocket, WebSocketDisconnect
+from PIL import Image
+import uvicorn
+
+OUTPUT_IMAGE_EVENT = 3
+
+
+def _placeholder_png() -> bytes:
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (128, 128, 128)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeComfyUI:
+    def __init__(self, generation_seconds: float = 0.5, batch_cost: float = 1.0) -> None:
+        self.generation_seconds = generation_seconds
+        self.batch_cost = batch_cost
+        self.history: dict[str, dict] = {}
+        self.sockets: dict[str, WebSocket] = {}
+        self.request_counts: Counter[str] = Counter()
+        self.queue: asyncio.Queue | None = None
+        self.output_image = _placeholder_png()
+        self.app = self._create_app()
+
+    def _create_app(self) -> FastAPI:
+        @asynccontextmanager
+        async def lifespan(app: FastAPI):
+            self.queue = asyncio.Queue()
+            worker = asyncio.create_task(self._prompt_worker())
+            yield
+            worker.cancel()
+
+        app = FastAPI(lifespan=lifespan)
+
+        @app.post("/prompt")
+        async def post_prompt(body: dict):
+            self.request_counts["prompt"] += 1
+            prompt_id = str(body.get("prompt_id", uuid.uuid4()))
+            await self.queue.put((prompt_id, body["prompt"], body.get("client_id")))
+            return {"prompt_id": prompt_id, "number": self.request_counts["prompt"], "node_errors": {}}
+
+        @app.get("/history/{prompt_id}")
+        async def get_history(prompt_id: str):
+            self.request_counts["history"] += 1
+            if prompt_id in self.history:
+                return {prompt_id: self.history[prompt_id]}
+            return {}
+
+        @app.websocket("/ws")
+        async def websocket_handler(ws: WebSocket, client_id: str = Query("", alias="clientId")):
+            await ws.accept()
+            sid = client_id or uuid.uuid4().hex
+            self.sockets[sid] = ws
+            try:
+                await ws.send_json({"type": "status", "data": {"status": {}, "sid": sid}})
+                while True:
+                    await ws.receive_text()
+            except WebSocketDisconnect:
+                pass
+            finally:
+                self.sockets.pop(sid, None)
+
+        return app
+
+    async def _send(self, client_id: str | None, event: str, data: dict) -> None:
+        ws = self.sockets.get(client_id) if client_id else None
+        if ws is not None:
+            await ws.send_json({"type": event, "data": data})
+
+    async def _send_image(self, client_id: str | None, prompt_id: str, node_id: str, index: int) -> None:
+        ws = self.sockets.get(client_id) if client_id else None
+        if ws is not None:
+            header = json.dumps({"prompt_id": prompt_id, "node": node_id, "index": index, "format": "png"}).encode()
+            payload = struct.pack(">II", OUTPUT_IMAGE_EVENT, len(header)) + header + self.output_image
+            await ws.send_bytes(payload)
+
+    async def _prompt_worker(self) -> None:
+        while True:
+            prompt_id, prompt, client_id = await self.queue.get()
+            await self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+            batch_size = max(1, sum(node.get("class_type") == "LoadImageBase64" for node in prompt.values()))
+            await asyncio.sleep(self.generation_seconds * (1 + self.batch_cost * (batch_size - 1)))
+
+            outputs = {}
+            for node_id, node in prompt.items():
+                if node.get("class_type") == "SaveImage":
+                    output = {"images": [{"filename": f"{prompt_id}.png", "subfolder": "", "type": "output"}]}
+                elif node.get("class_type") == "SaveImageWebsocket":
+                    for index in range(batch_size):
+                        await self._send_image(client_id, prompt_id, node_id, index)
+                    output = {"websocket_images": [{"index": i, "format": "png"} for i in range(batch_size)]}
+                else:
+                    continue
+                outputs[node_id] = output
+                await self._send(client_id, "executed", {"node": node_id, "output": output, "prompt_id": prompt_id})
+
+            self.history[prompt_id] = {
+                "prompt": [0, prompt_id, prompt, {}, list(outputs)],
+                "outputs": outputs,
+                "status": {"status_str": "success", "completed": True, "messages": []},
+            }
+            await self._send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+
+def start_fake_server(fake: FakeComfyUI) -> tuple[uvicorn.Server, str]:
+    """Serve `fake` on a free local port from a background thread, returning the server and its base URL."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(fake.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
+
+
+if __name__ == "__main__":
+    uvicorn.run(FakeComfyUI().app, host="127.0.0.1", port=8188)